@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+"""Wrapper for running refind search workers directly from source tree."""
+
+from panaroo.refind_worker import main
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os, sys
+import time
 import tempfile
 from Bio import SeqIO
 import shutil
@@ -16,7 +17,10 @@ from .generate_network import generate_network
 from .generate_output import *
 from .clean_network import *
 from .find_missing import find_missing
+from .merge_nodes import materialise_merged
 from .generate_alignments import check_aligner_install
+from .gml_writer import write_gml, SnapshotWriter
+from .memory_profile import MemoryProfiler
 from intbitset import intbitset
 
 from .__init__ import __version__
@@ -157,6 +161,22 @@ off:
 Turns off all re-finding steps.'''),
         choices=['default', 'strict', 'off'],
         default='default')
+    refind.add_argument(
+        "--refind_shards",
+        dest="refind_shards",
+        help=("a directory shared with panaroo-refind-worker processes. " +
+              "Genome searches are written here as shards that any " +
+              "worker pointed at the directory can claim. It must not " +
+              "contain shards left by another run"),
+        default=None,
+        type=str)
+    refind.add_argument(
+        "--refind_shard_timeout",
+        dest="refind_shard_timeout",
+        help=("seconds without a heartbeat from the worker searching a " +
+              "shard before the shard is searched again (default=3600)"),
+        default=3600,
+        type=int)
 
     graph = parser.add_argument_group('Graph correction')
 
@@ -207,6 +227,13 @@ Turns off all re-finding steps.'''),
             "region (default = 5)."),
         type=int,
         default=5)
+    graph.add_argument(
+        "--find_high_var",
+        dest="find_high_var",
+        help=("Flag genes in highly variable regions with the highVar " +
+              "attribute in the final graph, using --high_var_flag"),
+        action='store_true',
+        default=False)
     graph.add_argument(
         "--min_edge_support_sv",
         dest="min_edge_support_sv",
@@ -220,6 +247,33 @@ Turns off all re-finding steps.'''),
               "output. Off by default as it uses a large amount of space."),
         action='store_true',
         default=False)
+    graph.add_argument(
+        "--snapshots",
+        dest="snapshots",
+        help=("How to write diagnostic graphs such as pre_filt_graph.gml. " +
+              "'sync' writes them immediately, 'async' writes a copy in a " +
+              "background thread, which needs memory for a second copy of " +
+              "the graph, and 'off' skips them (default='sync')"),
+        type=str,
+        choices=['sync', 'async', 'off'],
+        default='sync')
+    graph.add_argument(
+        "--parallel_collapse",
+        dest="parallel_collapse",
+        help=("Collapse gene families in parallel using --threads by " +
+              "splitting the graph into regions that are searched " +
+              "independently. Nodes are visited in sorted order, region " +
+              "by region, so the merges and node ids can differ from the " +
+              "default serial run"),
+        action='store_true',
+        default=False)
+    graph.add_argument(
+        "--memory_report",
+        dest="memory_report",
+        help=("Write the estimated memory used by graph attributes after " +
+              "each stage to graph_memory.json"),
+        action='store_true',
+        default=False)
     graph.add_argument(
         "--no_clean_edges",
         dest="clean_edges",
@@ -352,6 +406,14 @@ def main():
               quiet=(not args.verbose),
               n_cpu=args.n_cpu)
 
+    # diagnostic graphs can be written from a copy to avoid blocking the
+    # pipeline
+    snapshots = SnapshotWriter(mode=args.snapshots, quiet=(not args.verbose))
+
+    # optionally track graph memory usage after each stage
+    profiler = MemoryProfiler(enabled=args.memory_report,
+                              n_genomes=len(args.input_files))
+
     if args.verbose:
         print("generating initial network...")
 
@@ -361,25 +423,18 @@ def main():
         data_file=args.output_dir + "gene_data.csv",
         prot_seq_file=args.output_dir + "combined_protein_CDS.fasta",
         all_dna=args.all_seq_in_graph)
+    profiler.record("generate_network", G)
 
     # merge paralogs
     if args.verbose:
         print("Processing paralogs...")
     G = collapse_paralogs(G, centroid_contexts, quiet=(not args.verbose))
+    profiler.record("collapse_paralogs", G)
 
     # write out pre-filter graph in GML format
     for node in G.nodes():
         G.nodes[node]['size'] = len(G.nodes[node]['members'])
-        G.nodes[node]['genomeIDs'] = ";".join(
-            [str(m) for m in G.nodes[node]['members']])
-        G.nodes[node]['geneIDs'] = ";".join(G.nodes[node]['seqIDs'])
-        G.nodes[node]['degrees'] = G.degree[node]
-    for edge in G.edges():
-        G.edges[edge[0], edge[1]]['genomeIDs'] = ";".join(
-            [str(m) for m in G.edges[edge[0], edge[1]]['members']])
-    nx.write_gml(G,
-                 args.output_dir + "pre_filt_graph.gml",
-                 stringizer=custom_stringizer)
+    snapshots.write(G, args.output_dir + "pre_filt_graph.gml")
 
     if args.verbose:
         print("collapse mistranslations...")
@@ -394,7 +449,9 @@ def main():
                           length_outlier_support_proportion=args.
                           length_outlier_support_proportion,
                           n_cpu=args.n_cpu,
-                          quiet=(not args.verbose))[0]
+                          quiet=(not args.verbose),
+                          parallel=args.parallel_collapse)[0]
+    profiler.record("collapse_mistranslations", G)
 
     if args.verbose:
         print("collapse gene families...")
@@ -410,7 +467,9 @@ def main():
         length_outlier_support_proportion=args.
         length_outlier_support_proportion,
         n_cpu=args.n_cpu,
-        quiet=(not args.verbose))
+        quiet=(not args.verbose),
+        parallel=args.parallel_collapse)
+    profiler.record("collapse_families", G)
 
     if args.verbose:
         print("trimming contig ends...")
@@ -419,6 +478,7 @@ def main():
     G = trim_low_support_trailing_ends(G,
                                        min_support=args.min_trailing_support,
                                        max_recursive=args.trailing_recursive)
+    profiler.record("trim_trailing_ends", G)
 
     if len(G.nodes()) < 2:
         raise RuntimeError("Nearly all clusters have been trimmed! Try "
@@ -448,7 +508,10 @@ def main():
                         merge_id_thresh=max(0.8, args.family_threshold),
                         only_valid_genes=only_valid_genes,
                         n_cpu=args.n_cpu,
+                        shard_dir=args.refind_shards,
+                        shard_lock_timeout=args.refind_shard_timeout,
                         verbose=args.verbose)
+        profiler.record("find_missing", G)
 
         # remove edges that are likely due to misassemblies (by consensus)
 
@@ -466,15 +529,35 @@ def main():
                             n_cpu=args.n_cpu,
                             quiet=(not args.verbose),
                             distances_bwtn_centroids=distances_bwtn_centroids,
-                            centroid_to_index=centroid_to_index)[0]
+                            centroid_to_index=centroid_to_index,
+                            parallel=args.parallel_collapse)[0]
+        profiler.record("collapse_refound", G)
 
     if args.clean_edges:
         G = clean_misassembly_edges(
             G, edge_support_threshold=args.edge_support_threshold)
+        profiler.record("clean_misassembly_edges", G)
 
     # if requested merge paralogs
     if args.merge_paralogs:
         G = merge_paralogs(G)
+        profiler.record("merge_paralogs", G)
+
+    if args.find_high_var:
+        if args.verbose:
+            print("identifying highly variable regions...")
+        start = time.time()
+        G = identify_possible_highly_variable(
+            G, cycle_threshold_min=args.cycle_threshold_min)
+        if args.verbose:
+            print("flagged",
+                  sum(1 for n in G.nodes() if G.nodes[n]['highVar']),
+                  "highly variable genes in %.1f seconds" %
+                  (time.time() - start))
+        profiler.record("identify_high_var", G)
+
+    # concatenate the attributes of merged nodes for output
+    G = materialise_merged(G)
 
     isolate_names = [
         os.path.splitext(os.path.basename(x))[0] for x in args.input_files
@@ -530,7 +613,7 @@ def main():
         G.nodes[node]['protein'] = ";".join(conv_list(
             G.nodes[node]['protein']))
         G.nodes[node]['genomeIDs'] = ";".join(
-            [str(m) for m in G.nodes[node]['members']])
+            map(str, G.nodes[node]['members']))
         G.nodes[node]['geneIDs'] = ";".join(G.nodes[node]['seqIDs'])
         G.nodes[node]['degrees'] = G.degree[node]
         G.nodes[node]['members'] = list(G.nodes[node]['members'])
@@ -538,12 +621,12 @@ def main():
 
     for edge in G.edges():
         G.edges[edge[0], edge[1]]['genomeIDs'] = ";".join(
-            [str(m) for m in G.edges[edge[0], edge[1]]['members']])
+            map(str, G.edges[edge[0], edge[1]]['members']))
         G.edges[edge[0],
                 edge[1]]['members'] = list(G.edges[edge[0],
                                                    edge[1]]['members'])
 
-    nx.write_gml(G, args.output_dir + "final_graph.gml")
+    write_gml(G, args.output_dir + "final_graph.gml")
 
     #Write out core/pan-genome alignments
     if args.aln == "pan":
@@ -561,6 +644,10 @@ def main():
                                        args.core, args.codons, len(args.input_files),
                                        args.hc_threshold, args.subset)
 
+    # make sure any diagnostic snapshots have finished writing
+    snapshots.close()
+    profiler.write(args.output_dir + "graph_memory.json")
+
     # remove temporary directory
     shutil.rmtree(temp_dir)
 
@@ -1,8 +1,11 @@
 import networkx as nx
 from panaroo.cdhit import *
 from panaroo.merge_nodes import *
+from panaroo.membership import attach_membership, detach_membership
 from panaroo.isvalid import del_dups
 from collections import defaultdict, deque, Counter
+from joblib import Parallel, delayed
+import heapq
 from panaroo.cdhit import is_valid
 from itertools import chain, combinations
 import numpy as np
@@ -18,19 +21,23 @@ import sys
 # we can remove those with low support
 def trim_low_support_trailing_ends(G, min_support=3, max_recursive=2):
 
-    # fix trailing
+    # fix trailing. Removing a node can only expose new trailing nodes
+    # amongst its neighbours so only those are checked in the next round.
+    candidates = list(G.nodes())
     for i in range(max_recursive):
         bad_nodes = []
-        removed = False
-        for (node, val) in G.degree():
-            if val <= 1:  # trailing node
+        for node in candidates:
+            if G.degree[node] <= 1:  # trailing node
                 if G.nodes[node]['size'] < min_support:
                     bad_nodes.append(node)
-        for node in bad_nodes:
-            G.remove_node(node)
-            removed = True
 
-        if not removed: break
+        if len(bad_nodes) == 0: break
+
+        candidates = set()
+        for node in bad_nodes:
+            candidates.update(G.adj[node])
+        G.remove_nodes_from(bad_nodes)
+        candidates = [node for node in candidates if node in G]
 
     return G
 
@@ -58,135 +65,202 @@ def mod_bfs_edges(G, source, depth_limit=None):
             queue.popleft()
 
 
-def single_linkage(G, distances_bwtn_centroids, centroid_to_index, neighbours):
+class NeighbourhoodCache:
+    """Depth limited breadth-first neighbourhoods that are reused until the
+    graph around them changes.
+
+    `neighbours(node, depth)` returns the same list as
+    `[v for u, v in nx.bfs_edges(G, node, depth_limit=depth)] + [node]`.
+    Each entry is stored level by level so a search at a greater depth
+    extends a cached shallower search. An entry is dropped as soon as the
+    adjacency of any node it expanded is modified, which must be signalled
+    with `invalidate` before a merge.
+    """
+    def __init__(self, G):
+        self.G = G
+        self.entries = {}
+        self.readers = defaultdict(set)
+        self.stats = defaultdict(Counter)
+
+    def neighbours(self, node, depth):
+        entry = self.entries.get(node)
+        if entry is None:
+            entry = ([node], [1], {node})
+            self.entries[node] = entry
+            self.stats[depth]['misses'] += 1
+        elif len(entry[1]) > depth:
+            self.stats[depth]['hits'] += 1
+        else:
+            self.stats[depth]['extended'] += 1
+        discovered, level_ends, visited = entry
+
+        # expand the last level in the order its nodes were discovered
+        while len(level_ends) <= depth:
+            start = level_ends[-2] if len(level_ends) > 1 else 0
+            for parent in discovered[start:level_ends[-1]]:
+                self.readers[parent].add(node)
+                for child in self.G.adj[parent]:
+                    if child not in visited:
+                        visited.add(child)
+                        discovered.append(child)
+            level_ends.append(len(discovered))
+
+        return discovered[1:level_ends[depth]] + [node]
+
+    def invalidate(self, nodes):
+        # merging changes the adjacency of the merged nodes and their
+        # neighbours
+        changed = set(nodes)
+        for n in nodes:
+            changed.update(self.G.adj[n])
+        for n in changed:
+            for owner in self.readers.pop(n, ()):
+                self.entries.pop(owner, None)
+            self.entries.pop(n, None)
+        return
+
+
+def centroid_adjacency(distances_bwtn_centroids):
+    """Lists the centroids linked to each centroid in either direction of
+    the sparse distance matrix, indexed as in centroid_to_index."""
+    linked = csr_matrix(distances_bwtn_centroids != 0)
+    linked = (linked + linked.T).tocsr()
+    empty = frozenset()
+    adjacency = []
+    for i in range(linked.shape[0]):
+        start, end = linked.indptr[i], linked.indptr[i + 1]
+        if start == end:
+            adjacency.append(empty)
+        else:
+            adjacency.append(frozenset(linked.indices[start:end].tolist()))
+    return adjacency
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def single_linkage(G, centroid_adjacency, centroid_to_index, neighbours):
+    # one entry per centroid of each neighbour
     index = []
     neigh_array = []
     for neigh in neighbours:
         for sid in G.nodes[neigh]['centroid']:
             index.append(centroid_to_index[sid])
             neigh_array.append(neigh)
-    index = np.array(index, dtype=int)
-    neigh_array = np.array(neigh_array)
-
-    n_components, labels = connected_components(
-        csgraph=distances_bwtn_centroids[index][:, index],
-        directed=False,
-        return_labels=True)
-    # labels = labels[index]
+    positions = defaultdict(list)
+    for p, i in enumerate(index):
+        positions[i].append(p)
+
+    # union-find over the centroids that are linked
+    parent = list(range(len(index)))
+    for p, i in enumerate(index):
+        linked = centroid_adjacency[i]
+        if len(linked) < len(positions):
+            linked = [j for j in linked if j in positions]
+        else:
+            linked = [j for j in positions if j in linked]
+        for j in linked:
+            for q in positions[j]:
+                rp, rq = _find(parent, p), _find(parent, q)
+                if rp != rq:
+                    parent[max(rp, rq)] = min(rp, rq)
+
+    # label components in order of their first centroid as
+    # scipy.sparse.csgraph.connected_components does
+    label_of = {}
+    labels = []
+    for p in range(len(index)):
+        root = _find(parent, p)
+        if root not in label_of:
+            label_of[root] = len(label_of)
+        labels.append(label_of[root])
+
+    # nodes with multiple centroids join the clusters of each centroid,
+    # keeping the first label of the set as connected_components did
+    relabel = list(range(len(label_of)))
+    start = 0
     for neigh in neighbours:
-        l = list(set(labels[neigh_array == neigh]))
-        if len(l) > 1:
+        end = start + len(G.nodes[neigh]['centroid'])
+        if end - start > 1:
+            l = list(set(_find(relabel, x) for x in labels[start:end]))
             for i in l[1:]:
-                labels[labels == i] = l[0]
-
-    clusters = [
-        del_dups(list(neigh_array[labels == i])) for i in np.unique(labels)
-    ]
-
-    return (clusters)
-
-
-# @profile
-def collapse_families(G,
-                      seqid_to_centroid,
-                      outdir,
-                      family_threshold=0.7,
-                      dna_error_threshold=0.99,
-                      family_len_dif_percent=0,
-                      correct_mistranslations=False,
-                      length_outlier_support_proportion=0.01,
-                      n_cpu=1,
-                      quiet=False,
-                      distances_bwtn_centroids=None,
-                      centroid_to_index=None,
-                      depths = [1, 2, 3],
-                      search_genome_ids = None):
-
-    node_count = max(list(G.nodes())) + 10
-
-    if correct_mistranslations:
-        threshold = [0.99, 0.98, 0.95, 0.9]
-    else:
-        threshold = [0.99, 0.95, 0.9, 0.8, 0.7, 0.6, 0.5]
-
-    # precluster for speed
-    if correct_mistranslations:
-        cdhit_clusters = iterative_cdhit(G,
-                                         outdir,
-                                         thresholds=threshold,
-                                         s=family_len_dif_percent,
-                                         n_cpu=n_cpu,
-                                         quiet=True,
-                                         dna=True,
-                                         word_length=7,
-                                         accurate=False)
-        distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
-            G, cdhit_clusters, dna_error_threshold, dna=True, n_cpu=n_cpu)
-    elif distances_bwtn_centroids is None:
-        cdhit_clusters = iterative_cdhit(G,
-                                         outdir,
-                                         thresholds=threshold,
-                                         s=family_len_dif_percent,
-                                         n_cpu=n_cpu,
-                                         quiet=True,
-                                         dna=False)
-        distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
-            G, cdhit_clusters, family_threshold, dna=False, n_cpu=n_cpu)
-
-    # keep track of centroids for each sequence. Need this to resolve clashes
-    seqid_to_index = {}
-    for node in G.nodes():
-        for sid in G.nodes[node]['seqIDs']:
-            if "refound" in sid:
-                seqid_to_index[sid] = centroid_to_index[G.nodes[node]
-                                                        ["longCentroidID"][1]]
-            else:
-                seqid_to_index[sid] = centroid_to_index[seqid_to_centroid[sid]]
-
-    nonzero_dist = distances_bwtn_centroids.nonzero()
-    nonzero_dist = set([(i, j)
-                        for i, j in zip(nonzero_dist[0], nonzero_dist[1])])
-
-    node_mem_index = {}
-    for n in G.nodes():
-        node_mem_index[n] = defaultdict(set)
-        for sid in G.nodes[n]['seqIDs']:
-            node_mem_index[n][int(sid.split("_")[0])].add(seqid_to_index[sid])
+                relabel[i] = l[0]
+        start = end
+
+    clusters = defaultdict(list)
+    for label, neigh in zip(labels, neigh_array):
+        clusters[_find(relabel, label)].append(neigh)
+
+    return [del_dups(clusters[label]) for label in sorted(clusters)]
+
+
+def _collapse_search(G, node_count, depths, adjacency, centroid_to_index,
+                     node_mem_index,
+                     correct_mistranslations,
+                     length_outlier_support_proportion, search_genome_ids,
+                     quiet, ordered=False, border=None, search_nodes=None):
+    # With ordered=True nodes are visited in sorted order so that the merges
+    # within a region do not depend on the rest of the graph. Otherwise they
+    # are visited in set order as they always have been.
+    # If G is a region of a larger graph, border holds its nodes with
+    # neighbours outside the region. Nodes whose neighbourhood includes one
+    # are not searched and are returned as deferred instead.
+
+    # genome x node membership, kept up to date by merge_node_cluster. It is
+    # only needed to find the nodes of the genomes being searched
+    if search_genome_ids is not None:
+        membership = attach_membership(G)
+    neighbourhoods = NeighbourhoodCache(G)
+    deferred = set()
 
     for depth in depths:
         if not quiet: print("Processing depth: ", depth)
-        if search_genome_ids is None:
+        if search_nodes is not None:
+            search_space = set(n for n in search_nodes if n in G)
+        elif search_genome_ids is None:
             search_space = set(G.nodes())
         else:
-            search_space = set()
-            search_genome_ids = intbitset(search_genome_ids)
-            for n in G.nodes():
-                if len(G.nodes[n]['members'].intersection(search_genome_ids))>0:
-                    search_space.add(n)
-            
+            search_nodes = membership.nodes_with_any_genome(search_genome_ids)
+            search_space = set(n for n in G.nodes() if n in search_nodes)
+
         iteration_num = 1
         while len(search_space) > 0:
             # look for nodes to merge
-            temp_node_list = list(search_space)
+            if ordered:
+                temp_node_list = sorted(search_space)
+            else:
+                temp_node_list = list(search_space)
             removed_nodes = set()
             if not quiet: print("Iteration: ", iteration_num)
             iteration_num += 1
             for node in tqdm(temp_node_list, disable=quiet):
                 if node in removed_nodes: continue
 
+                if (border is not None) and (node in border):
+                    deferred.add(node)
+                    search_space.remove(node)
+                    continue
+
                 if G.degree[node] <= 2:
                     search_space.remove(node)
                     removed_nodes.add(node)
                     continue
 
                 # find neighbouring nodes and cluster their centroid with cdhit
-                neighbours = [
-                    v
-                    for u, v in nx.bfs_edges(G, source=node, depth_limit=depth)
-                ] + [node]
+                neighbours = neighbourhoods.neighbours(node, depth)
+
+                if (border is not None) and (not border.isdisjoint(neighbours)):
+                    # a merge here could reach outside the region
+                    deferred.add(node)
+                    search_space.remove(node)
+                    continue
 
                 # find clusters
-                clusters = single_linkage(G, distances_bwtn_centroids,
+                clusters = single_linkage(G, adjacency,
                                           centroid_to_index, neighbours)
 
                 for cluster in clusters:
@@ -210,6 +284,7 @@ def collapse_families(G,
                             removed_nodes.add(neig)
                             if neig in search_space: search_space.remove(neig)
 
+                        neighbourhoods.invalidate(cluster)
                         G = merge_node_cluster(
                             G,
                             cluster,
@@ -280,11 +355,8 @@ def collapse_families(G,
                                                         imem]:
                                                     for sidB in node_mem_index[
                                                             nB][imem]:
-                                                        if ((
-                                                                sidA, sidB
-                                                        ) in nonzero_dist) or (
-                                                            (sidB, sidA) in
-                                                                nonzero_dist):
+                                                        if sidB in adjacency[
+                                                                sidA]:
                                                             shouldmerge = False
                                                             break
                                                     if not shouldmerge: break
@@ -298,7 +370,7 @@ def collapse_families(G,
                             if len(sub_clust) > 1:
 
                                 clique_clusters = single_linkage(
-                                    G, distances_bwtn_centroids,
+                                    G, adjacency,
                                     centroid_to_index, sub_clust)
                                 for clust in clique_clusters:
                                     if len(clust) <= 1: continue
@@ -307,6 +379,7 @@ def collapse_families(G,
                                         removed_nodes.add(neig)
                                         if neig in search_space:
                                             search_space.remove(neig)
+                                    neighbourhoods.invalidate(clust)
                                     G = merge_node_cluster(
                                         G,
                                         clust,
@@ -333,9 +406,333 @@ def collapse_families(G,
                 if node in search_space:
                     search_space.remove(node)
 
+    if search_genome_ids is not None:
+        detach_membership(G)
+
+    deferred = set(n for n in deferred if n in G)
+
+    return G, node_count, neighbourhoods.stats, deferred
+
+
+def _ordered_edges(G):
+    """Order the edges of G so that adding them in turn recreates the
+    neighbour order of every node.
+
+    Each edge is inserted into the adjacency of both of its nodes at the same
+    time so the neighbour orders are consistent with a single edge ordering,
+    which is recovered by a topological sort.
+    """
+    succ = defaultdict(list)
+    indegree = Counter()
+    edges = set()
+    for node, nbrs in G.adjacency():
+        prev = None
+        for nbr in nbrs:
+            e = (node, nbr) if node <= nbr else (nbr, node)
+            edges.add(e)
+            if prev is not None:
+                succ[prev].append(e)
+                indegree[e] += 1
+            prev = e
+    heap = sorted(e for e in edges if indegree[e] == 0)
+    order = []
+    while len(heap) > 0:
+        e = heapq.heappop(heap)
+        order.append(e)
+        for f in succ[e]:
+            indegree[f] -= 1
+            if indegree[f] == 0:
+                heapq.heappush(heap, f)
+    return order
+
+
+def _copy_graph_ordered(G, nodes, H=None, mapping=None):
+    # copy a region of G into H keeping the node and neighbour order
+    if H is None:
+        H = nx.Graph()
+    if mapping is None:
+        mapping = {}
+    nodes = set(nodes)
+    region = G.subgraph(nodes)
+    H.add_nodes_from(
+        (mapping.get(n, n), dict(d)) for n, d in region.nodes(data=True))
+    H.add_edges_from((mapping.get(u, u), mapping.get(v, v), dict(G[u][v]))
+                     for u, v in _ordered_edges(region))
+    return H
+
+
+def _partition_regions(G, n_regions):
+    """Cut the nodes of G into n_regions runs of breadth-first order.
+
+    Returns the regions and, for each, the border of nodes that have a
+    neighbour in another region.
+    """
+    order = []
+    seen = set()
+    for start in sorted(G.nodes()):
+        if start in seen: continue
+        component = [start] + [v for u, v in nx.bfs_edges(G, start)]
+        seen.update(component)
+        order += component
+
+    size = max(1, -(-len(order) // n_regions))
+    regions = [order[i:i + size] for i in range(0, len(order), size)]
+    region_of = {}
+    for r, region in enumerate(regions):
+        for n in region:
+            region_of[n] = r
+    borders = []
+    for r, region in enumerate(regions):
+        borders.append(
+            set(n for n in region if any(region_of[m] != r for m in G.adj[n])))
+    return regions, borders
+
+
+def _collapse_region(G, border, node_count, depth, distances_bwtn_centroids,
+                     centroid_to_index, node_mem_index,
+                     correct_mistranslations,
+                     length_outlier_support_proportion, search_genome_ids):
+    adjacency = centroid_adjacency(distances_bwtn_centroids)
+    G, _, cache_stats, deferred = _collapse_search(
+        G, node_count, [depth], adjacency, centroid_to_index,
+        node_mem_index, correct_mistranslations,
+        length_outlier_support_proportion, search_genome_ids, True,
+        ordered=True, border=border)
+    new_mem_index = {n: node_mem_index[n] for n in G.nodes() if n > node_count}
+    return G, new_mem_index, cache_stats, deferred
+
+
+def _collapse_parallel(G, node_count, depths, distances_bwtn_centroids,
+                       centroid_to_index, node_mem_index,
+                       correct_mistranslations,
+                       length_outlier_support_proportion, search_genome_ids,
+                       n_cpu, quiet):
+    # At each depth the graph is cut into a region per worker. A worker only
+    # searches nodes whose neighbourhood stays clear of the region border, so
+    # each merge and every edge it changes lies inside one region and regions
+    # cannot interact, even within a single connected component. The nodes
+    # left over are then searched serially. Nodes are visited in sorted order
+    # and merged nodes are renumbered on the way back, so the merges and node
+    # ids can differ from the serial search.
+    adjacency = centroid_adjacency(distances_bwtn_centroids)
+    cache_stats = defaultdict(Counter)
+    for depth in depths:
+        regions, borders = _partition_regions(G, n_cpu)
+
+        results = Parallel(n_jobs=n_cpu)(delayed(_collapse_region)(
+            _copy_graph_ordered(G, region), border, node_count, depth,
+            distances_bwtn_centroids, centroid_to_index,
+            {n: node_mem_index[n] for n in region}, correct_mistranslations,
+            length_outlier_support_proportion, search_genome_ids)
+                                         for region, border in zip(
+                                             regions, borders))
+
+        # add the merged nodes back giving them unique ids
+        next_id = node_count
+        deferred = []
+        for region, (H, new_mem_index, stats, region_deferred) in zip(
+                regions, results):
+            for d in stats:
+                cache_stats[d].update(stats[d])
+            mapping = {}
+            for n in H.nodes():
+                if n > node_count:
+                    next_id += 1
+                    mapping[n] = next_id
+            merged = [n for n in region if n not in H]
+            G.remove_nodes_from(merged)
+            for n in merged:
+                node_mem_index[n] = None
+            for n in mapping:
+                G.add_node(mapping[n], **H.nodes[n])
+                node_mem_index[mapping[n]] = new_mem_index[n]
+            for n in mapping:
+                for nbr, attrs in H.adj[n].items():
+                    u, v = mapping[n], mapping.get(nbr, nbr)
+                    if not G.has_edge(u, v):
+                        G.add_edge(u, v, **attrs)
+            deferred += [mapping.get(n, n) for n in sorted(region_deferred)]
+        node_count = next_id
+
+        if not quiet:
+            print("Depth", depth, "searched", len(regions), "regions,",
+                  len(deferred), "nodes left for the serial search")
+
+        G, node_count, stats, _ = _collapse_search(
+            G, node_count, [depth], adjacency, centroid_to_index,
+            node_mem_index, correct_mistranslations,
+            length_outlier_support_proportion, search_genome_ids, True,
+            ordered=True, search_nodes=deferred)
+        for d in stats:
+            cache_stats[d].update(stats[d])
+
+    return G, cache_stats
+
+
+# @profile
+def collapse_families(G,
+                      seqid_to_centroid,
+                      outdir,
+                      family_threshold=0.7,
+                      dna_error_threshold=0.99,
+                      family_len_dif_percent=0,
+                      correct_mistranslations=False,
+                      length_outlier_support_proportion=0.01,
+                      n_cpu=1,
+                      quiet=False,
+                      distances_bwtn_centroids=None,
+                      centroid_to_index=None,
+                      depths = [1, 2, 3],
+                      search_genome_ids = None,
+                      parallel=False):
+
+    node_count = max(list(G.nodes())) + 10
+
+    if correct_mistranslations:
+        threshold = [0.99, 0.98, 0.95, 0.9]
+    else:
+        threshold = [0.99, 0.95, 0.9, 0.8, 0.7, 0.6, 0.5]
+
+    # precluster for speed
+    if correct_mistranslations:
+        cdhit_clusters = iterative_cdhit(G,
+                                         outdir,
+                                         thresholds=threshold,
+                                         s=family_len_dif_percent,
+                                         n_cpu=n_cpu,
+                                         quiet=True,
+                                         dna=True,
+                                         word_length=7,
+                                         accurate=False)
+        distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
+            G, cdhit_clusters, dna_error_threshold, dna=True, n_cpu=n_cpu)
+    elif distances_bwtn_centroids is None:
+        cdhit_clusters = iterative_cdhit(G,
+                                         outdir,
+                                         thresholds=threshold,
+                                         s=family_len_dif_percent,
+                                         n_cpu=n_cpu,
+                                         quiet=True,
+                                         dna=False)
+        distances_bwtn_centroids, centroid_to_index = pwdist_edlib(
+            G, cdhit_clusters, family_threshold, dna=False, n_cpu=n_cpu)
+
+    # keep track of centroids for each sequence. Need this to resolve clashes
+    seqid_to_index = {}
+    for node in G.nodes():
+        for sid in G.nodes[node]['seqIDs']:
+            if "refound" in sid:
+                seqid_to_index[sid] = centroid_to_index[G.nodes[node]
+                                                        ["longCentroidID"][1]]
+            else:
+                seqid_to_index[sid] = centroid_to_index[seqid_to_centroid[sid]]
+
+    node_mem_index = {}
+    for n in G.nodes():
+        node_mem_index[n] = defaultdict(set)
+        for sid in G.nodes[n]['seqIDs']:
+            node_mem_index[n][int(sid.split("_")[0])].add(seqid_to_index[sid])
+
+    if parallel and n_cpu > 1:
+        G, cache_stats = _collapse_parallel(
+            G, node_count, depths, distances_bwtn_centroids,
+            centroid_to_index, node_mem_index, correct_mistranslations,
+            length_outlier_support_proportion, search_genome_ids, n_cpu,
+            quiet)
+    else:
+        G, node_count, cache_stats, _ = _collapse_search(
+            G, node_count, depths,
+            centroid_adjacency(distances_bwtn_centroids), centroid_to_index,
+            node_mem_index,
+            correct_mistranslations, length_outlier_support_proportion,
+            search_genome_ids, quiet)
+
+    if not quiet:
+        for depth in sorted(cache_stats):
+            print("Neighbourhood cache depth", depth, "hits:",
+                  cache_stats[depth]['hits'], "extended:",
+                  cache_stats[depth]['extended'], "misses:",
+                  cache_stats[depth]['misses'])
+
     return G, distances_bwtn_centroids, centroid_to_index
 
 
+def _nearest_references(G, references, targets):
+    """Multi-source breadth-first search from the reference nodes.
+
+    Returns the distance to each reachable target and the index of its
+    nearest reference, taking the first reference in the list when several
+    are equally close.
+    """
+    targets = set(targets)
+    nearest = {}
+    labels = {}
+    frontier = []
+    for c, ref in enumerate(references):
+        if ref not in labels:
+            labels[ref] = c
+            frontier.append(ref)
+    depth = 0
+    while len(frontier) > 0:
+        for node in frontier:
+            if node in targets:
+                nearest[node] = (labels[node], depth)
+        if len(nearest) == len(targets):
+            break
+        depth += 1
+        next_labels = {}
+        for node in frontier:
+            for neigh in G.adj[node]:
+                if neigh in labels: continue
+                if labels[node] < next_labels.get(neigh, np.inf):
+                    next_labels[neigh] = labels[node]
+        labels.update(next_labels)
+        frontier = list(next_labels)
+    return nearest
+
+
+def _bfs_distances(G, source, targets):
+    # distances from source to the targets, stopping once all are found
+    targets = set(targets)
+    distances = {}
+    seen = {source}
+    frontier = [source]
+    depth = 0
+    while len(frontier) > 0:
+        for node in frontier:
+            if node in targets:
+                distances[node] = depth
+        if len(distances) == len(targets):
+            break
+        depth += 1
+        next_frontier = []
+        for node in frontier:
+            for neigh in G.adj[node]:
+                if neigh not in seen:
+                    seen.add(neigh)
+                    next_frontier.append(neigh)
+        frontier = next_frontier
+    return distances
+
+
+def _context_signature(G, node, max_context, centroid_to_index):
+    # sparse context of a node, mapping the index of each centroid within
+    # max_context steps to its depth counted down from max_context
+    context = {}
+    for u, neigh, depth in mod_bfs_edges(G, node, max_context):
+        context[centroid_to_index[G.nodes[neigh]['centroid'][0]]] = depth
+    return context
+
+
+def _context_similarity(context_a, context_b):
+    if len(context_a) > len(context_b):
+        context_a, context_b = context_b, context_a
+    shared = sorted(k for k in context_a if k in context_b)
+    diffs = np.array([context_a[k] - context_b[k] for k in shared],
+                     dtype=float)
+    return np.sum(1 / (1 + np.abs(diffs)))
+
+
 def collapse_paralogs(G, centroid_contexts, max_context=5, quiet=False):
 
     node_count = max(list(G.nodes())) + 10
@@ -373,6 +770,19 @@ def collapse_paralogs(G, centroid_contexts, max_context=5, quiet=False):
             cluster_dict[c].add(ref[0])
             cluster_mems[c].add(ref[1])
 
+        # distances from the references to each paralog. The nearest
+        # reference is found in a single search. Distances to every
+        # reference are only needed if a paralog from the same isolate has
+        # already been assigned to the nearest.
+        para_nodes = [
+            para[0] for para in centroid_contexts[centroid]
+            if para[1] != ref_paralogs[0][1]
+        ]
+        nearest = _nearest_references(G, [ref[0] for ref in ref_paralogs],
+                                      para_nodes)
+        ref_distances = None
+        ref_contexts = {}
+
         for para in centroid_contexts[centroid]:
             d_max = np.inf
             s_max = -np.inf
@@ -383,39 +793,42 @@ def collapse_paralogs(G, centroid_contexts, max_context=5, quiet=False):
                 continue
 
             # first attempt by shortest path
-            for c, ref in enumerate(ref_paralogs):
-                if para[1] in cluster_mems[c]:
-                    #dont match paralogs of the same isolate
-                    continue
-                # d = spath[para[0], ref[0]]
-                # d = gt.shortest_distance(Gt, para[0], ref[0])
-                try:
-                    d = nx.shortest_path_length(G, ref[0], para[0])
-                except nx.NetworkXNoPath:
-                    continue
-                if d < d_max:
+            if para[0] in nearest:
+                c, d = nearest[para[0]]
+                if para[1] not in cluster_mems[c]:
                     d_max = d
                     best_cluster = c
+                else:
+                    if ref_distances is None:
+                        ref_distances = [
+                            _bfs_distances(G, ref[0], para_nodes)
+                            for ref in ref_paralogs
+                        ]
+                    for c, ref in enumerate(ref_paralogs):
+                        if para[1] in cluster_mems[c]:
+                            #dont match paralogs of the same isolate
+                            continue
+                        if para[0] not in ref_distances[c]:
+                            continue
+                        d = ref_distances[c][para[0]]
+                        if d < d_max:
+                            d_max = d
+                            best_cluster = c
 
             # if this fails use context
             if d_max == np.inf:
                 best_cluster = 0
                 s_max = -np.inf
-                para_context = np.zeros(ncentroids)
-                for u, node, depth in mod_bfs_edges(G, para[0], max_context):
-                    para_context[centroid_to_index[G.nodes[node]['centroid']
-                                                   [0]]] = depth
+                para_context = _context_signature(G, para[0], max_context,
+                                                  centroid_to_index)
                 for c, ref in enumerate(ref_paralogs):
                     if para[1] in cluster_mems[c]:
                         #dont match paralogs of the same isolate
                         continue
-                    ref_context = np.zeros(ncentroids)
-                    for u, node, depth in mod_bfs_edges(
-                            G, ref[0], max_context):
-                        ref_context[centroid_to_index[G.nodes[node]['centroid']
-                                                      [0]]] = depth
-                    s = np.sum(1 / (1 + np.abs((para_context - ref_context)[
-                        (para_context * ref_context) != 0])))
+                    if c not in ref_contexts:
+                        ref_contexts[c] = _context_signature(
+                            G, ref[0], max_context, centroid_to_index)
+                    s = _context_similarity(para_context, ref_contexts[c])
                     if s > s_max:
                         s_max = s
                         best_cluster = c
@@ -433,6 +846,53 @@ def collapse_paralogs(G, centroid_contexts, max_context=5, quiet=False):
     return (G)
 
 
+def _paralog_clusters(paralog_centroids):
+    """Groups the node lists of each centroid into clusters of nodes that
+    are connected by sharing a centroid.
+
+    Gives the same clusters, with nodes added in the same order, as
+    repeatedly sweeping the remaining centroids for overlaps. A sweep adds a
+    centroid once an earlier centroid in the same sweep, or any centroid in
+    an earlier sweep, shares a node with it. The sweep in which each
+    centroid is added is therefore a shortest path over the centroid-node
+    incidences, which a single best-first search finds in (sweep, centroid)
+    order.
+    """
+    node_centroids = defaultdict(list)
+    for c, nodes in enumerate(paralog_centroids):
+        for node in nodes:
+            node_centroids[node].append(c)
+
+    sweep = [None] * len(paralog_centroids)
+    added = [False] * len(paralog_centroids)
+    seen = set()
+    merge_clusters = []
+    for first in range(len(paralog_centroids)):
+        if added[first]: continue
+        cluster = set(paralog_centroids[first])
+        sweep[first] = 0
+        heap = [(0, first)]
+        while len(heap) > 0:
+            s, c = heapq.heappop(heap)
+            if added[c]: continue
+            added[c] = True
+            if c != first:
+                cluster |= set(paralog_centroids[c])
+            for node in paralog_centroids[c]:
+                if node in seen: continue
+                seen.add(node)
+                for d in node_centroids[node]:
+                    if added[d]: continue
+                    # centroids before c are only reached on the next sweep
+                    t = s + (d < c)
+                    if (sweep[d] is None) or (t < sweep[d]):
+                        sweep[d] = t
+                        heapq.heappush(heap, (t, d))
+        merge_clusters.append(cluster)
+
+    return merge_clusters
+
+
 def merge_paralogs(G):
 
     node_count = max(list(G.nodes())) + 10
@@ -445,23 +905,7 @@ def merge_paralogs(G):
                 paralog_centroids[centroid].append(node)
 
     # find nodes that share common centroids
-    paralog_centroids = paralog_centroids.values()
-    merge_clusters = []
-    while len(paralog_centroids) > 0:
-        first, *rest = paralog_centroids
-        first = set(first)
-        lf = -1
-        while len(first) > lf:
-            lf = len(first)
-            rest2 = []
-            for r in rest:
-                if len(first.intersection(set(r))) > 0:
-                    first |= set(r)
-                else:
-                    rest2.append(r)
-            rest = rest2
-        merge_clusters.append(first)
-        paralog_centroids = rest
+    merge_clusters = _paralog_clusters(list(paralog_centroids.values()))
 
     # merge paralog nodes that share the same centroid
     for temp_c in merge_clusters:
@@ -511,10 +955,13 @@ def identify_possible_highly_variable(G,
     for node in G.nodes():
         G.nodes[node]['highVar'] = 0
 
-    # find all the cycles shorter than cycle_threshold
+    # find all the cycles shorter than cycle_threshold. Components that are
+    # trees have no cycles.
     complete_basis = []
     for c in nx.connected_components(G):
         sub_G = G.subgraph(c)
+        if sub_G.number_of_edges() < len(c):
+            continue
         basis = nx.cycle_basis(sub_G, list(sub_G.nodes())[0])
         complete_basis += [
             set(b) for b in basis if len(b) <= cycle_threshold_max
@@ -523,21 +970,40 @@ def identify_possible_highly_variable(G,
     # remove cycles that are too short
     complete_basis = [b for b in complete_basis if len(b) >= 3]
 
-    # merge cycles with more than one node in common (nested)
+    # merge cycles with more than one node in common (nested). Each node
+    # indexes the merged groups it belongs to and groups joined by a cycle
+    # are combined with a union-find.
     if len(complete_basis) < 1:
         return G
 
-    merged_basis = [[1, set(complete_basis[0])]]
-    for b in complete_basis[1:]:
-        b = set(b)
-        merged = False
-        for i, mb in enumerate(merged_basis):
-            if len(mb[1].intersection(b)) > 1:
-                merged = True
-                merged_basis[i][0] += 1
-                merged_basis[i][1] |= b
-        if not merged:
-            merged_basis.append([1, b])
+    parent = []
+    merged_basis = []
+    node_groups = defaultdict(set)
+    for b in complete_basis:
+        shared = Counter()
+        for node in b:
+            for g in set(_find(parent, g) for g in node_groups[node]):
+                shared[g] += 1
+        hits = [g for g in shared if shared[g] > 1]
+        if len(hits) > 0:
+            # keep the largest group as the root to limit copying
+            hits = sorted(hits, key=lambda g: -len(merged_basis[g][1]))
+            root = hits[0]
+            for g in hits[1:]:
+                parent[g] = root
+                merged_basis[root][0] += merged_basis[g][0]
+                merged_basis[root][1] |= merged_basis[g][1]
+                merged_basis[g] = None
+            merged_basis[root][0] += 1
+            merged_basis[root][1] |= b
+        else:
+            root = len(parent)
+            parent.append(root)
+            merged_basis.append([1, set(b)])
+        for node in b:
+            node_groups[node] = set(_find(parent, g)
+                                    for g in node_groups[node]) | set([root])
+    merged_basis = [b for b in merged_basis if b is not None]
 
     for b in merged_basis:
         if b[0] < cycle_threshold_min: continue
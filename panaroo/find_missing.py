@@ -4,16 +4,28 @@ from collections import defaultdict, Counter
 import numpy as np
 from Bio.Seq import translate, reverse_complement, Seq
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.Data.IUPACData import ambiguous_dna_complement
 from .cdhit import align_dna_cdhit
 from .isvalid import del_dups, is_valid_gene
 from joblib import Parallel, delayed
 import os
+import mmap
+import time
+import pickle
+import socket
+import threading
+import tempfile
 import gffutils as gff
 from io import StringIO
 import edlib
-from .merge_nodes import delete_node, remove_member_from_node
+from intbitset import intbitset
+from .merge_nodes import delete_node, remove_member_from_node, merged_value
+from .membership import attach_neighbours, detach_neighbours
 from tqdm import tqdm
 import re
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
 
 
 # @profile
@@ -29,6 +41,8 @@ def find_missing(G,
                  n_cpu,
                  remove_by_consensus=False,
                  only_valid_genes=False,
+                 shard_dir=None,
+                 shard_lock_timeout=3600,
                  verbose=True):
 
     # Iterate over each genome file checking to see if any missing accessory genes
@@ -44,149 +58,131 @@ def find_missing(G,
                 raise NameError("Duplicate internal ids!")
             id_to_gff[line[2]] = line[3]
 
-    # identify nodes that have been merged at the protein level
-    merged_ids = {}
-    for node in G.nodes():
-        if (len(G.nodes[node]['centroid']) >
-                1) or (G.nodes[node]['mergedDNA']):
-            for sid in sorted(G.nodes[node]['seqIDs']):
-                merged_ids[sid] = node
+    # the DNA of merged nodes is written to a sequence store that the
+    # searches read through a shared memory map, so only an (offset, length)
+    # handle is kept and sent to the workers for each gene
+    store_dir = shard_dir
+    if store_dir is None:
+        store_dir = os.path.dirname(os.path.abspath(dna_seq_file))
+    else:
+        os.makedirs(store_dir, exist_ok=True)
+    store_fd, seq_store = tempfile.mkstemp(suffix=".seqs", dir=store_dir)
+    os.close(store_fd)
+    # the store is as large as the merged sequences, so it is removed even
+    # if the search fails
+    store = SequenceStore(seq_store)
+    try:
+        merged_nodes = store_merged_genes(G, gene_data_file, store)
+        store.close()
+
+        # identify accessory genes for searching
+        search_list, conflicts, n_searches = plan_searches(G, id_to_gff)
 
-    merged_nodes = defaultdict(dict)
-    with open(gene_data_file, 'r') as infile:
-        next(infile)
-        for line in infile:
-            line = line.split(",")
-            if line[2] in merged_ids:
-                mem = int(sid.split("_")[0])
-                if merged_ids[line[2]] in merged_nodes[mem]:
-                    merged_nodes[mem][merged_ids[line[2]]] = G.nodes[
-                        merged_ids[line[2]]]["dna"][G.nodes[merged_ids[
-                            line[2]]]['maxLenId']]
-                else:
-                    merged_nodes[mem][merged_ids[line[2]]] = line[5]
-
-    # iterate through nodes to identify accessory genes for searching
-    # these are nodes missing a member with at least one neighbour that has that member
-    n_searches = 0
-    search_list = defaultdict(lambda: defaultdict(set))
-    conflicts = defaultdict(set)
-    for node in G.nodes():
-        for neigh in G.neighbors(node):
-            # seen_mems = set()
-            for sid in sorted(G.nodes[neigh]['seqIDs']):
-                member = int(sid.split("_")[0])
-
-                conflicts[member].add((neigh, id_to_gff[sid]))
-                if member not in G.nodes[node]['members']:
-                    if len(G.nodes[node]["dna"][G.nodes[node]
-                                                ['maxLenId']]) <= 0:
-                        print(G.nodes[node]["dna"])
-                        raise NameError("Problem!")
-                    search_list[member][node].add(
-                        (G.nodes[node]["dna"][G.nodes[node]['maxLenId']],
-                         id_to_gff[sid]))
-
-                    n_searches += 1
-
-    if verbose:
-        print("Number of searches to perform: ", n_searches)
-        print("Searching...")
-
-    all_hits, all_node_locs, max_seq_lengths = zip(*Parallel(n_jobs=n_cpu)(
-        delayed(search_gff)(search_list[member],
-                            conflicts[member],
-                            gff_handle,
-                            merged_nodes=merged_nodes[member],
-                            search_radius=search_radius,
-                            prop_match=prop_match,
-                            pairwise_id_thresh=pairwise_id_thresh,
-                            merge_id_thresh=merge_id_thresh,
-                            only_valid_genes=only_valid_genes)
-        for member, gff_handle in tqdm(enumerate(gff_file_handles),
-                                       disable=(not verbose))))
-
-    if verbose:
-        print("translating hits...")
-
-    hits_trans_dict = {}
-    for member, hits in enumerate(all_hits):
-        hits_trans_dict[member] = Parallel(n_jobs=n_cpu)(
-            delayed(translate_to_match)(hit[1], G.nodes[hit[0]]["protein"][0])
-            for hit in hits)
-
-    # remove nodes that conflict (overlap)
-    nodes_by_size = sorted([(G.nodes[node]['size'], node)
-                            for node in G.nodes()],
-                           reverse=True)
-    nodes_by_size = [n[1] for n in nodes_by_size]
-    member = 0
-    bad_node_mem_pairs = set()
-    bad_nodes = set()
-    for node_locs, max_seq_length in zip(all_node_locs, max_seq_lengths):
-        seq_coverage = defaultdict(
-            lambda: np.zeros(max_seq_length + 2, dtype=bool))
-
-        for node in nodes_by_size:
-            if node in bad_nodes: continue
-            if node not in node_locs: continue
-            contig_id = node_locs[node][0]
-            loc = node_locs[node][1]
-
-            if np.sum(seq_coverage[contig_id][loc[0]:loc[1]]) >= (
-                    0.5 * (max(G.nodes[node]['lengths']))):
-                if member in G.nodes[node]['members']:
-                    remove_member_from_node(G, node, member)
-                # G.nodes[node]['members'].remove(str(member))
-                # G.nodes[node]['size'] -= 1
-                bad_node_mem_pairs.add((node, member))
-            else:
-                seq_coverage[contig_id][loc[0]:loc[1]] = True
-        member += 1
-
-    for node in G.nodes():
-        if len(G.nodes[node]['members']) <= 0:
-            bad_nodes.add(node)
-    for node in bad_nodes:
-        if node in G.nodes():
-            delete_node(G, node)
-
-    # remove by consensus
-    if remove_by_consensus:
         if verbose:
-            print("removing by consensus...")
+            print("Number of searches to perform: ", n_searches)
+            print("Searching...")
+
+        # Search the genomes in parallel and remove hits that conflict
+        # (overlap) as the results for each genome arrive. Whether a hit's
+        # node is removed later is only known once every genome has been
+        # searched, so accepted hits are spooled to a temporary file and
+        # written out at the end. The neighbour index means removing many
+        # members from a node does not scan every edge of the node each time.
+        attach_neighbours(G)
+        nodes_by_size = sorted([(G.nodes[node]['size'], node)
+                                for node in G.nodes()],
+                               reverse=True)
+        nodes_by_size = [n[1] for n in nodes_by_size]
+
         node_hit_counter = Counter()
-        for member, hits in enumerate(all_hits):
-            for node, dna_hit in hits:
+        spool = tempfile.TemporaryFile(
+            mode='w+', dir=os.path.dirname(os.path.abspath(dna_seq_file)))
+        search_plans = (dict(node_search_dict=search_list[member],
+                             conflicts=conflicts[member],
+                             gff_handle_name=gff_handle,
+                             merged_nodes=merged_nodes[member],
+                             seq_store=seq_store,
+                             node_proteins={
+                                 node: G.nodes[node]["protein"][0]
+                                 for node in search_list[member]
+                             },
+                             search_radius=search_radius,
+                             prop_match=prop_match,
+                             pairwise_id_thresh=pairwise_id_thresh,
+                             merge_id_thresh=merge_id_thresh,
+                             only_valid_genes=only_valid_genes)
+                        for member, gff_handle in enumerate(gff_file_handles))
+        if shard_dir is None:
+            results = Parallel(n_jobs=n_cpu, return_as="generator")(
+                delayed(search_gff)(**plan) for plan in search_plans)
+        else:
+            results = sharded_search(shard_dir,
+                                     search_plans,
+                                     n_cpu=n_cpu,
+                                     lock_timeout=shard_lock_timeout,
+                                 verbose=verbose)
+        search_stats = []
+        for member, (hits, node_locs, max_seq_len, stats) in tqdm(
+                enumerate(results),
+                total=len(gff_file_handles),
+                disable=(not verbose)):
+            search_stats.append(stats)
+            bad_nodes = remove_conflicting_hits(G, member, node_locs,
+                                                nodes_by_size)
+            for node, dna_hit, hit_protein in hits:
                 if dna_hit == "": continue
                 if node in bad_nodes: continue
-                if (node, member) in bad_node_mem_pairs: continue
                 node_hit_counter[node] += 1
-        for node in G:
-            if node_hit_counter[node] > G.nodes[node]['size']:
+                contig_id, loc = node_locs[node]
+                spool.write("\t".join(
+                    map(str, [member, node, dna_hit, hit_protein, contig_id] +
+                        loc)) + "\n")
+
+        write_refind_stats(
+            os.path.join(os.path.dirname(os.path.abspath(dna_seq_file)),
+                         "refind_stats.tsv"), gff_file_handles, search_stats)
+        if verbose:
+            print("Alignments saved by merging overlapping search windows: ",
+                  sum(stats['alignments_saved'] for stats in search_stats))
+            print_slowest_searches(gff_file_handles, search_stats)
+
+        bad_nodes = set()
+        for node in G.nodes():
+            if len(G.nodes[node]['members']) <= 0:
                 bad_nodes.add(node)
         for node in bad_nodes:
             if node in G.nodes():
                 delete_node(G, node)
 
-    if verbose:
-        print("Updating output...")
-
-    n_found = 0
-    with open(dna_seq_file, 'a') as dna_out:
-        with open(prot_seq_file, 'a') as prot_out:
-            with open(gene_data_file, 'a') as data_out:
-                for member, (hits, node_locs) in enumerate(zip(all_hits, all_node_locs)):
-                    i = -1
-                    for node, dna_hit in hits:
-                        i += 1
-                        if dna_hit == "": continue
+        # remove by consensus
+        if remove_by_consensus:
+            if verbose:
+                print("removing by consensus...")
+            for node in G:
+                if node_hit_counter[node] > G.nodes[node]['size']:
+                    bad_nodes.add(node)
+            for node in bad_nodes:
+                if node in G.nodes():
+                    delete_node(G, node)
+
+        detach_neighbours(G)
+
+        if verbose:
+            print("Updating output...")
+
+        n_found = 0
+        spool.seek(0)
+        with open(dna_seq_file, 'a') as dna_out:
+            with open(prot_seq_file, 'a') as prot_out:
+                with open(gene_data_file, 'a') as data_out:
+                    for line in spool:
+                        (member, node, dna_hit, hit_protein, contig_id, start,
+                         end, strand) = line.rstrip("\n").split("\t")
+                        member = int(member)
+                        node = int(node)
                         if node in bad_nodes: continue
-                        if (node, member) in bad_node_mem_pairs: continue
-                        
-                        hit_protein = hits_trans_dict[member][i]
 
-                        hit_strand = '+' if node_locs[node][1][2]==0 else '-'
+                        hit_strand = '+' if strand == '0' else '-'
                         G.nodes[node]['members'].add(member)
                         G.nodes[node]['size'] += 1
                         G.nodes[node]['dna'] = del_dups(G.nodes[node]['dna'] +
@@ -200,17 +196,21 @@ def find_missing(G,
                                        "\n")
                         data_out.write(",".join([
                             os.path.splitext(
-                                os.path.basename(
-                                    gff_file_handles[member]))[0], node_locs[node][0],
+                                os.path.basename(gff_file_handles[member]))[0],
+                            contig_id,
                             str(member) + "_refound_" + str(n_found),
-                            str(member) + "_refound_" +
-                            str(n_found), hit_protein, dna_hit, "", 
-                            "location:" + str(node_locs[node][1][0]) + '-' +
-                            str(node_locs[node][1][1]) + ';strand:' + hit_strand
+                            str(member) + "_refound_" + str(n_found),
+                            hit_protein, dna_hit, "",
+                            "location:" + start + '-' + end + ';strand:' +
+                            hit_strand
                         ]) + "\n")
                         G.nodes[node]['seqIDs'] |= set(
                             [str(member) + "_refound_" + str(n_found)])
                         n_found += 1
+        spool.close()
+    finally:
+        store.close()
+        os.remove(seq_store)
 
     if verbose:
         print("Number of refound genes: ", n_found)
@@ -218,17 +218,411 @@ def find_missing(G,
     return (G)
 
 
+REFIND_STATS = [
+    "searches", "alignments_saved", "edlib_calls", "bases_aligned", "hits",
+    "seconds"
+]
+
+
+def write_refind_stats(outfile_name, gff_file_handles, search_stats):
+    """Write the cost of searching each genome to a tab separated file."""
+    with open(outfile_name, 'w') as outfile:
+        outfile.write("\t".join(["genome"] + REFIND_STATS) + "\n")
+        for gff, stats in zip(gff_file_handles, search_stats):
+            outfile.write("\t".join(
+                [os.path.splitext(os.path.basename(gff))[0]] +
+                ["%.3f" % stats['seconds']
+                 if s == "seconds" else str(stats[s])
+                 for s in REFIND_STATS]) + "\n")
+    return
+
+
+def print_slowest_searches(gff_file_handles, search_stats, n=5):
+    total = sum(stats['seconds'] for stats in search_stats)
+    slowest = sorted(range(len(search_stats)),
+                     key=lambda i: search_stats[i]['seconds'],
+                     reverse=True)[:n]
+    print("Slowest genomes to search (" + "%.1f" % total +
+          "s in total, see refind_stats.tsv):")
+    for i in slowest:
+        stats = search_stats[i]
+        genome = os.path.splitext(os.path.basename(gff_file_handles[i]))[0]
+        print("  " + genome + ": " + "%.2f" % stats['seconds'] + "s, " +
+              str(stats['searches']) + " searches, " +
+              str(stats['edlib_calls']) + " alignments, " +
+              str(stats['bases_aligned']) + " bases aligned, " +
+              str(stats['hits']) + " hits")
+    return
+
+
+def store_merged_genes(G, gene_data_file, store):
+    """Add the DNA of the genes in merged nodes to a SequenceStore.
+
+    Nodes that have been merged at the protein level are located in each
+    genome by aligning the gene of that genome, or the node's centroid if
+    the genome has more than one gene in the node. Returns the store
+    handles as member -> node -> handle.
+    """
+    merged_ids = {}
+    for node in G.nodes():
+        if (len(G.nodes[node]['centroid']) >
+                1) or (G.nodes[node]['mergedDNA']):
+            for sid in sorted(G.nodes[node]['seqIDs']):
+                merged_ids[sid] = node
+
+    merged_nodes = defaultdict(dict)
+    centroid_handles = {}
+    with open(gene_data_file, 'r') as infile:
+        next(infile)
+        for line in infile:
+            line = line.split(",")
+            if line[2] in merged_ids:
+                mem = int(line[2].split("_")[0])
+                node = merged_ids[line[2]]
+                if node in merged_nodes[mem]:
+                    if node not in centroid_handles:
+                        centroid = G.nodes[node]['maxLenId']
+                        centroid_handles[node] = store.add(
+                            G.nodes[node]["dna"][centroid])
+                    merged_nodes[mem][node] = centroid_handles[node]
+                else:
+                    merged_nodes[mem][node] = store.add(line[5])
+    return merged_nodes
+
+
+def plan_searches(G, id_to_gff):
+    """Find the genomes in which to search for each node.
+
+    A node is searched for in every genome that is missing from it but
+    present in one of its neighbours, in the region of that neighbour's
+    genes. Returns the searches, the neighbouring genes that a hit must
+    not overlap and the number of searches.
+    """
+    # index the genes of each node by genome, these are also the genes a
+    # hit must not overlap
+    node_genes = {}
+    conflicts = defaultdict(set)
+    for node in G.nodes():
+        genes = {}
+        connected = G.degree[node] > 0
+        for sid in G.nodes[node]['seqIDs']:
+            member = int(sid.split("_")[0])
+            gene = id_to_gff[sid]
+            genes[member] = genes.get(member, ()) + (gene, )
+            if connected:
+                conflicts[member].add((node, gene))
+        node_genes[node] = genes
+
+    search_list = defaultdict(lambda: defaultdict(set))
+    n_searches = 0
+    for node in G.nodes():
+        neighbours = list(G.neighbors(node))
+        missing = intbitset().union(
+            *[G.nodes[neigh]['members'] for neigh in neighbours])
+        missing -= G.nodes[node]['members']
+        if not missing:
+            continue
+        dna = G.nodes[node]["dna"][G.nodes[node]['maxLenId']]
+        if len(dna) <= 0:
+            print(G.nodes[node]["dna"])
+            raise NameError("Problem!")
+        searches = defaultdict(set)
+        for neigh in neighbours:
+            for member in G.nodes[neigh]['members'] & missing:
+                for gene in node_genes[neigh].get(member, ()):
+                    searches[member].add((dna, gene))
+                    n_searches += 1
+        for member in searches:
+            search_list[member][node] = searches[member]
+
+    return search_list, conflicts, n_searches
+
+
+def _shard_path(shard_dir, member, ext):
+    return os.path.join(shard_dir, "genome_" + str(member) + ext)
+
+
+def _shard_files(shard_dir, ext):
+    shards = []
+    for f in os.listdir(shard_dir):
+        if f.startswith("genome_") and f.endswith(ext):
+            shards.append(int(f[len("genome_"):-len(ext)]))
+    return sorted(shards)
+
+
+def _write_atomic(path, obj):
+    # write to a temporary file first so readers never see a partial shard
+    tmp = path + ".tmp." + socket.gethostname() + "." + str(os.getpid())
+    with open(tmp, 'wb') as outfile:
+        pickle.dump(obj, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    return
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
+
+
+def _lock_owner(lock_file):
+    # the host:pid of the worker holding a lock and the age of the lock
+    try:
+        age = time.time() - os.path.getmtime(lock_file)
+        with open(lock_file, 'r') as infile:
+            owner = infile.read().strip()
+    except FileNotFoundError:
+        return None, None
+    return owner if owner != "" else "unknown", age
+
+
+def _heartbeat(lock_file, interval, stop):
+    # touch the lock while its shard is searched so it is not reclaimed
+    while not stop.wait(interval):
+        try:
+            os.utime(lock_file)
+        except FileNotFoundError:
+            return
+    return
+
+
+def process_shards(shard_dir, heartbeat=60):
+    """Search the refind shards in shard_dir until none are left unclaimed.
+
+    A shard is claimed by creating its lock file, so any number of workers
+    on hosts sharing the directory can take shards from it. The lock is
+    touched every heartbeat seconds while the shard is searched, and the
+    result is dropped if the shard was reclaimed or merged back in the
+    meantime. Returns the number of shards searched.
+    """
+    owner = socket.gethostname() + ":" + str(os.getpid())
+    n_searched = 0
+    for member in _shard_files(shard_dir, ".plan"):
+        plan_file = _shard_path(shard_dir, member, ".plan")
+        lock_file = _shard_path(shard_dir, member, ".lock")
+        result_file = _shard_path(shard_dir, member, ".result")
+        if os.path.exists(result_file):
+            continue
+        try:
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(lock, 'w') as lockfile:
+            lockfile.write(owner + "\n")
+        try:
+            with open(plan_file, 'rb') as infile:
+                plan = pickle.load(infile)
+        except FileNotFoundError:
+            # the shard has been merged back and cleaned up already
+            _remove_if_exists(lock_file)
+            continue
+
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat,
+                                args=(lock_file, heartbeat, stop),
+                                daemon=True)
+        beat.start()
+        try:
+            result = search_gff(**plan)
+        finally:
+            stop.set()
+            beat.join()
+
+        if (_lock_owner(lock_file)[0] != owner) or (
+                not os.path.exists(plan_file)):
+            # another worker has taken over the shard
+            continue
+        _write_atomic(result_file, result)
+        n_searched += 1
+    return n_searched
+
+
+def sharded_search(shard_dir,
+                   search_plans,
+                   n_cpu=1,
+                   poll_interval=10,
+                   lock_timeout=3600,
+                   verbose=False):
+    """Search genomes through shard files that other workers can share.
+
+    Writes the search plan of each genome to shard_dir, searches shards
+    with n_cpu local workers alongside any panaroo-refind-worker processes
+    using the same directory, and yields the results in genome order.
+    shard_dir must not hold shards from another run. A shard whose lock has
+    not been touched by its worker for lock_timeout seconds is assumed to
+    belong to a dead worker and is searched again.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for ext in [".plan", ".lock", ".result"]:
+        if len(_shard_files(shard_dir, ext)) > 0:
+            raise RuntimeError("Refind shard directory " + shard_dir +
+                               " already contains shards from another " +
+                               "run! Remove them or use another directory.")
+
+    n_shards = 0
+    for member, plan in enumerate(search_plans):
+        plan['gff_handle_name'] = os.path.abspath(plan['gff_handle_name'])
+        if plan.get('seq_store') is not None:
+            plan['seq_store'] = os.path.abspath(plan['seq_store'])
+        _write_atomic(_shard_path(shard_dir, member, ".plan"), plan)
+        n_shards += 1
+
+    Parallel(n_jobs=n_cpu)(
+        delayed(process_shards)(shard_dir) for i in range(n_cpu))
+
+    for member in range(n_shards):
+        result_file = _shard_path(shard_dir, member, ".result")
+        lock_file = _shard_path(shard_dir, member, ".lock")
+        waiting = False
+        while not os.path.exists(result_file):
+            # wait for remote workers, picking up shards whose lock has been
+            # removed
+            time.sleep(poll_interval)
+            process_shards(shard_dir)
+            if os.path.exists(result_file): break
+            owner, age = _lock_owner(lock_file)
+            if owner is None: continue
+            if verbose and (not waiting):
+                print("Waiting for refind shard " + lock_file +
+                      " locked by " + owner)
+                waiting = True
+            if (lock_timeout is not None) and (age > lock_timeout):
+                if verbose:
+                    print("Reclaiming refind shard " + lock_file + " from " +
+                          owner + " after " + str(int(age)) + "s")
+                _remove_if_exists(lock_file)
+                process_shards(shard_dir)
+        with open(result_file, 'rb') as infile:
+            yield pickle.load(infile)
+        for ext in [".plan", ".lock", ".result"]:
+            _remove_if_exists(_shard_path(shard_dir, member, ext))
+
+    return
+
+
+def remove_conflicting_hits(G, member, node_locs, nodes_by_size):
+    """Remove member from nodes whose location overlaps a larger node.
+
+    Locations are claimed in order of node size, and a node loses the member
+    if at least half its length is already covered. Returns the nodes whose
+    location was rejected.
+    """
+    seq_coverage = defaultdict(IntervalCoverage)
+    bad_nodes = set()
+    for node in nodes_by_size:
+        if node not in node_locs: continue
+        contig_id = node_locs[node][0]
+        loc = node_locs[node][1]
+
+        if seq_coverage[contig_id].covered(loc[0], loc[1]) >= (
+                0.5 * (max(merged_value(G, node, 'lengths')))):
+            if member in G.nodes[node]['members']:
+                remove_member_from_node(G, node, member)
+            bad_nodes.add(node)
+        else:
+            seq_coverage[contig_id].add(loc[0], loc[1])
+    return bad_nodes
+
+
+class IntervalCoverage:
+    """The union of half open intervals added along a contig.
+
+    The union is kept as sorted, disjoint intervals so the number of
+    covered bases in a region is found with a binary search, using memory
+    proportional to the number of genes rather than the contig length.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def covered(self, start, end):
+        """Number of bases in [start, end) that are covered."""
+        if end <= start: return 0
+        total = 0
+        i = bisect_right(self.ends, start)
+        while (i < len(self.starts)) and (self.starts[i] < end):
+            total += min(end, self.ends[i]) - max(start, self.starts[i])
+            i += 1
+        return total
+
+    def add(self, start, end):
+        if end <= start: return
+        # merge with any intervals that overlap or touch [start, end)
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        return
+
+
+class SequenceStore:
+    """Sequences appended to a file and read back through a memory map.
+
+    Each sequence is referred to by an (offset, length) handle, so the
+    handles can be sent to other processes, which share the read only
+    pages of the file rather than each holding a copy of the sequences.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._size = os.path.getsize(path)
+        self._file = None
+        self._map = None
+
+    def add(self, seq):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        data = seq.encode()
+        self._file.write(data)
+        handle = (self._size, len(data))
+        self._size += len(data)
+        return handle
+
+    def __getitem__(self, handle):
+        offset, length = handle
+        if length == 0: return ""
+        if self._map is None:
+            with open(self.path, 'rb') as infile:
+                self._map = mmap.mmap(infile.fileno(),
+                                      0,
+                                      access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length].decode()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        return
+
+
 def search_gff(node_search_dict,
                conflicts,
                gff_handle_name,
                merged_nodes,
+               node_proteins,
                search_radius=10000,
                prop_match=0.2,
                pairwise_id_thresh=0.95,
                merge_id_thresh=0.7,
                only_valid_genes=False,
+               seq_store=None,
                n_cpu=1):
 
+    # record the cost of the search, returned alongside the hits
+    t_start = time.perf_counter()
+    stats = Counter(searches=0,
+                    alignments_saved=0,
+                    edlib_calls=0,
+                    bases_aligned=0,
+                    hits=0)
+
     gff_handle = open(gff_handle_name, 'r')
 
     # sort sets to fix order
@@ -242,13 +636,14 @@ def search_gff(node_search_dict,
     if len(split) != 2:
         raise NameError("File does not appear to be in GFF3 format!")
 
-    # load fasta
+    # load fasta, keeping each contig as a plain string (one byte per base)
+    # and only copying out the windows that are searched
     contigs = {}
     max_seq_len = 0
     with StringIO(split[1]) as temp_fasta:
-        for record in SeqIO.parse(temp_fasta, 'fasta'):
-            contigs[record.id] = np.array(list(str(record.seq)))
-            max_seq_len = max(max_seq_len, len(contigs[record.id]))
+        for title, seq in SimpleFastaParser(temp_fasta):
+            contigs[title.split(None, 1)[0]] = seq
+            max_seq_len = max(max_seq_len, len(seq))
 
     # load gff annotation
     parsed_gff = gff.create_db("\n".join(
@@ -259,7 +654,10 @@ def search_gff(node_search_dict,
                                from_string=True,
                                merge_strategy="create_unique")
 
-    # mask regions that already have genes and convert back to string
+    # merged nodes refer to their sequences in the store by handle
+    store = SequenceStore(seq_store) if merged_nodes else None
+
+    # locate the genes that are already annotated
     seen = set()
     for node, geneid in conflicts:
         gene = parsed_gff[geneid]
@@ -270,14 +668,15 @@ def search_gff(node_search_dict,
             db_seq = contigs[gene[0]][max(0, (start -
                                               search_radius)):(end +
                                                                search_radius)]
-            db_seq = "".join(list(db_seq))
+            merged_seq = store[merged_nodes[node]]
 
             hit, loc = search_dna(db_seq,
-                                  merged_nodes[node],
+                                  merged_seq,
                                   prop_match=(end - start) /
-                                  float(len(merged_nodes[node])),
+                                  float(len(merged_seq)),
                                   pairwise_id_thresh=merge_id_thresh,
-                                  refind=False)
+                                  refind=False,
+                                  stats=stats)
 
             # update location
             loc[0] = loc[0] + max(0, (start - search_radius))
@@ -285,6 +684,8 @@ def search_gff(node_search_dict,
             node_locs[node] = [gene[0], loc]
         else:
             node_locs[node] = [gene[0], [start - 1, end]]
+    if store is not None:
+        store.close()
 
     for node, geneid in conflicts:
         gene = parsed_gff[geneid]
@@ -297,54 +698,242 @@ def search_gff(node_search_dict,
             raise NameError("Duplicate entry!!!")
         seen.add((gene[0], start - 1, end))
 
-    for sid in contigs:
-        contigs[sid] = "".join(list(contigs[sid]))
-
-    # search for matches
+    # search for matches, aligning once to each region where the windows
+    # around the neighbours of a node overlap
     hits = []
     for node in node_search_dict:
         best_hit = ""
+        best_query = None
         best_loc = None
-        for search in node_search_dict[node]:
-            gene = parsed_gff[search[1]]
-            start = min(gene.start, gene.end)
-            end = max(gene.start, gene.end)
-            db_seq = contigs[gene[0]][max(0, (start -
-                                              search_radius)):(end +
-                                                               search_radius)]
+        windows = merge_search_windows(node_search_dict[node], parsed_gff,
+                                       search_radius)
+        stats['searches'] += len(node_search_dict[node])
+        stats['alignments_saved'] += len(node_search_dict[node]) - len(windows)
+        for query, contig, db_start, db_end in windows:
+            db_seq = contigs[contig][db_start:db_end]
 
             hit, loc = search_dna(db_seq,
-                                  search[0],
+                                  query,
                                   prop_match,
                                   pairwise_id_thresh,
-                                  refind=True)
+                                  refind=True,
+                                  stats=stats)
             # update location
-            loc[0] = loc[0] + max(0, (start - search_radius))
-            loc[1] = loc[1] + max(0, (start - search_radius))
+            loc[0] = loc[0] + db_start
+            loc[1] = loc[1] + db_start
 
             if len(hit) > len(best_hit):
                 best_hit = hit
-                best_loc = [gene[0], loc]
+                best_query = query
+                best_loc = [contig, loc]
         
-        if only_valid_genes:
-            if not is_valid_gene(hit, translate(search[0])):
+        if only_valid_genes and (best_hit != ""):
+            if not is_valid_gene(best_hit, translate(best_query)):
                 continue
 
-        hits.append((node, best_hit))
+        # translate in the frame best matching the node's protein
+        hits.append((node, best_hit,
+                     translate_to_match(best_hit, node_proteins[node])))
         if (best_loc is not None) and (best_hit != ""):
             node_locs[node] = best_loc
+            stats['hits'] += 1
 
     gff_handle.close()
+    stats['seconds'] = time.perf_counter() - t_start
+
+    return [hits, node_locs, max_seq_len, stats]
+
+
+def merge_search_windows(searches, parsed_gff, search_radius):
+    """Merge the overlapping windows searched around each neighbouring gene.
+
+    Returns a (query, contig, start, end) window for each union of
+    overlapping windows of the same query on a contig, in the order of
+    their first search.
+    """
+    intervals = defaultdict(list)
+    for order, (query, geneid) in enumerate(searches):
+        gene = parsed_gff[geneid]
+        start = min(gene.start, gene.end)
+        end = max(gene.start, gene.end)
+        intervals[(query, gene[0])].append(
+            (max(0, start - search_radius), end + search_radius, order))
+
+    windows = []
+    for (query, contig), contig_intervals in intervals.items():
+        merged = []
+        for start, end, order in sorted(contig_intervals):
+            if merged and start < merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+                merged[-1][2] = min(merged[-1][2], order)
+            else:
+                merged.append([start, end, order])
+        windows += [(order, query, contig, start, end)
+                    for start, end, order in merged]
+
+    return [w[1:] for w in sorted(windows)]
 
-    return [hits, node_locs, max_seq_len]
+
+# IUPAC complements as used by Biopython, applied with str.translate
+_COMPLEMENT = str.maketrans(
+    "".join(ambiguous_dna_complement) +
+    "".join(ambiguous_dna_complement).lower(),
+    "".join(ambiguous_dna_complement.values()) +
+    "".join(ambiguous_dna_complement.values()).lower())
+
+
+def reverse_complement_dna(seq):
+    """Reverse complement of a DNA string through a translation table."""
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _is_acgt(seq):
+    return len(seq.translate(_DELETE_ACGT)) == 0
 
 
 def repl(m):
     return ('X' * len(m.group()))
 
 
+# k-mer seeding of the search windows. Seeds are only used when any hit
+# passing the length and identity thresholds must contain an exact match
+# long enough to include a sampled k-mer of the window, so windows without
+# seeds can be skipped.
+MIN_SEED_LENGTH = 10
+SEED_LENGTH = 12
+
+_BASE_CODES = np.full(256, -1, dtype=np.int64)
+for _i, _b in enumerate(b"ACGT"):
+    _BASE_CODES[_b] = _i
+_DELETE_ACGT = str.maketrans("", "", "ACGT")
+
+EDLIB_EQUALITIES = [
+    ('A', 'N'),
+    ('C', 'N'),
+    ('G', 'N'),
+    ('T', 'N'),
+    ('A', 'E'),
+    ('C', 'E'),
+    ('G', 'E'),
+    ('T', 'E'),
+]
+
+
+@lru_cache(maxsize=None)
+def guaranteed_match_length(min_aln_length, pairwise_id_thresh):
+    """Length of exact match contained in any hit passing the thresholds.
+
+    A hit covering L bases of the window has fewer than
+    (1 - pairwise_id_thresh) * L edits, which split the at least L - e
+    matching bases into at most e + 1 exact runs.
+    """
+    max_edit_prop = 1.0 - pairwise_id_thresh
+    if max_edit_prop <= 0:
+        return min_aln_length
+    match_length = None
+    for L in range(min_aln_length,
+                   min_aln_length + int(4 / max_edit_prop) + 2):
+        e = max(0, int(np.ceil(max_edit_prop * L)) - 1)
+        run = -(-(L - e) // (e + 1))
+        if (match_length is None) or (run < match_length):
+            match_length = run
+    return match_length
+
+
+def kmer_codes(seq, k, step=1):
+    """Integer codes of the k-mers starting every step bases of seq."""
+    bases = _BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n = (len(bases) - k) // step + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(n, dtype=np.int64)
+    for j in range(k):
+        codes = codes * 4 + bases[j:j + (n - 1) * step + 1:step]
+    return codes
+
+
+def seed_windows(db_seq, search_sequence, match_length, offset=0):
+    """Windows of each strand of db_seq around k-mer matches to the query.
+
+    Sampling the k-mers of db_seq every match_length - k + 1 bases finds at
+    least one seed in any exact match of match_length. Each window covers
+    the diagonal of a seed, with some slack for indels, and overlapping
+    windows are merged. The windows are offset to allow for padding.
+    """
+    k = min(SEED_LENGTH, match_length)
+    step = match_length - k + 1
+    db_codes = kmer_codes(db_seq, k, step)
+    q_len = len(search_sequence)
+    slack = q_len // 4 + k
+
+    # k-mers of both strands of the query in one sorted table
+    q_codes = np.concatenate([
+        kmer_codes(search_sequence, k),
+        kmer_codes(reverse_complement_dna(search_sequence), k)
+    ])
+    n_kmers = len(q_codes) // 2
+    order = np.argsort(q_codes, kind='stable')
+    sorted_codes = q_codes[order]
+
+    db_pos = np.zeros(0, dtype=np.int64)
+    q_index = np.zeros(0, dtype=np.int64)
+    if len(sorted_codes) > 0:
+        lo = np.searchsorted(sorted_codes, db_codes, side='left')
+        hi = np.searchsorted(sorted_codes, db_codes, side='right')
+        # expand the matches of k-mers repeated in the query
+        n_matches = hi - lo
+        db_pos = np.repeat(np.arange(len(db_codes)) * step, n_matches)
+        q_index = order[np.repeat(hi - np.cumsum(n_matches), n_matches) +
+                        np.arange(np.sum(n_matches))]
+    strand, q_pos = np.divmod(q_index, n_kmers)
+    diagonals = [
+        np.unique(db_pos[strand == 0] - q_pos[strand == 0]),
+        # diagonals of the reverse complement query on the reverse strand
+        np.unique(len(db_seq) - q_len - db_pos[strand == 1] +
+                  q_pos[strand == 1])
+    ]
+
+    windows = []
+    for strand_diagonals in diagonals:
+        strand_windows = []
+        for d in strand_diagonals.tolist():
+            start = max(0, d - slack + offset)
+            end = d + q_len + slack + offset
+            if strand_windows and start <= strand_windows[-1][1]:
+                strand_windows[-1][1] = max(end, strand_windows[-1][1])
+            else:
+                strand_windows.append([start, end])
+        windows.append(strand_windows)
+
+    return windows
+
+
+def _seeded_align(search_sequence, db, windows, stats=None):
+    # align to each window and combine the results as edlib.align would
+    # report them for the whole of db
+    best = None
+    for start, end in windows:
+        if stats is not None:
+            stats['edlib_calls'] += 1
+            stats['bases_aligned'] += min(end, len(db)) - start
+        aln = edlib.align(search_sequence,
+                          db[start:end],
+                          mode="HW",
+                          task='path',
+                          k=10 * len(search_sequence),
+                          additionalEqualities=EDLIB_EQUALITIES)
+        if aln['editDistance'] == -1: continue
+        locations = [(s + start, e + start) for s, e in aln['locations']]
+        if (best is None) or (aln['editDistance'] < best['editDistance']):
+            best = aln
+            best['locations'] = locations
+        elif aln['editDistance'] == best['editDistance']:
+            best['locations'] += locations
+    return best
+
+
 def search_dna(db_seq, search_sequence, prop_match, pairwise_id_thresh,
-               refind):
+               refind, seeded=True, stats=None):
     found_dna = ""
     start = None
     end = None
@@ -360,26 +949,38 @@ def search_dna(db_seq, search_sequence, prop_match, pairwise_id_thresh,
 
     added_E_len = int(len(search_sequence) / 2)
 
-    for i, db in enumerate([db_seq, str(Seq(db_seq).reverse_complement())]):
+    # only seed when a hit passing the thresholds must contain a seed, and
+    # the sequences are plain ACGT so the N equalities cannot matter
+    match_length = guaranteed_match_length(
+        int(prop_match * len(search_sequence)) + 1, pairwise_id_thresh)
+    seeded = (seeded and (match_length >= MIN_SEED_LENGTH)
+              and (len(search_sequence) >= match_length)
+              and _is_acgt(db_seq) and _is_acgt(search_sequence))
+    if seeded:
+        windows = seed_windows(db_seq,
+                               search_sequence,
+                               match_length,
+                               offset=added_E_len)
+
+    for i, db in enumerate([db_seq, reverse_complement_dna(db_seq)]):
 
         # add some Ns at the start and end to deal with fragments at the end of contigs
         db = "E" * added_E_len + db + "E" * added_E_len
 
-        aln = edlib.align(search_sequence,
-                          db,
-                          mode="HW",
-                          task='path',
-                          k=10 * len(search_sequence),
-                          additionalEqualities=[
-                              ('A', 'N'),
-                              ('C', 'N'),
-                              ('G', 'N'),
-                              ('T', 'N'),
-                              ('A', 'E'),
-                              ('C', 'E'),
-                              ('G', 'E'),
-                              ('T', 'E'),
-                          ])
+        if seeded:
+            # no seeds means no hit can pass the thresholds on this strand
+            aln = _seeded_align(search_sequence, db, windows[i], stats)
+            if aln is None: continue
+        else:
+            if stats is not None:
+                stats['edlib_calls'] += 1
+                stats['bases_aligned'] += len(db)
+            aln = edlib.align(search_sequence,
+                              db,
+                              mode="HW",
+                              task='path',
+                              k=10 * len(search_sequence),
+                              additionalEqualities=EDLIB_EQUALITIES)
 
         # remove trailing inserts
         cig = re.split(r'(\d+)', aln['cigar'])[1:]
@@ -461,32 +1062,86 @@ def search_dna(db_seq, search_sequence, prop_match, pairwise_id_thresh,
     return seq, loc
 
 
-def translate_to_match(hit, target_prot):
-
-    if hit == "": return ""
+# codon lookup for the six frame translation. Codons containing anything
+# other than ACGT are rare and are translated with Biopython, which resolves
+# ambiguous codons where possible.
+_CODON_TABLE = np.frombuffer("".join(
+    translate(a + b + c) for a in "ACGT" for b in "ACGT"
+    for c in "ACGT").encode(),
+                             dtype=np.uint8)
+_CODON_BASES = np.full(256, -1, dtype=np.int64)
+for _i, _b in enumerate(b"ACGT"):
+    _CODON_BASES[_b] = _i
+    _CODON_BASES[ord(chr(_b).lower())] = _i
+
+
+@lru_cache(maxsize=None)
+def _translate_codon(codon):
+    return ord(translate(codon))
+
+# 6 bit codes for amino acids (and upper and lower case letters generally)
+# so each 3-mer is an 18 bit integer. Other characters share a code.
+_AA_CODES = np.full(256, 63, dtype=np.int64)
+for _i, _b in enumerate(
+        b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz*"):
+    _AA_CODES[_b] = _i
+
+
+def translate_codons(seq):
+    """Translate seq, whose length is a multiple of 3, with the standard table."""
+    bases = _CODON_BASES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    codons = bases.reshape(-1, 3)
+    valid = np.all(codons >= 0, axis=1)
+    index = np.where(valid, codons[:, 0] * 16 + codons[:, 1] * 4 + codons[:, 2],
+                     0)
+    protein = _CODON_TABLE[index]
+    for i in np.flatnonzero(~valid):
+        protein[i] = _translate_codon(seq[3 * i:3 * i + 3])
+    return protein.tobytes().decode()
+
+
+def six_frame_translation(dna):
+    """Translations of dna in the frame order used by translate_to_match.
+
+    Each frame is padded with N up to the next multiple of 3, adding a full
+    NNN codon when it is already a multiple of 3.
+    """
+    dna_seqs = [dna, reverse_complement_dna(dna)]
+    proteins = []
+    for i in range(3):
+        for s in dna_seqs:
+            s = s[i:]
+            proteins.append(
+                translate_codons(s.ljust(len(s) + (3 - len(s) % 3), 'N')))
+    return proteins
+
+
+def kmer_bitset(prot):
+    """The distinct 3-mers of a protein as an intbitset of integer codes."""
+    codes = _AA_CODES[np.frombuffer(prot.encode(), dtype=np.uint8)]
+    if len(codes) < 3:
+        return intbitset()
+    return intbitset(
+        (codes[:-2] * 4096 + codes[1:-1] * 64 + codes[2:]).tolist())
 
-    # translate in all 6 frames splitting on unknown
-    dna_seqs = [hit, reverse_complement(hit)]
 
-    proteins = [
-        translate(s[i:].ljust(len(s[i:]) + (3 - len(s[i:]) % 3), 'N'))
-        for i in range(3) for s in dna_seqs
-    ]
+def translate_to_match(hit, target_prot):
 
-    search_set = set(
-        [target_prot[i:i + 3] for i in range(len(target_prot) - 2)])
+    if hit == "": return ""
 
-    alignments = []
-    for target_sequence in proteins:
-        query_set = set([
-            target_sequence[i:i + 3] for i in range(len(target_sequence) - 2)
-        ])
-        alignments.append(
-            (target_sequence, len(search_set.intersection(query_set))))
+    # translate in all 6 frames and take the one sharing most 3-mers with
+    # the target
+    target_kmers = kmer_bitset(target_prot)
 
-    prot = max(alignments, key=lambda x: x[1])
+    best = None
+    best_shared = -1
+    for protein in six_frame_translation(hit):
+        shared = len(target_kmers & kmer_bitset(protein))
+        if shared > best_shared:
+            best = protein
+            best_shared = shared
 
-    return (prot[0])
+    return best
 
 
 blosum50 = \
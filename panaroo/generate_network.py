@@ -11,26 +11,34 @@ def generate_network(cluster_file, data_file, prot_seq_file, all_dna=False):
 
     # associate sequences with their clusters
     seq_to_cluster = {}
-    seqid_to_centroid = {}
     cluster_centroids = {}
-    cluster_members = defaultdict(list)
+    clust_seq_cluster = []
+    clust_seq_genome = []
     with open(cluster_file, 'r') as infile:
         for line in infile:
             if line[0] == ">":
-                cluster = int(line.strip().split()[-1])
+                cluster = int(line.split()[-1])
             else:
-                seq = line.split(">")[1].split("...")[0]
+                seq = line.split(">", 1)[1].split("...", 1)[0]
                 seq_to_cluster[seq] = cluster
-                cluster_members[cluster].append(seq.split("_")[0])
-                if line.strip().split()[-1] == "*":
+                clust_seq_cluster.append(cluster)
+                clust_seq_genome.append(seq.split("_", 1)[0])
+                if line.split()[-1] == "*":
                     cluster_centroids[cluster] = seq
+    n_clusters = len(set(clust_seq_cluster))
+    max_cluster = max(clust_seq_cluster)
 
-    # determine paralogs if required
-    paralogs = set()
-    for clust in cluster_members:
-        genomes = [s.split("_")[0] for s in cluster_members[clust]]
-        if len(genomes) != len(set(genomes)):
-            paralogs.add(clust)
+    # determine paralogs by counting (cluster, genome) pairs
+    clust_seq_cluster = np.array(clust_seq_cluster, dtype=np.int64)
+    clust_seq_genome = np.fromiter(map(int, clust_seq_genome),
+                                   dtype=np.int64,
+                                   count=len(clust_seq_genome))
+    n_genomes = np.max(clust_seq_genome) + 1
+    pair_keys, pair_counts = np.unique(clust_seq_cluster * n_genomes +
+                                       clust_seq_genome,
+                                       return_counts=True)
+    is_paralog = np.zeros(max_cluster + 1, dtype=bool)
+    is_paralog[pair_keys[pair_counts > 1] // n_genomes] = True
 
     # Load meta data such as sequence and annotation
     cluster_centroid_data = {}
@@ -38,9 +46,9 @@ def generate_network(cluster_file, data_file, prot_seq_file, all_dna=False):
     with open(data_file, 'r') as infile:
         next(infile)  # skip header
         for line in infile:
-            line = line.strip().split(",")
-            if line[2] in centroid_ids:
+            if line.split(",", 3)[2] in centroid_ids:
                 # this is a cluster centroid so keep it
+                line = line.strip().split(",")
                 cluster_centroid_data[seq_to_cluster[line[2]]] = {
                     'prot_sequence': line[4],
                     'dna_sequence': line[5],
@@ -48,184 +56,117 @@ def generate_network(cluster_file, data_file, prot_seq_file, all_dna=False):
                     'description': line[7],
                 }
 
-    # create a dictionary of indexes for paralog context
-    centroid_index = {}
-    for i, centroid in enumerate(cluster_centroids.values()):
-        centroid_index[centroid] = i
-    n_centroids = len(centroid_index.keys())
-
     # load headers which contain adjacency information
     seq_ids = []
-    for rec in SeqIO.parse(prot_seq_file, "fasta"):
-        seq_ids.append(str(rec.id))
+    with open(prot_seq_file, 'r') as infile:
+        for line in infile:
+            if line[0] == ">":
+                seq_ids.append(line[1:].split(None, 1)[0])
+
+    # integer table of (genome, contig, position) and cluster for every gene,
+    # sorted so that neighbouring genes on a contig are adjacent
+    n_genes = len(seq_ids)
+    gene_table = np.fromiter(map(int, "_".join(seq_ids).split("_")),
+                             dtype=np.int64,
+                             count=3 * n_genes).reshape(-1, 3)
+    clusters = np.fromiter(map(seq_to_cluster.__getitem__, seq_ids),
+                           dtype=np.int64,
+                           count=n_genes)
+    order = np.lexsort((gene_table[:, 2], gene_table[:, 1], gene_table[:, 0]))
+    gene_table = gene_table[order]
+    clusters = clusters[order]
+    seq_ids = [seq_ids[i] for i in order.tolist()]
+    genomes = gene_table[:, 0]
+
+    seqid_to_centroid = {
+        sid: cluster_centroids[c]
+        for sid, c in zip(seq_ids, clusters.tolist())
+    }
+
+    # each paralog gene gets its own node, numbered after the clusters
+    gene_paralog = is_paralog[clusters]
+    gene_nodes = clusters.copy()
+    gene_nodes[gene_paralog] = n_clusters + 1 + np.arange(
+        np.sum(gene_paralog))
+
+    # genes at the start or end of a contig
+    contig_start = gene_table[:, 2] == 0
+    contig_end = np.ones(n_genes, dtype=bool)
+    contig_end[:-1] = contig_start[1:]
+    gene_has_end = contig_start | contig_end
+
+    # nodes in order of first appearance
+    node_ids, first_index, gene_node_index = np.unique(gene_nodes,
+                                                       return_index=True,
+                                                       return_inverse=True)
+    node_counts = np.bincount(gene_node_index)
+    node_has_end = (np.bincount(gene_node_index, weights=gene_has_end) >
+                    0).tolist()
+    node_offsets = np.concatenate(([0], np.cumsum(node_counts))).tolist()
+    genes_by_node = np.argsort(gene_node_index, kind='stable')
+    node_seq_ids = [seq_ids[i] for i in genes_by_node.tolist()]
+    node_genomes = genomes[genes_by_node].tolist()
+    node_clusters = clusters[genes_by_node].tolist()
+    node_ids = node_ids.tolist()
+    node_counts = node_counts.tolist()
 
-    # build graph using adjacency information and optionally split paralogs
     G = nx.Graph()
-    centroid_context = defaultdict(list)
-    n_nodes = len(cluster_members)
-    temp_nodes = []
-    prev = None
+    node_attributes = []
+    for ni in np.argsort(first_index, kind='stable').tolist():
+        start, end = node_offsets[ni], node_offsets[ni + 1]
+        current_cluster = node_clusters[start]
+        count = node_counts[ni]
+        cdata = cluster_centroid_data[current_cluster]
+        centroid = cluster_centroids[current_cluster]
+        dna_len = len(cdata['dna_sequence'])
+        node_attributes.append(
+            (node_ids[ni], {
+                'size': count,
+                'centroid': [centroid],
+                'maxLenId': 0,
+                'members': intbitset(node_genomes[start:end]),
+                'seqIDs': set(node_seq_ids[start:end]),
+                'hasEnd': node_has_end[ni],
+                'protein': [cdata['prot_sequence']],
+                'dna': [cdata['dna_sequence']] * (count if all_dna else 1),
+                'annotation': cdata['annotation'],
+                'description': cdata['description'],
+                'lengths': [dna_len] * count,
+                'longCentroidID': (dna_len, centroid),
+                'paralog': bool(is_paralog[current_cluster]),
+                'mergedDNA': False
+            }))
+    G.add_nodes_from(node_attributes)
 
-    for i, id in enumerate(seq_ids):
-        current_cluster = seq_to_cluster[id]
-        seqid_to_centroid[id] = cluster_centroids[current_cluster]
-        loc = id.split("_")
-        genome_id = int(loc[0])
-        if loc[-1] == "0":
-            # we're at the start of a contig
-            if prev is not None: G.nodes[prev]['hasEnd'] = True
-            prev = current_cluster
-            if G.has_node(prev) and (prev not in paralogs):
-                G.nodes[prev]['size'] += 1
-                G.nodes[prev]['members'].add(genome_id)
-                G.nodes[prev]['seqIDs'].add(id)
-                G.nodes[prev]['hasEnd'] = True
-                G.nodes[current_cluster]['lengths'].append(
-                    len(cluster_centroid_data[prev]['dna_sequence']))
-                if all_dna:
-                    G.nodes[prev]['dna'] += [
-                        cluster_centroid_data[prev]['dna_sequence']
-                    ]
-            else:
-                if prev in paralogs:
-                    # create a new paralog
-                    n_nodes += 1
-                    prev = n_nodes
-                    temp_nodes.append(prev)
-                    centroid_context[
-                        cluster_centroids[current_cluster]].append(
-                            [prev, genome_id])
-                # add non paralog node
-                G.add_node(
-                    prev,
-                    size=1,
-                    centroid=[cluster_centroids[current_cluster]],
-                    maxLenId=0,
-                    members=intbitset([genome_id]),
-                    seqIDs=set([id]),
-                    hasEnd=True,
-                    protein=[
-                        cluster_centroid_data[current_cluster]['prot_sequence']
-                    ],
-                    dna=[
-                        cluster_centroid_data[current_cluster]['dna_sequence']
-                    ],
-                    annotation=cluster_centroid_data[current_cluster]
-                    ['annotation'],
-                    description=cluster_centroid_data[current_cluster]
-                    ['description'],
-                    lengths=[
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence'])
-                    ],
-                    longCentroidID=(len(cluster_centroid_data[current_cluster]
-                                        ['dna_sequence']),
-                                    cluster_centroids[current_cluster]),
-                    paralog=(current_cluster in paralogs),
-                    mergedDNA=False)
-        else:
-            is_paralog = current_cluster in paralogs
-            if is_paralog:
-                # create a new paralog
-                n_nodes += 1
-                neighbour = n_nodes
-                temp_nodes.append(neighbour)
-                centroid_context[cluster_centroids[current_cluster]].append(
-                    [neighbour, genome_id])
-                G.add_node(
-                    neighbour,
-                    size=1,
-                    centroid=[cluster_centroids[current_cluster]],
-                    maxLenId=0,
-                    members=intbitset([genome_id]),
-                    seqIDs=set([id]),
-                    hasEnd=False,
-                    protein=[
-                        cluster_centroid_data[current_cluster]['prot_sequence']
-                    ],
-                    dna=[
-                        cluster_centroid_data[current_cluster]['dna_sequence']
-                    ],
-                    annotation=cluster_centroid_data[current_cluster]
-                    ['annotation'],
-                    description=cluster_centroid_data[current_cluster]
-                    ['description'],
-                    lengths=[
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence'])
-                    ],
-                    longCentroidID=(len(cluster_centroid_data[current_cluster]
-                                        ['dna_sequence']),
-                                    cluster_centroids[current_cluster]),
-                    paralog=True,
-                    mergedDNA=False)
-                # add edge between nodes
-                G.add_edge(prev,
-                           neighbour,
-                           size=1,
-                           members=intbitset([genome_id]))
-                prev = neighbour
-            else:
-                if not G.has_node(current_cluster):
-                    # we need to add the gene in
-                    G.add_node(
-                        current_cluster,
-                        size=1,
-                        centroid=[cluster_centroids[current_cluster]],
-                        maxLenId=0,
-                        members=intbitset([genome_id]),
-                        seqIDs=set([id]),
-                        hasEnd=False,
-                        protein=[
-                            cluster_centroid_data[current_cluster]
-                            ['prot_sequence']
-                        ],
-                        dna=[
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']
-                        ],
-                        annotation=cluster_centroid_data[current_cluster]
-                        ['annotation'],
-                        description=cluster_centroid_data[current_cluster]
-                        ['description'],
-                        lengths=[
-                            len(cluster_centroid_data[current_cluster]
-                                ['dna_sequence'])
-                        ],
-                        longCentroidID=(len(
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']),
-                                        cluster_centroids[current_cluster]),
-                        paralog=is_paralog,
-                        mergedDNA=False)
-                    # add edge between nodes
-                    G.add_edge(prev,
-                               current_cluster,
-                               size=1,
-                               members=intbitset([genome_id]))
-                else:
-                    G.nodes[current_cluster]['size'] += 1
-                    G.nodes[current_cluster]['members'].add(genome_id)
-                    G.nodes[current_cluster]['seqIDs'].add(id)
-                    G.nodes[current_cluster]['lengths'].append(
-                        len(cluster_centroid_data[current_cluster]
-                            ['dna_sequence']))
-                    if all_dna:
-                        G.nodes[current_cluster]['dna'] += [
-                            cluster_centroid_data[current_cluster]
-                            ['dna_sequence']
-                        ]
-                    if G.has_edge(prev, current_cluster):
-                        G[prev][current_cluster]['size'] += 1
-                        G[prev][current_cluster]['members'].add(genome_id)
-                    else:
-                        G.add_edge(prev,
-                                   current_cluster,
-                                   size=1,
-                                   members=intbitset([genome_id]))
-                prev = current_cluster
+    # add edges between neighbouring genes on the same contig in bulk
+    adjacent = np.flatnonzero(~contig_start[1:]) + 1
+    if len(adjacent) > 0:
+        edge_u = gene_nodes[adjacent - 1]
+        edge_v = gene_nodes[adjacent]
+        key_base = np.max(gene_nodes) + 1
+        edge_keys = np.minimum(edge_u, edge_v) * key_base + np.maximum(
+            edge_u, edge_v)
+        _, edge_first, edge_index = np.unique(edge_keys,
+                                              return_index=True,
+                                              return_inverse=True)
+        edge_counts = np.bincount(edge_index)
+        edge_offsets = np.concatenate(([0], np.cumsum(edge_counts))).tolist()
+        edge_genomes = genomes[adjacent][np.argsort(edge_index,
+                                                    kind='stable')].tolist()
+        edge_u = edge_u[edge_first].tolist()
+        edge_v = edge_v[edge_first].tolist()
+        edge_counts = edge_counts.tolist()
+        G.add_edges_from(
+            (edge_u[ei], edge_v[ei], {
+                'size': edge_counts[ei],
+                'members': intbitset(
+                    edge_genomes[edge_offsets[ei]:edge_offsets[ei + 1]])
+            }) for ei in np.argsort(edge_first, kind='stable').tolist())
 
-    if prev is not None: 
-        G.nodes[prev]['hasEnd'] = True
+    # context table used to resolve paralogs
+    centroid_context = defaultdict(list)
+    for i in np.flatnonzero(gene_paralog).tolist():
+        centroid_context[cluster_centroids[int(clusters[i])]].append(
+            [int(gene_nodes[i]), int(genomes[i])])
 
     return G, centroid_context, seqid_to_centroid
@@ -0,0 +1,376 @@
+import os
+import re
+import time
+import threading
+import networkx as nx
+from networkx.exception import NetworkXError
+from intbitset import intbitset
+
+from .merge_nodes import MergedValues
+
+# marker used by networkx to flag single element lists
+LIST_START_VALUE = "_networkx_list_start"
+
+_valid_keys = re.compile("^[A-Za-z][0-9A-Za-z_]*$")
+_escape_chars = re.compile('[^ -~]|[&"]')
+_inf_text = repr(float("inf")).upper()
+
+
+def _fixup(m):
+    return '&#' + str(ord(m.group(0))) + ';'
+
+
+def escape(text):
+    """Use XML character references to escape characters.
+
+    Equivalent to the networkx GML escape but skips the regular expression
+    for the common case of plain printable ASCII (e.g. DNA sequences).
+    """
+    if text.isascii() and text.isprintable() and ('&' not in text) and (
+            '"' not in text):
+        return text
+    return _escape_chars.sub(_fixup, text)
+
+
+def _stringize_parts(value, parts):
+    # mirrors isvalid.custom_stringizer but appends to a list of parts
+    if isinstance(value, (int, bool)) or value is None:
+        if value is True:
+            parts.append('1')
+        elif value is False:
+            parts.append('0')
+        else:
+            parts.append(str(value))
+    elif isinstance(value, str):
+        text = repr(value)
+        if text[0] != 'u' and not value.isascii():
+            try:
+                value.encode('latin1')
+            except UnicodeEncodeError:
+                text = 'u' + text
+        parts.append(text)
+    elif isinstance(value, (float, complex, bytes)):
+        parts.append(repr(value))
+    elif isinstance(value, intbitset):
+        parts.append('[' + ','.join(map(str, value)) + ']')
+    elif isinstance(value, (list, set)):
+        parts.append('[')
+        first = True
+        for item in value:
+            if not first:
+                parts.append(',')
+            else:
+                first = False
+            _stringize_parts(item, parts)
+        parts.append(']')
+    elif isinstance(value, tuple):
+        if len(value) > 1:
+            parts.append('(')
+            first = True
+            for item in value:
+                if not first:
+                    parts.append(',')
+                else:
+                    first = False
+                _stringize_parts(item, parts)
+            parts.append(')')
+        elif value:
+            parts.append('(')
+            _stringize_parts(value[0], parts)
+            parts.append(',)')
+        else:
+            parts.append('()')
+    elif isinstance(value, dict):
+        parts.append('{')
+        first = True
+        for key, val in value.items():
+            if not first:
+                parts.append(',')
+            else:
+                first = False
+            _stringize_parts(key, parts)
+            parts.append(':')
+            _stringize_parts(val, parts)
+        parts.append('}')
+    else:
+        raise ValueError('%r cannot be converted into a Python literal' %
+                         (value, ))
+
+
+def fast_stringizer(value):
+    """Drop in replacement for `custom_stringizer`.
+
+    Produces identical output but builds the string by joining a list of
+    parts rather than writing each value to a StringIO buffer.
+    """
+    if isinstance(value, intbitset):
+        return '[' + ','.join(map(str, value)) + ']'
+    parts = []
+    _stringize_parts(value, parts)
+    return ''.join(parts)
+
+
+def _stringize(key, value, ignored_keys, indent, out, stringizer,
+               in_list=False):
+    # port of the stringize closure in networkx.generate_gml
+    if not isinstance(key, str):
+        raise NetworkXError(f"{key!r} is not a string")
+    if not _valid_keys.match(key):
+        raise NetworkXError(f"{key!r} is not a valid key")
+    if key in ignored_keys:
+        return
+    if isinstance(value, (int, bool)):
+        if key == "label":
+            out.append(indent + key + ' "' + str(value) + '"')
+        elif value is True:
+            out.append(indent + key + " 1")
+        elif value is False:
+            out.append(indent + key + " 0")
+        elif value < -(2**31) or value >= 2**31:
+            out.append(indent + key + ' "' + str(value) + '"')
+        else:
+            out.append(indent + key + " " + str(value))
+    elif isinstance(value, float):
+        text = repr(value).upper()
+        if text == _inf_text:
+            text = "+" + text
+        else:
+            epos = text.rfind("E")
+            if epos != -1 and text.find(".", 0, epos) == -1:
+                text = text[:epos] + "." + text[epos:]
+        if key == "label":
+            out.append(indent + key + ' "' + text + '"')
+        else:
+            out.append(indent + key + " " + text)
+    elif isinstance(value, dict):
+        out.append(indent + key + " [")
+        next_indent = indent + "  "
+        for k, v in value.items():
+            _stringize(k, v, (), next_indent, out, stringizer)
+        out.append(indent + "]")
+    elif isinstance(value, tuple) and key == "label":
+        out.append(indent + key +
+                   f' "({",".join(repr(v) for v in value)})"')
+    elif isinstance(value, (list, tuple)) and key != "label" and not in_list:
+        if len(value) == 0:
+            out.append(indent + key + " " + f'"{value!r}"')
+        if len(value) == 1:
+            out.append(indent + key + " " + f'"{LIST_START_VALUE}"')
+        for val in value:
+            _stringize(key, val, (), indent, out, stringizer, True)
+    else:
+        if stringizer:
+            try:
+                value = stringizer(value)
+            except ValueError as err:
+                raise NetworkXError(
+                    f"{value!r} cannot be converted into a string") from err
+        if not isinstance(value, str):
+            raise NetworkXError(f"{value!r} is not a string")
+        out.append(indent + key + ' "' + escape(value) + '"')
+
+
+def _render_nodes(chunk, stringizer):
+    out = []
+    ignored_keys = {"id", "label"}
+    for node_id, node, attrs in chunk:
+        out.append("  node [")
+        out.append("    id " + str(node_id))
+        _stringize("label", node, (), "    ", out, stringizer)
+        for attr, value in attrs.items():
+            _stringize(attr, value, ignored_keys, "    ", out, stringizer)
+        out.append("  ]")
+    out.append("")
+    return "\n".join(out)
+
+
+def _render_edges(chunk, stringizer):
+    out = []
+    ignored_keys = {"source", "target"}
+    for source, target, attrs in chunk:
+        out.append("  edge [")
+        out.append("    source " + str(source))
+        out.append("    target " + str(target))
+        for attr, value in attrs.items():
+            _stringize(attr, value, ignored_keys, "    ", out, stringizer)
+        out.append("  ]")
+    out.append("")
+    return "\n".join(out)
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _write_gml_items(path, graph_attrs, nodes, edges, stringizer,
+                     chunk_size, buffer_size):
+    # nodes yields (node, attrs) and edges (u, v, attrs) in output order
+    node_id = {}
+
+    def numbered(nodes):
+        for n, attrs in nodes:
+            node_id[n] = len(node_id)
+            yield node_id[n], n, attrs
+
+    with open(path, "wb", buffering=buffer_size) as outfile:
+        header = ["graph ["]
+        ignored_keys = {"directed", "multigraph", "node", "edge"}
+        for attr, value in graph_attrs.items():
+            _stringize(attr, value, ignored_keys, "  ", header, stringizer)
+        header.append("")
+        outfile.write("\n".join(header).encode("ascii"))
+
+        for chunk in _chunks(numbered(nodes), chunk_size):
+            outfile.write(_render_nodes(chunk, stringizer).encode("ascii"))
+        for chunk in _chunks(((node_id[u], node_id[v], attrs)
+                              for u, v, attrs in edges), chunk_size):
+            outfile.write(_render_edges(chunk, stringizer).encode("ascii"))
+
+        outfile.write("]\n".encode("ascii"))
+
+    return
+
+
+def write_gml(G, path, stringizer=None, chunk_size=1000, buffer_size=1 << 20):
+    """Write a graph in GML format.
+
+    Produces byte identical output to `networkx.write_gml` for undirected
+    graphs. Nodes and edges are rendered in chunks and written through a
+    buffered stream.
+    """
+    if G.is_directed() or G.is_multigraph():
+        raise NetworkXError("write_gml only supports undirected simple graphs")
+    _write_gml_items(path, G.graph, G.nodes.items(), G.edges(data=True),
+                     stringizer, chunk_size, buffer_size)
+    return
+
+
+def _snapshot_value(value, copy):
+    if isinstance(value, MergedValues):
+        return value.materialise()
+    if copy and isinstance(value, (list, set, dict, intbitset)):
+        return value.copy()
+    return value
+
+
+def snapshot_items(G, copy=False):
+    """The nodes and edges of a diagnostic snapshot of the graph.
+
+    Returns generators of (node, attrs) and (u, v, attrs) with the
+    'genomeIDs', 'geneIDs' and 'degrees' attributes added, without
+    modifying `G`. Each attribute dict is built as it is read, and mutable
+    values are only copied if copy is True.
+    """
+    def nodes():
+        for node, attrs in G.nodes.items():
+            nattrs = {k: _snapshot_value(v, copy) for k, v in attrs.items()}
+            nattrs['size'] = len(attrs['members'])
+            nattrs['genomeIDs'] = ";".join(map(str, attrs['members']))
+            nattrs['geneIDs'] = ";".join(attrs['seqIDs'])
+            nattrs['degrees'] = G.degree[node]
+            yield node, nattrs
+
+    def edges():
+        for u, v, attrs in G.edges(data=True):
+            eattrs = {k: _snapshot_value(val, copy) for k, val in attrs.items()}
+            eattrs['genomeIDs'] = ";".join(map(str, attrs['members']))
+            yield u, v, eattrs
+
+    return nodes(), edges()
+
+
+def snapshot_graph(G):
+    """Take a frozen copy of the graph for writing as a diagnostic snapshot.
+
+    Mutable attributes are copied so the pipeline can keep modifying `G`
+    while the snapshot is written.
+    """
+    H = nx.Graph()
+    H.graph.update(G.graph)
+    H.add_nodes_from(
+        (node, {k: _snapshot_value(v, True)
+                for k, v in attrs.items()}) for node, attrs in G.nodes.items())
+    H.add_edges_from(
+        (u, v, {k: _snapshot_value(val, True)
+                for k, val in attrs.items()})
+        for u, v, attrs in G.edges(data=True))
+    return H
+
+
+def write_snapshot(G, path, stringizer=fast_stringizer, chunk_size=1000,
+                   buffer_size=1 << 20):
+    """Write a diagnostic snapshot of G straight from the graph."""
+    nodes, edges = snapshot_items(G)
+    _write_gml_items(path, G.graph, nodes, edges, stringizer, chunk_size,
+                     buffer_size)
+    return
+
+
+class SnapshotWriter:
+    """Writes diagnostic graph snapshots.
+
+    mode is one of 'sync' (write immediately from the graph), 'async'
+    (write a frozen copy in a background thread, which holds a second copy
+    of the graph until it is written) or 'off' (skip snapshots). The write
+    time and file size of each snapshot is recorded and reported by `close`.
+    """
+    def __init__(self, mode='sync', quiet=False):
+        if mode not in ['sync', 'async', 'off']:
+            raise ValueError("Invalid snapshot mode: " + str(mode))
+        self.mode = mode
+        self.quiet = quiet
+        self.threads = []
+        self.stats = []
+        self.errors = []
+
+    def _write(self, G, path):
+        try:
+            start = time.time()
+            write_snapshot(G, path)
+            self.stats.append(
+                (os.path.basename(path), time.time() - start,
+                 os.path.getsize(path)))
+        except Exception as err:
+            self.errors.append(err)
+
+    def write(self, G, path):
+        if self.mode == 'off':
+            return
+        if self.mode == 'sync':
+            self._write(G, path)
+            self._raise_errors()
+        else:
+            start = time.time()
+            H = snapshot_graph(G)
+            copy_time = time.time() - start
+            if not self.quiet:
+                print("snapshot copy of", os.path.basename(path), "took",
+                      round(copy_time, 2), "seconds")
+            thread = threading.Thread(target=self._write,
+                                      args=(H, path),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return
+
+    def _raise_errors(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def close(self):
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._raise_errors()
+        if not self.quiet:
+            for name, seconds, size in self.stats:
+                print("snapshot", name, "written in", round(seconds, 2),
+                      "seconds,", round(size / 1e6, 2), "MB")
+        return self.stats
@@ -0,0 +1,142 @@
+from collections import defaultdict
+from intbitset import intbitset
+
+# keys used to attach the indices to the graph
+MEMBERSHIP_KEY = 'membership_index'
+NEIGHBOURS_KEY = 'neighbour_index'
+
+
+class MembershipIndex:
+    """Node x genome membership kept alongside a graph.
+
+    Rows hold a copy of each node's members and the columns map each genome
+    back to the nodes that contain it, so both 'genomes in node n' and
+    'nodes containing genome g' are cheap.
+
+    The index is updated by `merge_node_cluster`, `delete_node` and
+    `remove_member_from_node` while it is attached to the graph with
+    `attach_membership`. Other direct modifications of node members are not
+    tracked.
+    """
+    def __init__(self):
+        self.node_members = {}
+        self.genome_nodes = defaultdict(set)
+
+    @classmethod
+    def from_graph(cls, G):
+        index = cls()
+        for node, members in G.nodes(data='members'):
+            index.add_node(node, members)
+        return index
+
+    # updates
+    def add_node(self, node, members):
+        self.remove_node(node)
+        members = intbitset(members)
+        self.node_members[node] = members
+        for m in members:
+            self.genome_nodes[m].add(node)
+
+    def remove_node(self, node):
+        members = self.node_members.pop(node, None)
+        if members is None:
+            return
+        for m in members:
+            self.genome_nodes[m].discard(node)
+
+    def add_member(self, node, member):
+        self.node_members[node].add(member)
+        self.genome_nodes[member].add(node)
+
+    def remove_member(self, node, member):
+        self.node_members[node].discard(member)
+        self.genome_nodes[member].discard(node)
+
+    # queries
+    def genomes_of(self, node):
+        return self.node_members[node]
+
+    def nodes_with_genome(self, genome):
+        return self.genome_nodes.get(genome, set())
+
+    def nodes_with_any_genome(self, genomes):
+        nodes = set()
+        for g in genomes:
+            nodes |= self.nodes_with_genome(g)
+        return nodes
+
+
+class NeighbourIndex:
+    """The neighbours joined to a node by an edge carrying each genome.
+
+    The entry of a node is only built, in one pass over its edges, the
+    first time it is looked up. Entries are then kept up to date by
+    `merge_node_cluster`, `delete_node` and `remove_member_from_node` while
+    the index is attached with `attach_neighbours`, so removing many
+    members from the same node does not scan all of its edges each time.
+    """
+    def __init__(self):
+        self.node_neighbours = {}
+
+    def neighbours_with_genome(self, G, node, genome):
+        if node not in self.node_neighbours:
+            neighbours = {}
+            for neighbour, attrs in G.adj[node].items():
+                for m in attrs['members']:
+                    neighbours.setdefault(m, set()).add(neighbour)
+            self.node_neighbours[node] = neighbours
+        return self.node_neighbours[node].get(genome, set())
+
+    def add_edge_member(self, u, v, member):
+        for a, b in [(u, v), (v, u)]:
+            neighbours = self.node_neighbours.get(a)
+            if neighbours is not None:
+                neighbours.setdefault(member, set()).add(b)
+
+    def set_edge(self, u, v, members):
+        if (u in self.node_neighbours) or (v in self.node_neighbours):
+            for m in members:
+                self.add_edge_member(u, v, m)
+
+    def remove_member_edge(self, u, v, member):
+        for a, b in [(u, v), (v, u)]:
+            neighbours = self.node_neighbours.get(a)
+            if neighbours is None: continue
+            neighbours.get(member, set()).discard(b)
+            if len(neighbours.get(member, ())) == 0:
+                neighbours.pop(member, None)
+
+    def remove_node(self, G, node):
+        for neighbour, attrs in G.adj[node].items():
+            if neighbour in self.node_neighbours:
+                for m in attrs['members']:
+                    self.remove_member_edge(node, neighbour, m)
+        self.node_neighbours.pop(node, None)
+
+
+def attach_membership(G):
+    """Build a MembershipIndex for G and keep it in sync with merges."""
+    G.graph[MEMBERSHIP_KEY] = MembershipIndex.from_graph(G)
+    return G.graph[MEMBERSHIP_KEY]
+
+
+def detach_membership(G):
+    return G.graph.pop(MEMBERSHIP_KEY, None)
+
+
+def get_membership(G):
+    return G.graph.get(MEMBERSHIP_KEY, None)
+
+
+def attach_neighbours(G):
+    """Attach a NeighbourIndex to G, built lazily for the nodes touched."""
+    G.graph[NEIGHBOURS_KEY] = NeighbourIndex()
+    return G.graph[NEIGHBOURS_KEY]
+
+
+def detach_neighbours(G):
+    return G.graph.pop(NEIGHBOURS_KEY, None)
+
+
+def get_neighbours(G):
+    return G.graph.get(NEIGHBOURS_KEY, None)
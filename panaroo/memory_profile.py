@@ -0,0 +1,119 @@
+import sys
+import json
+import time
+import random
+import resource
+from collections import defaultdict
+from intbitset import intbitset
+
+from .merge_nodes import MergedValues
+from .__init__ import __version__
+
+
+def deep_sizeof(value):
+    """Estimate the number of bytes used by an attribute value.
+
+    Follows the containers used for graph attributes (lists, tuples, sets,
+    dicts, intbitsets and merged node values). Shared objects are counted
+    each time they are referenced.
+    """
+    if isinstance(value, intbitset):
+        return sys.getsizeof(value) + (value.get_allocated() *
+                                       value.get_wordbytsize())
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(v) for v in value)
+    elif isinstance(value, MergedValues):
+        size += deep_sizeof(value.parts)
+    elif isinstance(value, dict):
+        size += sum(
+            deep_sizeof(k) + deep_sizeof(v) for k, v in value.items())
+    return size
+
+
+def _attribute_bytes(items, n_total, sample_size, rng):
+    # estimate total bytes per attribute from a random sample of items
+    items = list(items)
+    if len(items) > sample_size:
+        items = rng.sample(items, sample_size)
+    attr_bytes = defaultdict(float)
+    for attrs in items:
+        for key, value in attrs.items():
+            attr_bytes[key] += deep_sizeof(value)
+    if len(items) > 0:
+        scale = n_total / float(len(items))
+        for key in attr_bytes:
+            attr_bytes[key] = int(round(attr_bytes[key] * scale))
+    return dict(sorted(attr_bytes.items(), key=lambda x: -x[1]))
+
+
+def graph_memory_usage(G, sample_size=2000, seed=0):
+    """Summarise the node/edge counts and attribute memory of a graph.
+
+    Attribute sizes are estimated by measuring the deep size of a random
+    sample of `sample_size` nodes and edges and scaling up to the full graph.
+    """
+    rng = random.Random(seed)
+    n_nodes = G.number_of_nodes()
+    n_edges = G.number_of_edges()
+    node_bytes = _attribute_bytes((d for n, d in G.nodes(data=True)),
+                                  n_nodes, sample_size, rng)
+    edge_bytes = _attribute_bytes((d for u, v, d in G.edges(data=True)),
+                                  n_edges, sample_size, rng)
+    return {
+        'n_nodes': n_nodes,
+        'n_edges': n_edges,
+        'node_attribute_bytes': node_bytes,
+        'edge_attribute_bytes': edge_bytes,
+        'total_node_attribute_bytes': sum(node_bytes.values()),
+        'total_edge_attribute_bytes': sum(edge_bytes.values())
+    }
+
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+class MemoryProfiler:
+    """Records the size of the graph after each stage of the pipeline.
+
+    When disabled `record` does nothing so the hook can be left in place.
+    The report is written as JSON by `write`.
+    """
+    def __init__(self, enabled=False, sample_size=2000, n_genomes=None):
+        self.enabled = enabled
+        self.sample_size = sample_size
+        self.n_genomes = n_genomes
+        self.stages = []
+        self.last_time = time.time()
+
+    def record(self, stage, G):
+        if not self.enabled:
+            return
+        now = time.time()
+        stats = {'stage': stage, 'stage_seconds': round(now - self.last_time, 3)}
+        stats.update(graph_memory_usage(G, sample_size=self.sample_size))
+        stats['peak_rss_bytes'] = peak_rss_bytes()
+        self.stages.append(stats)
+        # don't count the time spent profiling towards the next stage
+        self.last_time = time.time()
+        return
+
+    def write(self, outfile):
+        if not self.enabled:
+            return
+        with open(outfile, 'w') as out:
+            json.dump(
+                {
+                    'panaroo_version': __version__,
+                    'n_genomes': self.n_genomes,
+                    'sample_size': self.sample_size,
+                    'stages': self.stages
+                },
+                out,
+                indent=2)
+        return
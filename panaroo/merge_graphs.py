@@ -17,7 +17,7 @@ from .__init__ import __version__
 from .cdhit import run_cdhit
 from .generate_output import *
 from .clean_network import *
-from .merge_nodes import merge_node_cluster, gen_edge_iterables, gen_node_iterables, iter_del_dups, del_dups
+from .merge_nodes import merge_node_cluster, gen_edge_iterables, gen_node_iterables, iter_del_dups, del_dups, materialise_merged
 
 
 def make_list(inp):
@@ -344,6 +344,9 @@ def merge_graphs(directories,
     # Generate output
     if not quiet: print("Generating output...")
 
+    # concatenate the attributes of merged nodes for output
+    G = materialise_merged(G)
+
     G.graph['isolateNames'] = isolate_names
     mems_to_isolates = {}
     for i, iso in enumerate(isolate_names):
@@ -3,6 +3,7 @@ from collections import Counter
 from .isvalid import del_dups
 import numpy as np
 from intbitset import intbitset
+from .membership import get_membership, get_neighbours
 
 
 def gen_node_iterables(G, nodes, feature, split=None):
@@ -37,6 +38,84 @@ def del_dups(iterable):
     return (list(seen.keys()))
 
 
+# Attributes of merged nodes that are only needed for output. Merging
+# records the values of the merged nodes in a MergedValues rather than
+# concatenating them, so a family merged over many iterations is not copied
+# at each step. Use merged_value or materialise_merged before reading them.
+JOINED_ATTRIBUTES = ('annotation', 'description')
+LIST_ATTRIBUTES = ('lengths', )
+MAX_MERGE_DEPTH = 32
+
+
+class MergedValues:
+    """The values of an attribute of merged nodes, in merge order.
+
+    `parts` holds the values of each merged node, which may themselves be
+    MergedValues. Joined attributes are ';' separated strings which are
+    split, deduplicated and rejoined when materialised, list attributes are
+    concatenated.
+    """
+    __slots__ = ('parts', 'joined', 'depth')
+
+    def __init__(self, parts, joined, depth=1):
+        self.parts = parts
+        self.joined = joined
+        self.depth = depth
+
+    def leaves(self):
+        # the concrete values in order, without recursion
+        stack = [iter(self.parts)]
+        while stack:
+            for part in stack[-1]:
+                if isinstance(part, MergedValues):
+                    stack.append(iter(part.parts))
+                    break
+                yield part
+            else:
+                stack.pop()
+
+    def materialise(self):
+        if self.joined:
+            return ";".join(
+                iter_del_dups(leaf.split(";") for leaf in self.leaves()))
+        return list(itertools.chain.from_iterable(self.leaves()))
+
+
+def merge_values(values, joined):
+    parts = tuple(values)
+    depth = 1 + max([p.depth for p in parts if isinstance(p, MergedValues)],
+                    default=0)
+    merged = MergedValues(parts, joined, depth)
+    if depth > MAX_MERGE_DEPTH:
+        # flatten deeply nested merges to keep copying and pickling cheap
+        merged = MergedValues(tuple(merged.leaves()), joined)
+    return merged
+
+
+def materialise_value(value):
+    if isinstance(value, MergedValues):
+        return value.materialise()
+    return value
+
+
+def merged_value(G, node, feature):
+    """Read an attribute of a node, materialising it if it has been merged."""
+    value = G.nodes[node][feature]
+    if isinstance(value, MergedValues):
+        value = value.materialise()
+        G.nodes[node][feature] = value
+    return value
+
+
+def materialise_merged(G):
+    """Concatenate the attributes of all merged nodes, ready for output."""
+    for node in G.nodes():
+        for feature in JOINED_ATTRIBUTES + LIST_ATTRIBUTES:
+            if feature in G.nodes[node]:
+                merged_value(G, node, feature)
+    return G
+
+
 def merge_node_cluster(G,
                        nodes,
                        newNode,
@@ -77,19 +156,18 @@ def merge_node_cluster(G,
         centroid=iter_del_dups(gen_node_iterables(G, nodes, 'centroid')),
         maxLenId=maxLenId,
         members=members,
-        seqIDs=set(iter_del_dups(gen_node_iterables(G, nodes, 'seqIDs'))),
+        seqIDs=set(
+            itertools.chain.from_iterable(
+                gen_node_iterables(G, nodes, 'seqIDs'))),
         hasEnd=any(gen_node_iterables(G, nodes, 'hasEnd')),
         protein=iter_del_dups(gen_node_iterables(G, nodes, 'protein')),
         dna=dna,
-        annotation=";".join(
-            iter_del_dups(gen_node_iterables(G, nodes, 'annotation',
-                                             split=";"))),
-        description=";".join(
-            iter_del_dups(
-                gen_node_iterables(G, nodes, 'description', split=";"))),
-        lengths=list(
-            itertools.chain.from_iterable(
-                gen_node_iterables(G, nodes, 'lengths'))),
+        annotation=merge_values(gen_node_iterables(G, nodes, 'annotation'),
+                                joined=True),
+        description=merge_values(gen_node_iterables(G, nodes, 'description'),
+                                 joined=True),
+        lengths=merge_values(gen_node_iterables(G, nodes, 'lengths'),
+                             joined=False),
         longCentroidID=max(gen_node_iterables(G, nodes, 'longCentroidID')),
         paralog=any(gen_node_iterables(G, nodes, 'paralog')),
         mergedDNA=mergedDNA)
@@ -114,43 +192,89 @@ def merge_node_cluster(G,
                            size=G[node][neighbour]['size'],
                            members=G[node][neighbour]['members'])
 
+    # keep the membership index in sync if one is attached
+    index = get_membership(G)
+    if index is not None:
+        for node in nodes:
+            index.remove_node(node)
+        index.add_node(newNode, members)
+    neighbour_index = get_neighbours(G)
+    if neighbour_index is not None:
+        for node in nodes:
+            neighbour_index.remove_node(G, node)
+        for neighbour in G.neighbors(newNode):
+            neighbour_index.set_edge(newNode, neighbour,
+                                     G[newNode][neighbour]['members'])
+
     # remove old nodes from Graph
     G.remove_nodes_from(nodes)
 
     return G
 
 
+def member_neighbours(G, node):
+    """The neighbours of node sharing each of its members, in one pass."""
+    neighbours = {}
+    for neighbour, attrs in G.adj[node].items():
+        for mem in attrs['members']:
+            neighbours.setdefault(mem, []).append(neighbour)
+    return neighbours
+
+
+def _replacement_edges(G, mem_edges, member):
+    # join up the neighbours that were connected by member through a node
+    neighbour_index = get_neighbours(G)
+    for n1, n2 in itertools.combinations(sorted(mem_edges), 2):
+        if G.has_edge(n1, n2):
+            G[n1][n2]['members'].add(member)
+            G[n1][n2]['size'] = len(G[n1][n2]['members'])
+        else:
+            G.add_edge(n1, n2, size=1, members=intbitset([member]))
+        if neighbour_index is not None:
+            neighbour_index.add_edge_member(n1, n2, member)
+    return
+
+
 def delete_node(G, node):
+    neighbour_index = get_neighbours(G)
+
     # add in new edges
+    if neighbour_index is None:
+        neighbours = member_neighbours(G, node)
     for mem in G.nodes[node]['members']:
-        mem_edges = list(
-            set([e[1] for e in G.edges(node) if mem in G.edges[e]['members']]))
+        if neighbour_index is not None:
+            mem_edges = neighbour_index.neighbours_with_genome(G, node, mem)
+        else:
+            mem_edges = neighbours.get(mem, [])
         if len(mem_edges) < 2: continue
-        for n1, n2 in itertools.combinations(mem_edges, 2):
-            if G.has_edge(n1, n2):
-                G[n1][n2]['members'] |= intbitset([mem])
-                G[n1][n2]['size'] = len(G[n1][n2]['members'])
-            else:
-                G.add_edge(n1, n2, size=1, members=intbitset([mem]))
+        _replacement_edges(G, mem_edges, mem)
 
     # now remove node
+    index = get_membership(G)
+    if index is not None:
+        index.remove_node(node)
+    if neighbour_index is not None:
+        neighbour_index.remove_node(G, node)
     G.remove_node(node)
 
     return G
 
 
 def remove_member_from_node(G, node, member):
+    index = get_membership(G)
+    neighbour_index = get_neighbours(G)
 
     # add in replacement edges if required
-    mem_edges = list(
-        set([e[1] for e in G.edges(node) if member in G.edges[e]['members']]))
+    if neighbour_index is not None:
+        mem_edges = list(
+            neighbour_index.neighbours_with_genome(G, node, member))
+    else:
+        mem_edges = [
+            neighbour for neighbour, attrs in G.adj[node].items()
+            if member in attrs['members']
+        ]
     if len(mem_edges) > 1:
-        for n1, n2 in itertools.combinations(mem_edges, 2):
-            if G.has_edge(n1, n2):
-                G[n1][n2]['members'] |= intbitset([member])
-                G[n1][n2]['size'] = len(G[n1][n2]['members'])
-            else:
-                G.add_edge(n1, n2, size=1, members=intbitset([member]))
+        _replacement_edges(G, mem_edges, member)
 
     # remove member from node
     G.nodes[node]['members'].discard(member)
@@ -159,17 +283,18 @@ def remove_member_from_node(G, node, member):
         if sid.split("_")[0] != str(member)
     ])
     G.nodes[node]['size'] -= 1
+    if index is not None:
+        index.remove_member(node, member)
 
     # remove member from edges of node
-    edges_to_remove = []
-    for e in G.edges(node):
-        if member in G.edges[e]['members']:
-            if len(G.edges[e]['members']) == 1:
-                edges_to_remove.append(e)
-            else:
-                G.edges[e]['members'].discard(member)
-                G.edges[e]['size'] = len(G.edges[e]['members'])
-    for e in edges_to_remove:
-        G.remove_edge(*e)
+    for neighbour in mem_edges:
+        members = G[node][neighbour]['members']
+        if len(members) == 1:
+            G.remove_edge(node, neighbour)
+        else:
+            members.discard(member)
+            G[node][neighbour]['size'] = len(members)
+        if neighbour_index is not None:
+            neighbour_index.remove_member_edge(node, neighbour, member)
 
-    return G
\ No newline at end of file
+    return G
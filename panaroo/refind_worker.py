@@ -0,0 +1,69 @@
+import os, sys
+import time
+
+from joblib import Parallel, delayed
+
+from .find_missing import process_shards
+from .isvalid import *
+from .__init__ import __version__
+
+
+def get_options(args):
+    import argparse
+
+    description = 'Searches refind shards written by a panaroo run with '
+    description += '--refind_shards, to spread the refinding step over hosts.'
+    parser = argparse.ArgumentParser(description=description,
+                                     prog='panaroo-refind-worker')
+
+    parser.add_argument("--shards",
+                        dest="shard_dir",
+                        required=True,
+                        help="the directory given to --refind_shards",
+                        type=lambda x: is_valid_folder(parser, x))
+    parser.add_argument("-t",
+                        "--threads",
+                        dest="n_cpu",
+                        help="number of threads to use (default=1)",
+                        type=int,
+                        default=1)
+    parser.add_argument(
+        "--wait",
+        dest="wait",
+        help=("seconds to keep polling for new shards once none are " +
+              "left (default=0)"),
+        type=int,
+        default=0)
+    parser.add_argument('--version',
+                        action='version',
+                        version='%(prog)s ' + __version__)
+
+    args = parser.parse_args(args)
+    return (args)
+
+
+def main():
+    args = get_options(sys.argv[1:])
+
+    n_searched = 0
+    idle = 0
+    while True:
+        n = sum(
+            Parallel(n_jobs=args.n_cpu)(delayed(process_shards)(args.shard_dir)
+                                        for i in range(args.n_cpu)))
+        n_searched += n
+        if n > 0:
+            idle = 0
+        elif idle >= args.wait:
+            break
+        else:
+            time.sleep(1)
+            idle += 1
+
+    print("Searched " + str(n_searched) + " genomes")
+
+    return
+
+
+if __name__ == '__main__':
+    main()
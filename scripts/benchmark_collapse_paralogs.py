@@ -0,0 +1,144 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+import networkx as nx
+import numpy as np
+
+from panaroo.generate_network import generate_network
+from panaroo.clean_network import collapse_paralogs, _nearest_references
+
+
+def simulate_cohort(outdir, n_genomes, n_clusters, paralog_prop, max_copies,
+                    seed):
+    # writes cd-hit style clusters and gene data for a cohort where a
+    # proportion of the gene clusters are present in multiple copies
+    rng = random.Random(seed)
+    paralogs = set(rng.sample(range(n_clusters),
+                              int(paralog_prop * n_clusters)))
+    dna = {}
+    for c in range(n_clusters):
+        dna[c] = "ATG" + "".join(
+            rng.choice("ACGT") for i in range(rng.randint(30, 90)))
+
+    genes = []
+    for g in range(n_genomes):
+        order = [
+            c for c in range(n_clusters)
+            if (c not in paralogs) and (rng.random() < 0.9)
+        ]
+        for c in paralogs:
+            for i in range(rng.randint(1, max_copies)):
+                order.insert(rng.randint(0, len(order)), c)
+        for pos, c in enumerate(order):
+            genes.append(("_".join([str(g), "0", str(pos)]), c))
+
+    clusters = defaultdict(list)
+    for sid, c in genes:
+        clusters[c].append(sid)
+    with open(os.path.join(outdir, "combined_protein_cdhit_out.txt.clstr"),
+              'w') as outfile:
+        for c in sorted(clusters):
+            outfile.write(">Cluster " + str(c) + "\n")
+            for i, sid in enumerate(clusters[c]):
+                outfile.write(
+                    str(i) + "\t10aa, >" + sid + "... " +
+                    ("*" if i == 0 else "at 99.00%") + "\n")
+    with open(os.path.join(outdir, "gene_data.csv"), 'w') as outfile:
+        outfile.write(",".join([
+            "gff_file", "scaffold_name", "clustering_id", "annotation_id",
+            "prot_sequence", "dna_sequence", "gene_name", "description"
+        ]) + "\n")
+        for sid, c in genes:
+            outfile.write(",".join([
+                "genome", "contig", sid, "id_" + sid,
+                "M" + "A" * (len(dna[c]) // 3), dna[c], "gene" + str(c),
+                "hypothetical protein"
+            ]) + "\n")
+    with open(os.path.join(outdir, "combined_protein_CDS.fasta"),
+              'w') as outfile:
+        for sid, c in genes:
+            outfile.write(">" + sid + "\nMAAA\n")
+    return
+
+
+def pairwise_nearest(G, references, targets):
+    # one shortest path search per reference and target pair
+    nearest = {}
+    for t in targets:
+        d_max = np.inf
+        for c, ref in enumerate(references):
+            try:
+                d = nx.shortest_path_length(G, ref, t)
+            except nx.NetworkXNoPath:
+                continue
+            if d < d_max:
+                d_max = d
+                nearest[t] = (c, d)
+    return nearest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stress test the reference assignment in ' +
+        'collapse_paralogs on a simulated paralog heavy cohort.')
+    parser.add_argument('--genomes', dest='n_genomes', type=int, default=40)
+    parser.add_argument('--clusters', dest='n_clusters', type=int, default=200)
+    parser.add_argument('--paralogs',
+                        dest='paralog_prop',
+                        type=float,
+                        default=0.15,
+                        help='proportion of clusters with multiple copies')
+    parser.add_argument('--copies',
+                        dest='max_copies',
+                        type=int,
+                        default=4,
+                        help='maximum number of copies per genome')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        simulate_cohort(tmpdir, args.n_genomes, args.n_clusters,
+                        args.paralog_prop, args.max_copies, args.seed)
+        G, centroid_contexts, seqid_to_centroid = generate_network(
+            os.path.join(tmpdir, "combined_protein_cdhit_out.txt.clstr"),
+            os.path.join(tmpdir, "gene_data.csv"),
+            os.path.join(tmpdir, "combined_protein_CDS.fasta"))
+    print("nodes:", G.number_of_nodes(), "edges:", G.number_of_edges(),
+          "paralogous centroids:", len(centroid_contexts))
+
+    # compare the nearest reference search for each paralogous centroid
+    t_pairwise = 0
+    t_multi = 0
+    for centroid, paras in centroid_contexts.items():
+        member_paralogs = defaultdict(list)
+        for para in sorted(paras):
+            member_paralogs[para[1]].append(para)
+        refs = max(member_paralogs.items(), key=lambda x: len(x[1]))[1]
+        references = [ref[0] for ref in refs]
+        targets = [para[0] for para in paras if para[1] != refs[0][1]]
+
+        start = time.time()
+        expected = pairwise_nearest(G, references, targets)
+        t_pairwise += time.time() - start
+        start = time.time()
+        observed = _nearest_references(G, references, targets)
+        t_multi += time.time() - start
+        assert expected == observed
+
+    print("pairwise shortest paths: %.2fs" % t_pairwise)
+    print("multi-source search: %.2fs" % t_multi)
+
+    start = time.time()
+    G = collapse_paralogs(G, centroid_contexts, quiet=True)
+    print("collapse_paralogs: %.2fs" % (time.time() - start))
+    print("nodes after collapse:", G.number_of_nodes())
+
+    return
+
+
+if __name__ == '__main__':
+    main()
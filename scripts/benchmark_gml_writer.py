@@ -0,0 +1,85 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import networkx as nx
+from intbitset import intbitset
+
+from panaroo.gml_writer import write_gml, fast_stringizer
+from panaroo.isvalid import custom_stringizer
+
+
+def simulate(n_nodes, n_genomes, dna_length, seed):
+    # a path of genes carrying the attributes of a final panaroo graph
+    rng = random.Random(seed)
+    G = nx.Graph()
+    for n in range(n_nodes):
+        members = rng.sample(range(n_genomes), rng.randint(1, n_genomes))
+        dna = "".join(rng.choice("ACGT") for i in range(dna_length))
+        G.add_node(n,
+                   size=len(members),
+                   centroid=str(members[0]) + "_0_" + str(n),
+                   members=list(members),
+                   seqIDs=[str(m) + "_0_" + str(n) for m in members],
+                   dna=dna,
+                   protein="M" * (dna_length // 3),
+                   annotation="hypothetical protein",
+                   lengths=[dna_length] * len(members),
+                   paralog=0)
+    for n in range(n_nodes - 1):
+        members = list(
+            set(G.nodes[n]['members']) & set(G.nodes[n + 1]['members']))
+        G.add_edge(n, n + 1, size=len(members), members=members)
+    return G
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Compare the time taken to write a simulated graph with ' +
+        'networkx.write_gml and the chunked GML writer.')
+    parser.add_argument('--nodes',
+                        dest='n_nodes',
+                        type=int,
+                        default=20000,
+                        help='number of nodes in the graph')
+    parser.add_argument('--genomes',
+                        dest='n_genomes',
+                        type=int,
+                        default=100,
+                        help='number of genomes')
+    parser.add_argument('--dna_length',
+                        dest='dna_length',
+                        type=int,
+                        default=1000,
+                        help='length of the dna attribute of each node')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    G = simulate(args.n_nodes, args.n_genomes, args.dna_length, args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        expected = os.path.join(tmpdir, "expected.gml")
+        t_start = time.perf_counter()
+        nx.write_gml(G, expected, stringizer=custom_stringizer)
+        t_nx = time.perf_counter() - t_start
+        with open(expected, 'rb') as infile:
+            expected = infile.read()
+
+        print("writer\tseconds\tspeedup")
+        print("networkx\t" + "%.2f" % t_nx + "\t1.0")
+        observed = os.path.join(tmpdir, "observed.gml")
+        t_start = time.perf_counter()
+        write_gml(G, observed, stringizer=fast_stringizer)
+        t_write = time.perf_counter() - t_start
+        with open(observed, 'rb') as infile:
+            assert infile.read() == expected
+        print("chunked\t" + "%.2f" % t_write + "\t" +
+              "%.1f" % (t_nx / t_write))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
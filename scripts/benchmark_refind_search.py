@@ -0,0 +1,112 @@
+import argparse
+import random
+import time
+
+from Bio.Seq import reverse_complement
+
+from panaroo.find_missing import search_dna
+
+
+def mutate(seq, identity, rng):
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() > identity:
+            r = rng.random()
+            if r < 0.8:
+                seq[i] = rng.choice("ACGT")
+            elif r < 0.9:
+                seq[i] = ""
+            else:
+                seq[i] += rng.choice("ACGT")
+    return "".join(seq)
+
+
+def simulate_searches(n_searches, radius, seed):
+    # search windows around a neighbouring gene which contain the query at
+    # a range of identities, as a fragment at the window end, on either
+    # strand, or not at all
+    rng = random.Random(seed)
+    searches = []
+    for s in range(n_searches):
+        query = "".join(
+            rng.choice("ACGT") for i in range(rng.randint(100, 1500)))
+        window = "".join(
+            rng.choice("ACGT") for i in range(2 * radius + 1000))
+        kind = rng.choice(
+            ["absent", "exact", "similar", "diverged", "fragment"])
+        hit = query
+        if kind == "similar":
+            hit = mutate(query, rng.choice([0.99, 0.985]), rng)
+        elif kind == "diverged":
+            hit = mutate(query, 0.9, rng)
+        elif kind == "fragment":
+            # the start of the gene at the end of a contig
+            hit = query[:rng.randint(len(query) // 2 + 1, len(query))]
+        if kind == "fragment":
+            window = window[:-len(hit)] + hit
+        elif kind != "absent":
+            if rng.random() < 0.5:
+                hit = reverse_complement(hit)
+            pos = rng.randint(0, len(window) - len(hit))
+            window = window[:pos] + hit + window[pos + len(hit):]
+        searches.append((kind, window, query))
+    return searches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the recall and speed of seeded and exhaustive ' +
+        'searches used when re-finding genes.')
+    parser.add_argument('--searches',
+                        dest='n_searches',
+                        type=int,
+                        default=500,
+                        help='number of simulated searches')
+    parser.add_argument('--radius',
+                        dest='radius',
+                        type=int,
+                        default=5000,
+                        help='search radius around the neighbouring gene')
+    parser.add_argument('--prop_match',
+                        dest='prop_match',
+                        type=float,
+                        default=0.2)
+    parser.add_argument('--id',
+                        dest='pairwise_id_thresh',
+                        type=float,
+                        default=0.98)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    searches = simulate_searches(args.n_searches, args.radius, args.seed)
+
+    results = []
+    for seeded in [False, True]:
+        start = time.time()
+        results.append([
+            search_dna(window,
+                       query,
+                       args.prop_match,
+                       args.pairwise_id_thresh,
+                       refind=True,
+                       seeded=seeded) for kind, window, query in searches
+        ])
+        print(("seeded" if seeded else "exhaustive") +
+              " search: %.2fs" % (time.time() - start))
+
+    print("kind\tsearches\texhaustive_hits\tseeded_hits\tidentical")
+    for kind in ["absent", "exact", "similar", "diverged", "fragment"]:
+        index = [i for i, s in enumerate(searches) if s[0] == kind]
+        print("\t".join([
+            kind,
+            str(len(index)),
+            str(sum(results[0][i][0] != "" for i in index)),
+            str(sum(results[1][i][0] != "" for i in index)),
+            str(sum(results[0][i] == results[1][i] for i in index))
+        ]))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import random
+import timeit
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from panaroo.clean_network import single_linkage, centroid_adjacency
+from panaroo.isvalid import del_dups
+
+
+def single_linkage_scipy(G, distances_bwtn_centroids, centroid_to_index,
+                         neighbours):
+    # the previous implementation based on slicing the distance matrix
+    index = []
+    neigh_array = []
+    for neigh in neighbours:
+        for sid in G.nodes[neigh]['centroid']:
+            index.append(centroid_to_index[sid])
+            neigh_array.append(neigh)
+    index = np.array(index, dtype=int)
+    neigh_array = np.array(neigh_array)
+
+    n_components, labels = connected_components(
+        csgraph=distances_bwtn_centroids[index][:, index],
+        directed=False,
+        return_labels=True)
+    for neigh in neighbours:
+        l = list(set(labels[neigh_array == neigh]))
+        if len(l) > 1:
+            for i in l[1:]:
+                labels[labels == i] = l[0]
+
+    clusters = [
+        del_dups(list(neigh_array[labels == i])) for i in np.unique(labels)
+    ]
+
+    return (clusters)
+
+
+def simulate(n_centroids, n_links, multi_prop, seed):
+    rng = random.Random(seed)
+    G = nx.Graph()
+    centroid_to_index = {}
+    for i in range(n_centroids):
+        centroid_to_index[str(i)] = i
+    for n in range(n_centroids):
+        centroids = [str(n)]
+        if rng.random() < multi_prop:
+            centroids.append(str(rng.randrange(n_centroids)))
+        G.add_node(n, centroid=centroids)
+    rows = [rng.randrange(n_centroids) for i in range(n_links)]
+    cols = [rng.randrange(n_centroids) for i in range(n_links)]
+    distances = csr_matrix((np.ones(n_links), (rows, cols)),
+                           shape=(n_centroids, n_centroids))
+    return G, distances, centroid_to_index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Compare the union-find and scipy versions of single_linkage on ' +
+        'random neighbourhoods of different sizes.')
+    parser.add_argument('--centroids',
+                        dest='n_centroids',
+                        type=int,
+                        default=100000,
+                        help='number of centroids in the distance matrix')
+    parser.add_argument('--sizes',
+                        dest='sizes',
+                        type=int,
+                        nargs='+',
+                        default=[5, 20, 50, 200, 1000],
+                        help='neighbourhood sizes to benchmark')
+    parser.add_argument('--repeats',
+                        dest='repeats',
+                        type=int,
+                        default=200,
+                        help='neighbourhoods per size')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    G, distances, centroid_to_index = simulate(args.n_centroids,
+                                               2 * args.n_centroids, 0.1,
+                                               args.seed)
+    adjacency = centroid_adjacency(distances)
+
+    rng = random.Random(args.seed)
+    nodes = list(G.nodes())
+    print("size\tscipy_ms\tunion_find_ms\tspeedup")
+    for size in args.sizes:
+        neighbourhoods = [
+            rng.sample(nodes, size) for i in range(args.repeats)
+        ]
+        for neighbours in neighbourhoods:
+            assert [[int(n) for n in c] for c in single_linkage_scipy(
+                G, distances, centroid_to_index, neighbours)
+                    ] == single_linkage(G, adjacency, centroid_to_index,
+                                        neighbours)
+        t_scipy = timeit.timeit(lambda: [
+            single_linkage_scipy(G, distances, centroid_to_index, n)
+            for n in neighbourhoods
+        ],
+                                number=1) / args.repeats
+        t_uf = timeit.timeit(lambda: [
+            single_linkage(G, adjacency, centroid_to_index, n)
+            for n in neighbourhoods
+        ],
+                             number=1) / args.repeats
+        print("\t".join([
+            str(size),
+            "%.3f" % (1000 * t_scipy),
+            "%.3f" % (1000 * t_uf),
+            "%.1f" % (t_scipy / t_uf)
+        ]))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
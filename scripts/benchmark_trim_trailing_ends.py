@@ -0,0 +1,95 @@
+import argparse
+import copy
+import random
+import time
+
+import networkx as nx
+
+from panaroo.clean_network import trim_low_support_trailing_ends
+
+
+def trim_full_scan(G, min_support=3, max_recursive=2):
+    # the previous implementation which rescans every node in each round
+    for i in range(max_recursive):
+        bad_nodes = []
+        removed = False
+        for (node, val) in G.degree():
+            if val <= 1:  # trailing node
+                if G.nodes[node]['size'] < min_support:
+                    bad_nodes.append(node)
+        for node in bad_nodes:
+            G.remove_node(node)
+            removed = True
+
+        if not removed: break
+
+    return G
+
+
+def simulate_tails(n_core, n_tails, tail_length, seed):
+    # a well supported backbone with long low support tails hanging off it
+    rng = random.Random(seed)
+    G = nx.Graph()
+    nx.add_path(G, range(n_core))
+    for n in range(n_core):
+        G.nodes[n]['size'] = 100
+    node = n_core
+    for t in range(n_tails):
+        prev = rng.randrange(n_core)
+        for i in range(rng.randint(1, tail_length)):
+            G.add_node(node, size=rng.randint(1, 2))
+            G.add_edge(prev, node)
+            prev = node
+            node += 1
+    return G
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare full scan and queue based trimming of low ' +
+        'support trailing ends on simulated graphs with long tails.')
+    parser.add_argument('--core',
+                        dest='n_core',
+                        type=int,
+                        default=20000,
+                        help='number of backbone nodes')
+    parser.add_argument('--tails',
+                        dest='n_tails',
+                        type=int,
+                        default=2000,
+                        help='number of low support tails')
+    parser.add_argument('--length',
+                        dest='tail_length',
+                        type=int,
+                        default=200,
+                        help='maximum tail length')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+
+    G = simulate_tails(args.n_core, args.n_tails, args.tail_length,
+                       args.seed)
+    print("nodes:", G.number_of_nodes(), "edges:", G.number_of_edges())
+
+    # as used in strict and moderate modes
+    max_recursive = 99999999
+
+    H = copy.deepcopy(G)
+    start = time.time()
+    H = trim_full_scan(H, min_support=3, max_recursive=max_recursive)
+    print("full scan: %.2fs" % (time.time() - start))
+
+    start = time.time()
+    G = trim_low_support_trailing_ends(G,
+                                       min_support=3,
+                                       max_recursive=max_recursive)
+    print("queue: %.2fs" % (time.time() - start))
+
+    assert list(G.nodes()) == list(H.nodes())
+    assert list(G.edges()) == list(H.edges())
+    print("nodes after trimming:", G.number_of_nodes())
+
+    return
+
+
+if __name__ == '__main__':
+    main()
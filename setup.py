@@ -37,7 +37,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/gtonkinhill/panaroo",
     install_requires=[
-        'networkx', 'gffutils', 'BioPython', 'joblib', 'tqdm', 'edlib',
+        'networkx', 'gffutils', 'BioPython', 'joblib>=1.3', 'tqdm', 'edlib',
         'scipy', 'numpy', 'matplotlib', 'scikit-learn', 'plotly', 'dendropy',
         'intbitset', 'biocode'
     ],
@@ -67,7 +67,8 @@ setup(
             'panaroo-integrate = panaroo.integrate:main',
             'panaroo-filter-pa = panaroo.filter_pa:main',
             'panaroo-generate-gffs = panaroo.post_run_gff_output:main',
-            'panaroo-extract-gene = panaroo.extract_gene_fasta:main'
+            'panaroo-extract-gene = panaroo.extract_gene_fasta:main',
+            'panaroo-refind-worker = panaroo.refind_worker:main'
         ],
     },
 )
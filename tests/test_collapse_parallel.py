@@ -0,0 +1,185 @@
+# test that collapsing families region by region in parallel finds the same
+# merges as the serial search
+from panaroo.clean_network import collapse_families, _copy_graph_ordered
+from panaroo.clean_network import _partition_regions, _collapse_region
+from collections import defaultdict
+from intbitset import intbitset
+from scipy.sparse import csr_matrix
+import networkx as nx
+import numpy as np
+import copy
+
+
+def build_graph(n_components=4, length=12, n_genomes=6, joined=False):
+    # each component is a path of core genes with a bubble of two
+    # mutually exclusive variants that should be collapsed. With joined=True
+    # the paths are linked end to end into a single component
+    G = nx.Graph()
+    seqid_to_centroid = {}
+    centroid_to_index = {}
+    node = 0
+    for c in range(n_components):
+        path = []
+        for i in range(length):
+            if i == length // 2:
+                var_a, var_b = node, node + 1
+                node += 2
+                path.append((var_a, var_b))
+            else:
+                path.append((node, ))
+                node += 1
+        for pos, nodes in enumerate(path):
+            for n in nodes:
+                if len(nodes) == 2:
+                    genomes = [g for g in range(n_genomes)
+                               if g % 2 == nodes.index(n)]
+                else:
+                    genomes = list(range(n_genomes))
+                seqs = [
+                    str(g) + "_" + str(c) + "_" + str(pos) + "_" + str(n)
+                    for g in genomes
+                ]
+                centroid_to_index[seqs[0]] = len(centroid_to_index)
+                for sid in seqs:
+                    seqid_to_centroid[sid] = seqs[0]
+                G.add_node(n,
+                           size=len(genomes),
+                           centroid=[seqs[0]],
+                           maxLenId=0,
+                           members=intbitset(genomes),
+                           seqIDs=set(seqs),
+                           hasEnd=False,
+                           protein=['M'],
+                           dna=['ATG'],
+                           annotation='',
+                           description='',
+                           lengths=[3] * len(genomes),
+                           longCentroidID=(3, seqs[0]),
+                           paralog=False,
+                           mergedDNA=False)
+        if joined and (c > 0):
+            path = [(start - 1, )] + path
+        start = node
+        for a, b in zip(path[:-1], path[1:]):
+            for u in a:
+                for v in b:
+                    shared = G.nodes[u]['members'] & G.nodes[v]['members']
+                    G.add_edge(u, v, size=len(shared), members=shared)
+
+    # the two variants in each bubble are similar
+    n = len(centroid_to_index)
+    dist = np.eye(n)
+    for node in G.nodes():
+        if G.degree[node] > 2:
+            continue
+        for nbr in G.neighbors(node):
+            for other in G.neighbors(nbr):
+                if (other != node) and (G.degree[other] <= 2) and (
+                        G.nodes[other]['size'] < n_genomes) and (
+                            G.nodes[node]['size'] < n_genomes):
+                    i = centroid_to_index[G.nodes[node]['centroid'][0]]
+                    j = centroid_to_index[G.nodes[other]['centroid'][0]]
+                    dist[i, j] = dist[j, i] = 1
+    return G, seqid_to_centroid, csr_matrix(dist), centroid_to_index
+
+
+def canonical(G):
+    # the graph with each node named by its sequences, as merged node ids
+    # are not comparable between runs
+    names = {n: tuple(sorted(G.nodes[n]['seqIDs'])) for n in G.nodes()}
+    nodes = sorted((names[n], sorted(G.nodes[n]['members']),
+                    sorted(G.nodes[n]['centroid'])) for n in G.nodes())
+    edges = sorted(
+        (tuple(sorted([names[u], names[v]])), sorted(G[u][v]['members']))
+        for u, v in G.edges())
+    return nodes, edges
+
+
+def test_partition_regions():
+    G = build_graph(joined=True)[0]
+    assert nx.is_connected(G)
+    regions, borders = _partition_regions(G, 3)
+    assert len(regions) == 3
+    assert sorted(n for r in regions for n in r) == sorted(G.nodes())
+    for region, border in zip(regions, borders):
+        region = set(region)
+        assert border == set(
+            n for n in region if any(m not in region for m in G.adj[n]))
+
+    return
+
+
+def test_collapse_parallel():
+
+    for joined in [False, True]:
+        G, seqid_to_centroid, dist, centroid_to_index = build_graph(
+            joined=joined)
+
+        H = _copy_graph_ordered(G, G.nodes())
+        for n in G.nodes():
+            assert list(H.adj[n]) == list(G.adj[n])
+
+        # the serial search collapses the variants of each bubble, leaving a
+        # node for each position of each component
+        expected = defaultdict(list)
+        for n in G.nodes():
+            for sid in G.nodes[n]['seqIDs']:
+                expected[tuple(sid.split("_")[1:3])].append(sid)
+        expected = sorted(sorted(sids) for sids in expected.values())
+        R = collapse_families(copy.deepcopy(G),
+                              seqid_to_centroid,
+                              outdir="",
+                              n_cpu=2,
+                              quiet=True,
+                              distances_bwtn_centroids=dist,
+                              centroid_to_index=centroid_to_index)[0]
+        assert sorted(sorted(R.nodes[n]['seqIDs'])
+                      for n in R.nodes()) == expected
+
+        # the parallel search finds the same merges whether or not the graph
+        # is a single component, and always gives the same graph
+        for n_cpu in [2, 3]:
+            runs = []
+            for i in range(2):
+                runs.append(
+                    collapse_families(copy.deepcopy(G),
+                                      seqid_to_centroid,
+                                      outdir="",
+                                      n_cpu=n_cpu,
+                                      quiet=True,
+                                      distances_bwtn_centroids=dist,
+                                      centroid_to_index=centroid_to_index,
+                                      parallel=True)[0])
+            assert canonical(runs[0]) == canonical(R)
+            assert list(runs[0].nodes()) == list(runs[1].nodes())
+            assert list(runs[0].edges()) == list(runs[1].edges())
+
+    return
+
+
+def test_collapse_region():
+    # a region only merges nodes away from its border and leaves the rest
+    # for the serial search
+    G, seqid_to_centroid, dist, centroid_to_index = build_graph(joined=True)
+    regions, borders = _partition_regions(G, 2)
+    node_mem_index = {}
+    for n in G.nodes():
+        node_mem_index[n] = defaultdict(set)
+        for sid in G.nodes[n]['seqIDs']:
+            node_mem_index[n][int(sid.split("_")[0])].add(
+                centroid_to_index[seqid_to_centroid[sid]])
+    node_count = max(G.nodes()) + 10
+    for region, border in zip(regions, borders):
+        H, new_mem_index, stats, deferred = _collapse_region(
+            _copy_graph_ordered(G, region), border, node_count, 1, dist,
+            centroid_to_index, {n: node_mem_index[n] for n in region}, False,
+            0.01, None)
+        assert len(new_mem_index) > 0
+        assert set(new_mem_index) == set(n for n in H if n > node_count)
+        assert border <= set(H.nodes())
+        for n in border:
+            assert list(H.adj[n]) == [m for m in G.adj[n] if m in H]
+        assert deferred <= set(H.nodes())
+        assert len(deferred) < len([n for n in region if G.degree[n] > 2])
+
+    return
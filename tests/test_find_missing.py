@@ -0,0 +1,436 @@
+# test re-finding genes that are present but not annotated in simulated
+# genomes
+from panaroo.find_missing import find_missing, process_shards, sharded_search
+from panaroo.find_missing import SequenceStore, store_merged_genes
+from intbitset import intbitset
+from Bio.Seq import translate
+import networkx as nx
+import random
+import os
+import pickle
+import panaroo.find_missing
+import pytest
+import time
+
+
+def simulate_genomes(outdir, n_genomes=5, n_genes=20, gene_len=600,
+                     spacing=1500, seed=0):
+    # genes are annotated, present without an annotation or absent
+    rng = random.Random(seed)
+    genes = [
+        "ATG" + "".join(rng.choice("ACGT") for i in range(gene_len - 3))
+        for j in range(n_genes)
+    ]
+    G = nx.Graph()
+    gff_files = []
+    hidden = set()
+    data = []
+    for g in range(n_genomes):
+        contig = list("".join(
+            rng.choice("ACGT") for i in range(spacing * n_genes + 1000)))
+        annotated = []
+        for i in range(n_genes):
+            pos = 500 + i * spacing
+            r = rng.random()
+            if r < 0.9:
+                contig[pos:pos + gene_len] = list(genes[i])
+            if r < 0.75:
+                annotated.append((i, pos))
+            elif r < 0.9:
+                hidden.add((g, i))
+        contig = "".join(contig)
+
+        gff_file = os.path.join(outdir, "genome" + str(g) + ".gff")
+        with open(gff_file, 'w') as outfile:
+            outfile.write("##gff-version 3\n")
+            for i, pos in annotated:
+                outfile.write("\t".join([
+                    "contig" + str(g), "prokka", "CDS",
+                    str(pos + 1),
+                    str(pos + gene_len), ".", "+", "0",
+                    "ID=g" + str(g) + "_" + str(i)
+                ]) + "\n")
+            outfile.write("##FASTA\n>contig" + str(g) + "\n" + contig + "\n")
+        gff_files.append(gff_file)
+
+        prev = None
+        for n, (i, pos) in enumerate(annotated):
+            sid = str(g) + "_0_" + str(n)
+            data.append(",".join([
+                "genome" + str(g), "contig" + str(g), sid,
+                "g" + str(g) + "_" + str(i),
+                translate(genes[i]), genes[i], "", ""
+            ]))
+            if i not in G:
+                G.add_node(i,
+                           size=0,
+                           centroid=[sid],
+                           maxLenId=0,
+                           members=intbitset(),
+                           seqIDs=set(),
+                           hasEnd=False,
+                           protein=[translate(genes[i])],
+                           dna=[genes[i]],
+                           annotation="",
+                           description="",
+                           lengths=[],
+                           longCentroidID=(gene_len, sid),
+                           paralog=False,
+                           mergedDNA=False)
+            G.nodes[i]['members'].add(g)
+            G.nodes[i]['size'] += 1
+            G.nodes[i]['seqIDs'].add(sid)
+            G.nodes[i]['lengths'].append(gene_len)
+            if prev is not None:
+                if G.has_edge(prev, i):
+                    G[prev][i]['members'].add(g)
+                    G[prev][i]['size'] += 1
+                else:
+                    G.add_edge(prev, i, size=1, members=intbitset([g]))
+            prev = i
+
+    with open(os.path.join(outdir, "gene_data.csv"), 'w') as outfile:
+        outfile.write(",".join([
+            "gff_file", "scaffold_name", "clustering_id", "annotation_id",
+            "prot_sequence", "dna_sequence", "gene_name", "description"
+        ]) + "\n")
+        outfile.write("\n".join(data) + "\n")
+    for f in ["combined_DNA_CDS.fasta", "combined_protein_CDS.fasta"]:
+        open(os.path.join(outdir, f), 'w').close()
+
+    return G, gff_files, hidden
+
+
+def test_find_missing(tmp_path):
+    outdir = str(tmp_path) + "/"
+    G, gff_files, hidden = simulate_genomes(outdir)
+
+    G = find_missing(G,
+                     gff_files,
+                     dna_seq_file=outdir + "combined_DNA_CDS.fasta",
+                     prot_seq_file=outdir + "combined_protein_CDS.fasta",
+                     gene_data_file=outdir + "gene_data.csv",
+                     merge_id_thresh=0.8,
+                     search_radius=5000,
+                     prop_match=0.2,
+                     pairwise_id_thresh=0.95,
+                     n_cpu=1,
+                     verbose=False)
+
+    # genes next to an annotated neighbour are refound and written out in
+    # genome order
+    refound = []
+    with open(outdir + "gene_data.csv") as infile:
+        for line in infile:
+            if "_refound_" in line:
+                refound.append(line.split(","))
+    assert len(refound) > 0
+    assert [int(r[2].split("_")[0]) for r in refound] == sorted(
+        int(r[2].split("_")[0]) for r in refound)
+    for r in refound:
+        member = int(r[2].split("_")[0])
+        node = [n for n in G.nodes() if r[2] in G.nodes[n]['seqIDs']][0]
+        assert (member, node) in hidden
+        assert member in G.nodes[node]['members']
+        assert r[4] == G.nodes[node]['protein'][0] + "X"
+
+    with open(outdir + "combined_DNA_CDS.fasta") as infile:
+        assert infile.read().count(">") == len(refound)
+
+    # the cost of searching each genome is reported
+    with open(outdir + "refind_stats.tsv") as infile:
+        header = next(infile).strip().split("\t")
+        stats = [dict(zip(header, line.strip().split("\t")))
+                 for line in infile]
+    assert [s['genome'] for s in stats] == [
+        "genome" + str(g) for g in range(len(gff_files))
+    ]
+    assert sum(int(s['searches']) for s in stats) > 0
+    assert all(int(s['edlib_calls']) > 0 for s in stats
+               if int(s['searches']) > 0)
+    assert sum(int(s['hits']) for s in stats) >= len(refound)
+
+    return
+
+
+def test_find_missing_shards(tmp_path):
+    outputs = []
+    graphs = []
+    for shard_dir in [None, str(tmp_path / "shards")]:
+        outdir = str(tmp_path / ("sharded" if shard_dir else "local")) + "/"
+        os.makedirs(outdir)
+        G, gff_files, hidden = simulate_genomes(outdir)
+        G = find_missing(G,
+                         gff_files,
+                         dna_seq_file=outdir + "combined_DNA_CDS.fasta",
+                         prot_seq_file=outdir + "combined_protein_CDS.fasta",
+                         gene_data_file=outdir + "gene_data.csv",
+                         merge_id_thresh=0.8,
+                         search_radius=5000,
+                         prop_match=0.2,
+                         pairwise_id_thresh=0.95,
+                         n_cpu=1,
+                         shard_dir=shard_dir,
+                         verbose=False)
+        with open(outdir + "gene_data.csv") as infile:
+            outputs.append(infile.read().replace(outdir, ""))
+        graphs.append(
+            sorted((n, sorted(G.nodes[n]['members'])) for n in G.nodes()))
+
+    assert outputs[0] == outputs[1]
+    assert graphs[0] == graphs[1]
+    # shard files are removed once their results are merged back
+    assert os.listdir(str(tmp_path / "shards")) == []
+
+    return
+
+
+def test_shard_locks(tmp_path, monkeypatch):
+    shard_dir = str(tmp_path)
+    G, gff_files, hidden = simulate_genomes(shard_dir, n_genomes=2)
+    for member, gff in enumerate(gff_files):
+        with open(os.path.join(shard_dir, "genome_" + str(member) + ".plan"),
+                  'wb') as outfile:
+            pickle.dump(
+                dict(node_search_dict={},
+                     conflicts=set(),
+                     gff_handle_name=gff,
+                     merged_nodes={},
+                     node_proteins={}), outfile)
+
+    # a shard claimed by another worker is left alone
+    open(os.path.join(shard_dir, "genome_0.lock"), 'w').close()
+    assert process_shards(shard_dir) == 1
+    assert not os.path.exists(os.path.join(shard_dir, "genome_0.result"))
+    assert os.path.exists(os.path.join(shard_dir, "genome_1.result"))
+    assert process_shards(shard_dir) == 0
+
+    # removing a stale lock lets the shard be picked up again
+    os.remove(os.path.join(shard_dir, "genome_0.lock"))
+    assert process_shards(shard_dir) == 1
+
+    # a shard cleaned up after being listed releases its lock and the
+    # worker moves on to the next one
+    for f in ["genome_0.plan", "genome_0.lock", "genome_0.result"]:
+        os.remove(os.path.join(shard_dir, f))
+    for f in ["genome_1.lock", "genome_1.result"]:
+        os.remove(os.path.join(shard_dir, f))
+    monkeypatch.setattr(panaroo.find_missing, "_shard_files",
+                        lambda shard_dir, ext: [0, 1])
+    assert process_shards(shard_dir) == 1
+    assert not os.path.exists(os.path.join(shard_dir, "genome_0.lock"))
+    assert os.path.exists(os.path.join(shard_dir, "genome_1.result"))
+
+    return
+
+
+def test_sharded_search_locks(tmp_path, monkeypatch, capsys):
+    shard_dir = str(tmp_path / "shards")
+    G, gff_files, hidden = simulate_genomes(str(tmp_path), n_genomes=2)
+    plans = [
+        dict(node_search_dict={},
+             conflicts=set(),
+             gff_handle_name=gff,
+             merged_nodes={},
+             node_proteins={}) for gff in gff_files
+    ]
+    lock_file = os.path.join(shard_dir, "genome_0.lock")
+    old = time.time() - 60
+
+    # leftover shards from another run are refused
+    os.makedirs(shard_dir)
+    open(lock_file, 'w').close()
+    with pytest.raises(RuntimeError):
+        next(sharded_search(shard_dir, plans, poll_interval=0))
+    os.remove(lock_file)
+
+    # genome 0 is claimed by a worker that dies before writing its result
+    def dead_worker(n_jobs):
+        def run(jobs):
+            with open(lock_file, 'w') as outfile:
+                outfile.write("deadhost:1")
+            os.utime(lock_file, (old, old))
+
+        return run
+
+    monkeypatch.setattr(panaroo.find_missing, "Parallel", dead_worker)
+    for verbose in [True, False]:
+        results = list(
+            sharded_search(shard_dir,
+                           plans,
+                           poll_interval=0,
+                           lock_timeout=30,
+                           verbose=verbose))
+        assert len(results) == 2
+        assert os.listdir(shard_dir) == []
+        out = capsys.readouterr().out
+        if verbose:
+            assert "Waiting for refind shard" in out
+            assert "deadhost:1" in out
+            assert "Reclaiming" in out
+        else:
+            assert out == ""
+
+    return
+
+
+def test_shard_heartbeat(tmp_path, monkeypatch):
+    shard_dir = str(tmp_path)
+    G, gff_files, hidden = simulate_genomes(shard_dir, n_genomes=1)
+    plan_file = os.path.join(shard_dir, "genome_0.plan")
+    lock_file = os.path.join(shard_dir, "genome_0.lock")
+    result_file = os.path.join(shard_dir, "genome_0.result")
+    old = time.time() - 60
+    search_gff = panaroo.find_missing.search_gff
+
+    def write_plan():
+        with open(plan_file, 'wb') as outfile:
+            pickle.dump(
+                dict(node_search_dict={},
+                     conflicts=set(),
+                     gff_handle_name=gff_files[0],
+                     merged_nodes={},
+                     node_proteins={}), outfile)
+
+    # a long search keeps its lock fresh
+    def slow_search(**plan):
+        os.utime(lock_file, (old, old))
+        time.sleep(0.5)
+        return search_gff(**plan)
+
+    write_plan()
+    monkeypatch.setattr(panaroo.find_missing, "search_gff", slow_search)
+    assert process_shards(shard_dir, heartbeat=0.05) == 1
+    assert os.path.getmtime(lock_file) > old + 30
+    assert os.path.exists(result_file)
+
+    # the result is dropped if the shard is reclaimed or merged back
+    # while it is searched
+    def reclaimed(**plan):
+        with open(lock_file, 'w') as outfile:
+            outfile.write("otherhost:1")
+        return search_gff(**plan)
+
+    def merged_back(**plan):
+        for f in [plan_file, lock_file]:
+            os.remove(f)
+        return search_gff(**plan)
+
+    for search in [reclaimed, merged_back]:
+        for f in os.listdir(shard_dir):
+            if f.startswith("genome_0."):
+                os.remove(os.path.join(shard_dir, f))
+        write_plan()
+        monkeypatch.setattr(panaroo.find_missing, "search_gff", search)
+        assert process_shards(shard_dir) == 0
+        assert not os.path.exists(result_file)
+
+    return
+
+
+def test_find_missing_merged(tmp_path):
+    # merged nodes locate their genes by aligning sequences from the store,
+    # which finds the annotated genes again
+    outputs = []
+    for merged in [False, True]:
+        outdir = str(tmp_path / str(merged)) + "/"
+        os.makedirs(outdir)
+        G, gff_files, hidden = simulate_genomes(outdir)
+        for node in G.nodes():
+            G.nodes[node]['mergedDNA'] = merged
+        G = find_missing(G,
+                         gff_files,
+                         dna_seq_file=outdir + "combined_DNA_CDS.fasta",
+                         prot_seq_file=outdir + "combined_protein_CDS.fasta",
+                         gene_data_file=outdir + "gene_data.csv",
+                         merge_id_thresh=0.8,
+                         search_radius=5000,
+                         prop_match=0.2,
+                         pairwise_id_thresh=0.95,
+                         n_cpu=1,
+                         verbose=False)
+        with open(outdir + "gene_data.csv") as infile:
+            outputs.append(infile.read().replace(outdir, ""))
+        # the sequence store is removed
+        assert not any(f.endswith(".seqs") for f in os.listdir(outdir))
+
+    assert outputs[0] == outputs[1]
+
+    return
+
+
+def test_sequence_store_removed_on_error(tmp_path, monkeypatch):
+    outdir = str(tmp_path) + "/"
+    G, gff_files, hidden = simulate_genomes(outdir)
+    for node in G.nodes():
+        G.nodes[node]['mergedDNA'] = True
+
+    def failed_search(**plan):
+        assert os.path.getsize(plan['seq_store']) > 0
+        raise RuntimeError("search failed")
+
+    monkeypatch.setattr(panaroo.find_missing, "search_gff", failed_search)
+    with pytest.raises(RuntimeError):
+        find_missing(G,
+                     gff_files,
+                     dna_seq_file=outdir + "combined_DNA_CDS.fasta",
+                     prot_seq_file=outdir + "combined_protein_CDS.fasta",
+                     gene_data_file=outdir + "gene_data.csv",
+                     merge_id_thresh=0.8,
+                     search_radius=5000,
+                     prop_match=0.2,
+                     pairwise_id_thresh=0.95,
+                     n_cpu=1,
+                     verbose=False)
+    assert not any(f.endswith(".seqs") for f in os.listdir(outdir))
+
+    return
+
+
+def test_sequence_store(tmp_path):
+    path = str(tmp_path / "store.seqs")
+    open(path, 'w').close()
+    store = SequenceStore(path)
+    seqs = ["ATG" * i for i in range(20)] + ["ACGTN"]
+    handles = [store.add(seq) for seq in seqs]
+    store.close()
+
+    # handles are resolved in another store reading the same file
+    store = SequenceStore(path)
+    assert [store[h] for h in reversed(handles)] == list(reversed(seqs))
+    store.close()
+
+    return
+
+
+def test_store_merged_genes(tmp_path):
+    outdir = str(tmp_path) + "/"
+    G, gff_files, hidden = simulate_genomes(outdir)
+    for node in G.nodes():
+        G.nodes[node]['mergedDNA'] = (node % 2 == 0)
+    # genome 0 has a second, different gene in node 0
+    node = min(n for n in G.nodes() if 0 in G.nodes[n]['members'] and
+               n % 2 == 0)
+    G.nodes[node]['seqIDs'].add("0_0_99")
+    with open(outdir + "gene_data.csv", 'a') as outfile:
+        outfile.write(",".join([
+            "genome0", "contig0", "0_0_99", "g0_99", "MK", "ATGAAA", "", ""
+        ]) + "\n")
+
+    open(str(tmp_path / "store.seqs"), 'w').close()
+    store = SequenceStore(str(tmp_path / "store.seqs"))
+    merged_nodes = store_merged_genes(G, outdir + "gene_data.csv", store)
+    store.close()
+
+    # each genome's genes are filed under that genome
+    assert set(merged_nodes) == set(range(5))
+    for member in merged_nodes:
+        assert set(merged_nodes[member]) == set(
+            n for n in G.nodes()
+            if (n % 2 == 0) and (member in G.nodes[n]['members']))
+        for n, handle in merged_nodes[member].items():
+            # a genome with more than one gene in a node uses the centroid
+            assert store[handle] == G.nodes[n]['dna'][0]
+    store.close()
+
+    return
@@ -0,0 +1,147 @@
+# test that the chunked GML writer matches the networkx writer byte for byte
+from panaroo.gml_writer import write_gml, fast_stringizer, SnapshotWriter
+from panaroo.isvalid import custom_stringizer
+from panaroo.merge_nodes import merge_values
+import panaroo.gml_writer
+import pytest
+import threading
+from intbitset import intbitset
+import networkx as nx
+import os
+import tempfile
+
+
+def build_graph():
+    G = nx.Graph()
+    G.graph['isolateNames'] = ['isoA', 'isoB', 'iso"C&']
+    for i in range(50):
+        G.add_node(i,
+                   size=2,
+                   centroid=['0_0_' + str(i)] if i % 2 else ['0_0_1', '1_0_1'],
+                   members=intbitset([0, i % 3]),
+                   seqIDs=set(['0_0_' + str(i), '1_0_' + str(i)]),
+                   lengths=[300, 2**33],
+                   longCentroidID=(300, '0_0_' + str(i)),
+                   annotation='hypothetical protein' if i % 5 else 'é;€',
+                   paralog=(i % 4 == 0),
+                   score=1e20)
+    for i in range(49):
+        G.add_edge(i, i + 1, size=2, members=intbitset([0, 1]))
+    return G
+
+
+def test_gml_writer():
+
+    G = build_graph()
+    for value in [None, (1, ), ['a', set([1])], {'a': (1, 2.5)}, 'é€']:
+        assert fast_stringizer(value) == custom_stringizer(value)
+
+    with tempfile.TemporaryDirectory() as tmpoutdir:
+        expected = os.path.join(tmpoutdir, "expected.gml")
+        observed = os.path.join(tmpoutdir, "observed.gml")
+
+        nx.write_gml(G, expected, stringizer=custom_stringizer)
+        write_gml(G, observed, stringizer=fast_stringizer, chunk_size=7)
+        with open(expected, 'rb') as a, open(observed, 'rb') as b:
+            assert a.read() == b.read()
+
+    return
+
+
+def write_baseline_snapshot(G, path):
+    # how pre_filt_graph.gml was written before snapshots, modifying G
+    for node in G.nodes():
+        G.nodes[node]['size'] = len(G.nodes[node]['members'])
+        G.nodes[node]['genomeIDs'] = ";".join(
+            [str(m) for m in G.nodes[node]['members']])
+        G.nodes[node]['geneIDs'] = ";".join(G.nodes[node]['seqIDs'])
+        G.nodes[node]['degrees'] = G.degree[node]
+    for edge in G.edges():
+        G.edges[edge[0], edge[1]]['genomeIDs'] = ";".join(
+            [str(m) for m in G.edges[edge[0], edge[1]]['members']])
+    nx.write_gml(G, path, stringizer=custom_stringizer)
+    return
+
+
+def test_snapshots(tmp_path, monkeypatch):
+    # a merged attribute is written as its materialised value
+    G = build_graph()
+    G.nodes[3]['lengths'] = merge_values([[300], [2**33]], False)
+    G.nodes[3]['size'] = 0
+
+    # sync writes straight from the graph without copying or modifying it
+    def no_copy(G):
+        raise AssertionError("sync snapshots should not copy the graph")
+
+    with monkeypatch.context() as m:
+        m.setattr(panaroo.gml_writer, "snapshot_graph", no_copy)
+        snapshots = SnapshotWriter(quiet=True)
+        assert snapshots.mode == 'sync'
+        snapshots.write(G, str(tmp_path / "sync.gml"))
+    assert 'genomeIDs' not in G.nodes[0]
+    assert 'genomeIDs' not in G.edges[0, 1]
+    assert G.nodes[3]['size'] == 0
+
+    # async writes a frozen copy, so later changes to G are not written
+    changed = threading.Event()
+    write_snapshot = panaroo.gml_writer.write_snapshot
+
+    def write_later(H, path):
+        changed.wait()
+        write_snapshot(H, path)
+
+    monkeypatch.setattr(panaroo.gml_writer, "write_snapshot", write_later)
+    snapshots_async = SnapshotWriter(mode='async', quiet=True)
+    snapshots_async.write(G, str(tmp_path / "async.gml"))
+    G.nodes[0]['members'].add(2)
+    G.nodes[0]['lengths'].append(3)
+    G.add_edge(0, 10, size=1, members=intbitset([1]))
+    changed.set()
+    stats = snapshots_async.close()
+    assert [s[0] for s in stats] == ["async.gml"]
+    assert stats[0][2] == os.path.getsize(str(tmp_path / "async.gml"))
+
+    # both match the attributes pre_filt_graph.gml has always had
+    G = build_graph()
+    G.nodes[3]['lengths'] = [300, 2**33]
+    G.nodes[3]['size'] = 0
+    write_baseline_snapshot(G, str(tmp_path / "expected.gml"))
+    with open(str(tmp_path / "expected.gml"), 'rb') as infile:
+        expected = infile.read()
+    for name in ["sync.gml", "async.gml"]:
+        with open(str(tmp_path / name), 'rb') as infile:
+            assert infile.read() == expected
+    H = nx.read_gml(str(tmp_path / "sync.gml"))
+    for key in ['genomeIDs', 'geneIDs', 'degrees', 'size']:
+        assert key in H.nodes['0']
+    assert H.nodes['3']['size'] == len(G.nodes[3]['members'])
+    assert 'genomeIDs' in H.edges['0', '1']
+
+    # off writes nothing
+    snapshots = SnapshotWriter(mode='off', quiet=True)
+    snapshots.write(G, str(tmp_path / "off.gml"))
+    assert snapshots.close() == []
+    assert not os.path.exists(str(tmp_path / "off.gml"))
+
+    with pytest.raises(ValueError):
+        SnapshotWriter(mode='later')
+
+    return
+
+
+def test_snapshot_errors(tmp_path):
+    G = build_graph()
+    missing = str(tmp_path / "missing" / "snapshot.gml")
+
+    # a failed sync write is raised straight away
+    snapshots = SnapshotWriter(mode='sync', quiet=True)
+    with pytest.raises(FileNotFoundError):
+        snapshots.write(G, missing)
+
+    # a failed background write is raised when the writer is closed
+    snapshots = SnapshotWriter(mode='async', quiet=True)
+    snapshots.write(G, missing)
+    with pytest.raises(FileNotFoundError):
+        snapshots.close()
+
+    return
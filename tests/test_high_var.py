@@ -0,0 +1,29 @@
+# test the detection of highly variable regions from nested cycles
+from panaroo.clean_network import identify_possible_highly_variable
+import networkx as nx
+
+
+def test_high_var():
+
+    # two separate tangles joined by a path, each with a low support node
+    G = nx.Graph()
+    for start in [0, 100]:
+        nodes = list(range(start, start + 6))
+        for i, u in enumerate(nodes):
+            for v in nodes[i + 1:i + 3]:
+                G.add_edge(u, v)
+    G.add_edge(5, 50)
+    G.add_edge(50, 100)
+    for n in G.nodes():
+        G.nodes[n]['size'] = 1 if n in [2, 103] else 10
+
+    G = identify_possible_highly_variable(G,
+                                          cycle_threshold_min=3)
+    flagged = set(n for n in G.nodes() if G.nodes[n]['highVar'])
+    assert flagged == set([2, 103])
+
+    G = identify_possible_highly_variable(G,
+                                          cycle_threshold_min=5)
+    assert sum(G.nodes[n]['highVar'] for n in G.nodes()) == 0
+
+    return
@@ -0,0 +1,25 @@
+# test the interval coverage used to resolve overlapping refound genes
+# against a boolean coverage array
+from panaroo.find_missing import IntervalCoverage
+import numpy as np
+import random
+
+
+def test_interval_coverage():
+    rng = random.Random(0)
+    for i in range(50):
+        length = rng.randint(10, 2000)
+        coverage = np.zeros(length + 2, dtype=bool)
+        intervals = IntervalCoverage()
+        for j in range(100):
+            start = rng.randint(0, length)
+            end = min(start + rng.randint(-5, 200), length)
+            assert intervals.covered(start, end) == np.sum(
+                coverage[start:end])
+            if rng.random() < 0.5:
+                coverage[start:end] = True
+                intervals.add(start, end)
+        # intervals are kept disjoint and sorted
+        assert all(e < s for e, s in zip(intervals.ends, intervals.starts[1:]))
+
+    return
@@ -0,0 +1,117 @@
+# test that the membership index stays in sync with the graph
+from panaroo.membership import MembershipIndex, attach_membership, detach_membership
+from panaroo.membership import attach_neighbours
+from panaroo.merge_nodes import merge_node_cluster, delete_node, remove_member_from_node
+from panaroo.merge_nodes import member_neighbours
+from intbitset import intbitset
+import networkx as nx
+import random
+
+
+def build_graph(n_genomes=6, n_genes=30, seed=1):
+    rng = random.Random(seed)
+    G = nx.Graph()
+    for node in range(n_genes):
+        members = intbitset(rng.sample(range(n_genomes), rng.randint(1, 3)))
+        G.add_node(node,
+                   size=len(members),
+                   centroid=[str(node)],
+                   maxLenId=0,
+                   members=members,
+                   seqIDs=set(
+                       [str(m) + "_0_" + str(node) for m in members]),
+                   hasEnd=False,
+                   protein=["M"],
+                   dna=["ATG"],
+                   annotation="",
+                   description="",
+                   lengths=[3] * len(members),
+                   longCentroidID=(3, str(node)),
+                   paralog=False,
+                   mergedDNA=False)
+    for genome in range(n_genomes):
+        path = [n for n in G.nodes() if genome in G.nodes[n]['members']]
+        for u, v in zip(path[:-1], path[1:]):
+            if G.has_edge(u, v):
+                G[u][v]['members'].add(genome)
+                G[u][v]['size'] += 1
+            else:
+                G.add_edge(u, v, size=1, members=intbitset([genome]))
+    return G
+
+
+def check_index(G, index):
+    fresh = MembershipIndex.from_graph(G)
+    assert index.node_members == fresh.node_members
+    for g in range(10):
+        assert index.nodes_with_genome(g) == fresh.nodes_with_genome(g)
+
+
+def check_neighbours(G, neighbour_index):
+    # the entries built so far match a fresh scan of the edges
+    assert set(neighbour_index.node_neighbours) <= set(G.nodes())
+    for node, neighbours in neighbour_index.node_neighbours.items():
+        assert neighbours == {
+            m: set(n)
+            for m, n in member_neighbours(G, node).items()
+        }
+
+
+def test_membership():
+
+    G = build_graph()
+    index = attach_membership(G)
+
+    merge_node_cluster(G, [0, 1, 2], 100, check_merge_mems=False)
+    check_index(G, index)
+    delete_node(G, 5)
+    check_index(G, index)
+    member = list(G.nodes[10]['members'])[0]
+    remove_member_from_node(G, 10, member)
+    check_index(G, index)
+    genomes = intbitset([0, 1])
+    assert index.nodes_with_any_genome(genomes) == set(
+        n for n in G.nodes() if len(G.nodes[n]['members'] & genomes) > 0)
+
+    detach_membership(G)
+    assert 'membership_index' not in G.graph
+
+    return
+
+
+def test_member_edges():
+    # removing nodes and members gives the same graph with and without the
+    # membership and per member neighbour indices
+    rng = random.Random(0)
+    for seed in range(5):
+        graphs = [build_graph(n_genes=60, seed=seed) for i in range(2)]
+        index = attach_membership(graphs[1])
+        neighbour_index = attach_neighbours(graphs[1])
+        nodes = rng.sample(list(graphs[0].nodes()), 30)
+        new_node = 100
+        n_cached = 0
+        for i, node in enumerate(nodes):
+            if node not in graphs[0]: continue
+            for G in graphs:
+                if i % 3 == 0:
+                    delete_node(G, node)
+                elif i % 3 == 1:
+                    # remove members one at a time from the same node
+                    for member in sorted(G.nodes[node]['members'])[:-1]:
+                        remove_member_from_node(G, node, member)
+                else:
+                    other = [n for n in nodes[:i] if n in G][-1:]
+                    merge_node_cluster(G, [node] + other,
+                                       new_node,
+                                       check_merge_mems=False)
+            new_node += (i % 3 == 2)
+            check_index(graphs[1], index)
+            check_neighbours(graphs[1], neighbour_index)
+            n_cached += len(neighbour_index.node_neighbours)
+        assert n_cached > 0
+        assert list(graphs[0].nodes()) == list(graphs[1].nodes())
+        assert set(graphs[0].edges()) == set(graphs[1].edges())
+        for u, v in graphs[0].edges():
+            assert graphs[0][u][v] == graphs[1][u][v]
+
+    return
@@ -0,0 +1,94 @@
+# test the per stage graph memory report
+from panaroo.memory_profile import MemoryProfiler, graph_memory_usage
+from panaroo.memory_profile import deep_sizeof
+from panaroo.merge_nodes import merge_values
+from intbitset import intbitset
+import networkx as nx
+import random
+import json
+import os
+
+
+def build_graph(n_nodes=400, n_genomes=20, seed=0):
+    rng = random.Random(seed)
+    G = nx.Graph()
+    for n in range(n_nodes):
+        members = intbitset(rng.sample(range(n_genomes),
+                                       rng.randint(1, n_genomes)))
+        G.add_node(n,
+                   size=len(members),
+                   members=members,
+                   seqIDs=set(str(m) + "_0_" + str(n) for m in members),
+                   dna=["ATG" * rng.randint(10, 300)],
+                   lengths=merge_values([[300] * (len(members) // 2),
+                                         [303] * ((len(members) + 1) // 2)],
+                                        False),
+                   annotation="hypothetical protein")
+    for n in range(n_nodes - 1):
+        members = G.nodes[n]['members'] & G.nodes[n + 1]['members']
+        G.add_edge(n, n + 1, size=len(members), members=members)
+    return G
+
+
+def exact_bytes(items):
+    total = {}
+    for attrs in items:
+        for key, value in attrs.items():
+            total[key] = total.get(key, 0) + deep_sizeof(value)
+    return total
+
+
+def test_memory_profile(tmp_path):
+    G = build_graph()
+
+    # measuring every node and edge gives the exact sizes
+    usage = graph_memory_usage(G, sample_size=len(G))
+    assert usage['n_nodes'] == 400
+    assert usage['n_edges'] == 399
+    assert usage['node_attribute_bytes'] == exact_bytes(
+        d for n, d in G.nodes(data=True))
+    assert usage['edge_attribute_bytes'] == exact_bytes(
+        d for u, v, d in G.edges(data=True))
+
+    # a sample gives a close estimate
+    sampled = graph_memory_usage(G, sample_size=100)
+    for key in ['total_node_attribute_bytes', 'total_edge_attribute_bytes']:
+        assert abs(sampled[key] - usage[key]) < 0.2 * usage[key]
+    assert set(sampled['node_attribute_bytes']) == set(
+        usage['node_attribute_bytes'])
+
+    profiler = MemoryProfiler(enabled=True, sample_size=100, n_genomes=20)
+    profiler.record("generate_network", G)
+    G.remove_nodes_from(range(200))
+    profiler.record("trim", G)
+    outfile = str(tmp_path / "graph_memory.json")
+    profiler.write(outfile)
+
+    with open(outfile) as infile:
+        report = json.load(infile)
+    assert report['n_genomes'] == 20
+    assert report['sample_size'] == 100
+    assert [s['stage'] for s in report['stages']] == [
+        "generate_network", "trim"
+    ]
+    for stage in report['stages']:
+        assert set(stage) == set([
+            'stage', 'stage_seconds', 'n_nodes', 'n_edges',
+            'node_attribute_bytes', 'edge_attribute_bytes',
+            'total_node_attribute_bytes', 'total_edge_attribute_bytes',
+            'peak_rss_bytes'
+        ])
+        assert set(stage['node_attribute_bytes']) == set(
+            ['size', 'members', 'seqIDs', 'dna', 'lengths', 'annotation'])
+    assert report['stages'][1]['n_nodes'] == 200
+    assert (report['stages'][1]['total_node_attribute_bytes'] <
+            report['stages'][0]['total_node_attribute_bytes'])
+
+    # a disabled profiler records and writes nothing
+    profiler = MemoryProfiler()
+    profiler.record("generate_network", G)
+    profiler.write(str(tmp_path / "disabled.json"))
+    assert profiler.stages == []
+    assert not os.path.exists(str(tmp_path / "disabled.json"))
+
+    return
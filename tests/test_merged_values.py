@@ -0,0 +1,74 @@
+# test that attributes recorded lazily by merge_node_cluster materialise to
+# the values of merging them eagerly, including for long chains of merges
+from panaroo.merge_nodes import merge_node_cluster, merged_value, materialise_merged, iter_del_dups, MergedValues, MAX_MERGE_DEPTH
+from intbitset import intbitset
+import networkx as nx
+import pickle
+import random
+
+
+def add_gene(G, node, rng):
+    G.add_node(node,
+               size=1,
+               centroid=[str(node)],
+               maxLenId=0,
+               members=intbitset([node]),
+               seqIDs=set([str(node) + "_0_0"]),
+               hasEnd=False,
+               protein=["M"],
+               dna=["ATG"],
+               annotation=";".join(rng.sample("abcdef", rng.randint(1, 3))),
+               description=rng.choice(["", "hypothetical", "kinase;ligase"]),
+               lengths=[rng.randint(100, 200)],
+               longCentroidID=(3, str(node)),
+               paralog=False,
+               mergedDNA=False)
+    return
+
+
+def test_merged_values():
+    rng = random.Random(0)
+    G = nx.Graph()
+    n_genes = 3 * MAX_MERGE_DEPTH
+    for node in range(n_genes):
+        add_gene(G, node, rng)
+
+    # eagerly merged attributes in the same order as the lazy merges
+    annotation = [G.nodes[0]['annotation']]
+    description = [G.nodes[0]['description']]
+    lengths = list(G.nodes[0]['lengths'])
+
+    current = 0
+    new_node = n_genes
+    for node in range(1, n_genes):
+        # merge_node_cluster puts the node with least support first
+        first, second = sorted([current, node],
+                               key=lambda x: G.nodes[x]['size'])
+        if first == node:
+            annotation.insert(0, G.nodes[node]['annotation'])
+            description.insert(0, G.nodes[node]['description'])
+            lengths = G.nodes[node]['lengths'] + lengths
+        else:
+            annotation.append(G.nodes[node]['annotation'])
+            description.append(G.nodes[node]['description'])
+            lengths = lengths + G.nodes[node]['lengths']
+        G = merge_node_cluster(G, [current, node], new_node)
+        current = new_node
+        new_node += 1
+
+    merged = G.nodes[current]['annotation']
+    assert isinstance(merged, MergedValues)
+    assert merged.depth <= MAX_MERGE_DEPTH
+    assert pickle.loads(pickle.dumps(merged)).materialise() == \
+        merged.materialise()
+
+    assert merged_value(G, current, 'lengths') == lengths
+    assert G.nodes[current]['lengths'] == lengths
+
+    G = materialise_merged(G)
+    assert G.nodes[current]['annotation'] == ";".join(
+        iter_del_dups(a.split(";") for a in annotation))
+    assert G.nodes[current]['description'] == ";".join(
+        iter_del_dups(d.split(";") for d in description))
+
+    return
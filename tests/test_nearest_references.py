@@ -0,0 +1,42 @@
+# test the searches used to assign paralogs to references
+from panaroo.clean_network import _nearest_references, _bfs_distances
+from panaroo.clean_network import _context_similarity
+import networkx as nx
+import numpy as np
+
+
+def test_nearest_references():
+
+    # 0 - 1 - 2 - 3 - 4 - 5   6
+    G = nx.path_graph(6)
+    G.add_node(6)
+
+    # node 2 is equally close to both references and takes the first
+    nearest = _nearest_references(G, [4, 0], [1, 2, 3, 5, 6])
+    assert nearest == {1: (1, 1), 2: (0, 2), 3: (0, 1), 5: (0, 1)}
+    nearest = _nearest_references(G, [0, 4], [2])
+    assert nearest == {2: (0, 2)}
+
+    assert _bfs_distances(G, 0, [2, 5, 6]) == {2: 2, 5: 5}
+
+    return
+
+
+def test_context_similarity():
+
+    # the sparse score matches the dense vector calculation
+    a = {0: 5, 3: 4, 7: 1}
+    b = {3: 2, 7: 1, 9: 5}
+    dense_a = np.zeros(10)
+    dense_b = np.zeros(10)
+    for k in a:
+        dense_a[k] = a[k]
+    for k in b:
+        dense_b[k] = b[k]
+    expected = np.sum(1 / (1 + np.abs(
+        (dense_a - dense_b)[(dense_a * dense_b) != 0])))
+    assert _context_similarity(a, b) == expected
+    assert _context_similarity(b, a) == expected
+    assert _context_similarity(a, {}) == 0
+
+    return
@@ -0,0 +1,37 @@
+# test that cached neighbourhoods match a fresh breadth-first search as the
+# graph is modified
+from panaroo.clean_network import NeighbourhoodCache
+import networkx as nx
+
+
+def bfs_neighbours(G, node, depth):
+    return [v for u, v in nx.bfs_edges(G, source=node, depth_limit=depth)
+            ] + [node]
+
+
+def test_neighbourhood_cache():
+
+    G = nx.random_regular_graph(3, 60, seed=1)
+    cache = NeighbourhoodCache(G)
+
+    for depth in [1, 2, 3]:
+        for node in G.nodes():
+            assert cache.neighbours(node, depth) == bfs_neighbours(
+                G, node, depth)
+    assert cache.stats[1]['misses'] == 60
+    assert cache.stats[2]['extended'] == 60
+
+    # contract pairs of adjacent nodes as a merge would
+    new_node = max(G.nodes()) + 1
+    for u, v in [(0, next(iter(G.adj[0]))), (10, next(iter(G.adj[10])))]:
+        cache.invalidate([u, v])
+        for n in list(G.adj[u]) + list(G.adj[v]):
+            if n not in (u, v):
+                G.add_edge(new_node, n)
+        G.remove_nodes_from([u, v])
+        new_node += 1
+        for node in G.nodes():
+            assert cache.neighbours(node, 3) == bfs_neighbours(G, node, 3)
+    assert cache.stats[3]['hits'] > 0
+
+    return
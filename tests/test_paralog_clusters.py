@@ -0,0 +1,50 @@
+# test that the union-find grouping of paralogs matches a sweep over all
+# centroids, including the order nodes are added to each cluster
+from panaroo.clean_network import _paralog_clusters
+import random
+
+
+def sweep_clusters(paralog_centroids):
+    merge_clusters = []
+    while len(paralog_centroids) > 0:
+        first, *rest = paralog_centroids
+        first = set(first)
+        lf = -1
+        while len(first) > lf:
+            lf = len(first)
+            rest2 = []
+            for r in rest:
+                if len(first.intersection(set(r))) > 0:
+                    first |= set(r)
+                else:
+                    rest2.append(r)
+            rest = rest2
+        merge_clusters.append(first)
+        paralog_centroids = rest
+    return merge_clusters
+
+
+def test_paralog_clusters():
+
+    # a chain that is only joined up on a second sweep
+    groups = [[1, 2], [5, 6], [4, 5], [3, 4], [2, 3], [7]]
+    assert _paralog_clusters(groups) == [set([1, 2, 3, 4, 5, 6]), set([7])]
+
+    # a reversed chain needs a sweep for every centroid
+    groups = [[0, 1]] + [[i, i + 1] for i in range(300, 0, -1)]
+    assert [list(c) for c in _paralog_clusters(groups)
+            ] == [list(c) for c in sweep_clusters(groups)]
+
+    rng = random.Random(0)
+    for i in range(200):
+        nodes = rng.sample(range(1000, 100000), 50)
+        groups = [
+            rng.sample(nodes, rng.randint(1, 3))
+            for j in range(rng.randint(1, 40))
+        ]
+        expected = sweep_clusters(groups)
+        observed = _paralog_clusters(groups)
+        assert observed == expected
+        assert [list(c) for c in observed] == [list(c) for c in expected]
+
+    return
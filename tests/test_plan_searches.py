@@ -0,0 +1,51 @@
+# test the bitset search planner against looping over the genes of every
+# neighbour
+from panaroo.find_missing import plan_searches
+from intbitset import intbitset
+from collections import defaultdict
+import networkx as nx
+import random
+
+
+def loop_searches(G, id_to_gff):
+    n_searches = 0
+    search_list = defaultdict(lambda: defaultdict(set))
+    conflicts = defaultdict(set)
+    for node in G.nodes():
+        for neigh in G.neighbors(node):
+            for sid in sorted(G.nodes[neigh]['seqIDs']):
+                member = int(sid.split("_")[0])
+                conflicts[member].add((neigh, id_to_gff[sid]))
+                if member not in G.nodes[node]['members']:
+                    search_list[member][node].add(
+                        (G.nodes[node]["dna"][G.nodes[node]['maxLenId']],
+                         id_to_gff[sid]))
+                    n_searches += 1
+    return search_list, conflicts, n_searches
+
+
+def test_plan_searches():
+    rng = random.Random(0)
+    G = nx.gnm_random_graph(200, 400, seed=0)
+    id_to_gff = {}
+    for node in G.nodes():
+        seqIDs = set()
+        for member in rng.sample(range(50), rng.randint(1, 50)):
+            # include paralogs
+            for i in range(1 + (rng.random() < 0.1)):
+                sid = str(member) + "_0_" + str(node * 10 + i)
+                seqIDs.add(sid)
+                id_to_gff[sid] = "gene" + sid
+        G.nodes[node]['seqIDs'] = seqIDs
+        G.nodes[node]['members'] = intbitset(
+            [int(sid.split("_")[0]) for sid in seqIDs])
+        G.nodes[node]['dna'] = ["ATG" * (node + 1)]
+        G.nodes[node]['maxLenId'] = 0
+
+    expected = loop_searches(G, id_to_gff)
+    planned = plan_searches(G, id_to_gff)
+    assert planned[0] == expected[0]
+    assert planned[1] == expected[1]
+    assert planned[2] == expected[2]
+
+    return
@@ -0,0 +1,86 @@
+# test that the refind search aligns once to overlapping windows around the
+# neighbours of a gene and still finds it
+from panaroo.find_missing import search_gff
+from Bio.Seq import translate
+import random
+
+
+def write_gff(path, contig, genes):
+    with open(path, 'w') as outfile:
+        outfile.write("##gff-version 3\n")
+        for geneid, start, end in genes:
+            outfile.write("\t".join([
+                "contig1", "prokka", "CDS",
+                str(start),
+                str(end), ".", "+", "0", "ID=" + geneid
+            ]) + "\n")
+        outfile.write("##FASTA\n>contig1\n" + contig + "\n")
+    return
+
+
+def test_search_windows(tmp_path):
+    rng = random.Random(0)
+    contig = "".join(rng.choice("ACGT") for i in range(30000))
+    missing = contig[10000:10600]
+
+    # three neighbours close to the missing gene and one far away
+    genes = [("gene1", 9000, 9900), ("gene2", 10700, 11500),
+             ("gene3", 11600, 12200), ("gene4", 25000, 25900)]
+    gff_file = str(tmp_path / "genome.gff")
+    write_gff(gff_file, contig, genes)
+
+    searches = {1: set((missing, g[0]) for g in genes)}
+    conflicts = set([(2, g[0]) for g in genes])
+    protein = translate(missing)
+    hits, node_locs, max_seq_len, stats = search_gff(
+        searches,
+        conflicts,
+        gff_file,
+        merged_nodes={},
+        node_proteins={1: protein},
+        search_radius=2000)
+
+    # one alignment to each strand of the window around the close genes
+    # and of the window around the far one
+    assert stats['searches'] == 4
+    assert stats['alignments_saved'] == 2
+    assert stats['edlib_calls'] <= 4
+    assert stats['hits'] == 1
+    # hits are returned translated, with the padding codon of the frame
+    assert hits == [(1, missing, protein + "X")]
+    assert node_locs[1] == ["contig1", [10000, 10600, 0]]
+    assert max_seq_len == len(contig)
+
+    return
+
+
+def test_only_valid_genes(tmp_path):
+    rng = random.Random(1)
+    codons = [a + b + c for a in "ACGT" for b in "ACGT" for c in "ACGT"]
+    codons = [c for c in codons if c not in ["TAA", "TAG", "TGA"]]
+    query = "ATG" + "".join(rng.choice(codons) for i in range(199))
+    # the copy in the genome has a frame shift
+    missing = query[:300] + query[301:]
+    contig = "".join(rng.choice("ACGT") for i in range(30000))
+    contig = contig[:10000] + missing + contig[10000 + len(missing):]
+
+    genes = [("gene1", 9000, 9900), ("gene4", 25000, 25900)]
+    gff_file = str(tmp_path / "genome.gff")
+    write_gff(gff_file, contig, genes)
+
+    for only_valid_genes in [False, True]:
+        hits, node_locs, max_seq_len, stats = search_gff(
+            {1: set((query, g[0]) for g in genes)},
+            set([(2, g[0]) for g in genes]),
+            gff_file,
+            merged_nodes={},
+            node_proteins={1: translate(query)},
+            search_radius=2000,
+            only_valid_genes=only_valid_genes)
+        # the best hit is checked, not the empty hit of the last window
+        if only_valid_genes:
+            assert hits == []
+        else:
+            assert [h[1] for h in hits] == [missing]
+
+    return
@@ -0,0 +1,45 @@
+# test that the seeded refind search returns the same hits as aligning to
+# the whole search window
+from panaroo.find_missing import search_dna, guaranteed_match_length
+from Bio.Seq import reverse_complement
+import random
+
+
+def random_dna(n, rng):
+    return "".join(rng.choice("ACGT") for i in range(n))
+
+
+def test_guaranteed_match_length():
+    # hits of up to 50 bases must be exact at 98% identity
+    assert guaranteed_match_length(20, 0.98) == 20
+    assert guaranteed_match_length(50, 0.98) == 25
+    assert guaranteed_match_length(100, 0.95) == 16
+
+
+def test_seeded_search():
+    rng = random.Random(0)
+    n_found = 0
+    for i in range(60):
+        query = random_dna(rng.randint(100, 600), rng)
+        window = random_dna(3000, rng)
+        hit = "".join(b if rng.random() < 0.99 else rng.choice("ACGT")
+                      for b in query)
+        if i % 4 == 1:
+            hit = reverse_complement(hit)
+        if i % 4 == 2:
+            # a fragment at the end of the contig
+            window = window + hit[:len(hit) // 2 + 10]
+        elif i % 4 != 3:
+            pos = rng.randint(0, len(window))
+            window = window[:pos] + hit + window[pos:]
+
+        seeded = search_dna(window, query, 0.2, 0.98, True, seeded=True)
+        exhaustive = search_dna(window, query, 0.2, 0.98, True, seeded=False)
+        assert seeded == exhaustive
+        if i % 4 == 3:
+            assert seeded[0] == ""
+        n_found += seeded[0] != ""
+
+    assert n_found > 40
+
+    return
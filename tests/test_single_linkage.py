@@ -0,0 +1,28 @@
+# test the union-find clustering of neighbouring nodes by centroid similarity
+from panaroo.clean_network import single_linkage, centroid_adjacency
+from scipy.sparse import csr_matrix
+import networkx as nx
+import numpy as np
+
+
+def test_single_linkage():
+
+    centroid_to_index = {str(i): i for i in range(6)}
+    # links 0-1 and 3-4 are only stored in one direction
+    distances = csr_matrix((np.ones(2), ([0, 4], [1, 3])), shape=(6, 6))
+    adjacency = centroid_adjacency(distances)
+    assert adjacency[1] == frozenset([0])
+    assert adjacency[5] == frozenset()
+
+    G = nx.Graph()
+    G.add_node(10, centroid=['3'])
+    G.add_node(11, centroid=['0'])
+    G.add_node(12, centroid=['2', '4'])
+    G.add_node(13, centroid=['1'])
+    G.add_node(14, centroid=['5'])
+
+    clusters = single_linkage(G, adjacency, centroid_to_index,
+                              [10, 11, 12, 13, 14])
+    assert clusters == [[10, 12], [11, 13], [14]]
+
+    return
@@ -0,0 +1,26 @@
+# test the vectorised six frame translation against Biopython
+from panaroo.find_missing import translate_to_match, six_frame_translation
+from Bio.Seq import translate, reverse_complement
+import random
+
+
+def test_translate():
+    rng = random.Random(0)
+    for i in range(200):
+        alphabet = "ACGT" if i % 2 else "ACGTACGTACGTNRYacgt"
+        dna = "".join(
+            rng.choice(alphabet) for j in range(rng.randint(1, 300)))
+
+        expected = [
+            translate(s[f:].ljust(len(s[f:]) + (3 - len(s[f:]) % 3), 'N'))
+            for f in range(3) for s in [dna, reverse_complement(dna)]
+        ]
+        assert six_frame_translation(dna) == expected
+
+    # the frame sharing most 3-mers with the target is chosen
+    dna = "".join(rng.choice("ACGT") for j in range(300))
+    target = translate(reverse_complement(dna)[1:-2])
+    assert translate_to_match(dna, target)[:-1] == target
+    assert translate_to_match("", target) == ""
+
+    return